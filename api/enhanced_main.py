@@ -1,52 +1,56 @@
 import os
+import collections
+import copy
+import hmac
 import json
+import sys
 import asyncio
-from datetime import datetime, timedelta
-import google.generativeai as genai
+import threading
+import time
+from datetime import datetime
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from supabase import create_client, Client
 from dotenv import load_dotenv
 import logging
 from config import (
     MAX_DEEP_DIVE_QUESTIONS,
-    MAX_QUESTIONS_PER_REPLY,
     STOP_FOLLOW_UP_PHRASES,
     RAG_ENABLED,
-    KNOWLEDGE_DIR,
-    RAG_MAX_CONTEXT_CHARS,
+    RAG_TOP_K,
+    PROMPT_TOKEN_BUDGETS,
     AUTO_SILENCE_ON_ACK,
     ACKNOWLEDGEMENT_PHRASES,
+    STREAMING_ENABLED,
+    MAX_OUTPUT_TOKENS,
+    MAX_CONCURRENT_UPDATES,
+    PLAN_SPECULATION_AFTER_STEPS,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_MAX_PROCESSING_SECONDS,
+    WEBHOOK_SEEN_UPDATES,
 )
 
-# Lightweight RAG retriever
-def retrieve_context(query: str) -> str:
+from knowledge_index import get_knowledge_index, get_retriever, retrieve_ranked
+from context_packer import pack_context, projected_json
+from llm_backend import get_backend
+from llm_client import generate_json_async, get_model, message_deadline
+from llm_metrics import dump_periodically
+from user_store import get_user_state, get_user_store
+from chat_dispatcher import ChatDispatcher, MessageCoalescer
+from speculation import Speculator
+from circuit_breaker import CircuitBreaker
+from fallback_replies import fallback_reply
+from telegram_stream import ProgressiveReply, limit_questions, visible_plan_text, visible_reply_text
+
+# Lightweight RAG retriever: ranked knowledge chunks from the in-process index (RAG_BACKEND),
+# cached per keyword set (see retrieval_cache_stats() for hit/miss counters)
+def retrieve_chunks(query: str):
+    """Ranked (chunk, score) pairs for the token-budget packer; empty when RAG is off"""
     if not RAG_ENABLED:
-        return ""
+        return []
     try:
-        import os
-        import re
-        ctx_chunks = []
-        if not os.path.isdir(KNOWLEDGE_DIR):
-            return ""
-        # naive keyword scanning across small text/pdf summaries
-        for root, _, files in os.walk(KNOWLEDGE_DIR):
-            for name in files:
-                if not name.lower().endswith((".txt", ".md")):
-                    continue
-                path = os.path.join(root, name)
-                with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                    text = f.read()
-                # prioritize files containing any keyword from query
-                keywords = [w for w in re.findall(r"[a-zA-Z]{4,}", query.lower())]
-                score = sum(1 for k in keywords if k in text.lower())
-                if score > 0:
-                    snippet = text[: RAG_MAX_CONTEXT_CHARS]
-                    ctx_chunks.append(f"Source: {name}\n{snippet}")
-        combined = "\n\n".join(ctx_chunks)
-        return combined[: RAG_MAX_CONTEXT_CHARS]
+        return retrieve_ranked(query, RAG_TOP_K)
     except Exception:
-        return ""
+        return []
 
 load_dotenv()
 
@@ -55,125 +59,237 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token on every webhook request
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
 
-genai.configure(api_key=GEMINI_API_KEY)
+get_backend().configure(GEMINI_API_KEY)
 logging.basicConfig(level=logging.INFO)
 
+# --- STATIC COACH INSTRUCTIONS ---
+# Sent as the model's system_instruction, so the per-turn prompt carries only
+# the user-specific part (and the prefix can be context-cached where supported)
+PERSONALITY_ANALYSIS_INSTRUCTION = """
+You are an empathetic, authoritative coaching analyst. Start with brief reflective listening (1 sentence), then infer practical personality signals. Keep it concise and human.
+
+Tasks:
+1) Reflect what they shared and likely feel (1 sentence).
+2) Identify traits, interests, communication style, motivation factors.
+3) Provide at most one focused follow-up question. If the user already made a clear commitment or gave a complete answer, do not ask a question.
+
+Return JSON:
+{
+    "personality_insights": {
+        "traits": ["trait1", "trait2"],
+        "interests": ["interest1", "interest2"],
+        "communication_style": "direct|supportive|analytical|motivational",
+        "motivation_factors": ["achievement", "growth", "recognition"]
+    },
+    "follow_up_question": "One concise question or empty if not needed",
+    "conversation_context": "What we learned from this response"
+}
+"""
+
+PLAN_GENERATION_INSTRUCTION = """
+You are an empathetic, practical coach designing a small daily plan. Reflect briefly, then propose tasks that fit the user's personality and goals.
+
+Requirements:
+- 3–4 tasks balancing physical, emotional, and mental development.
+- Make tasks tiny and specific; reduce friction; include clear cues.
+- Include difficulty mix (easy/medium/hard) and a brief personality-fit.
+- Provide a short motivation line matching the user's tone (no hype).
+
+Return JSON:
+{
+    "daily_plan": {
+        "date": "YYYY-MM-DD",
+        "tasks": [
+            {
+                "id": 1,
+                "type": "physical|emotional|mental",
+                "title": "Task title",
+                "description": "Brief, concrete action with cue",
+                "difficulty": "easy|medium|hard",
+                "personality_fit": "Why this suits them"
+            }
+        ],
+        "motivation_message": "Brief personalized motivation"
+    }
+}
+"""
+
+ACCOUNTABILITY_INSTRUCTION = """
+You are an empathetic, authoritative coach responding to a check-in. Start with one reflective sentence. Offer one practical suggestion. End with at most one purposeful question only if needed. Match tone to mood. Avoid hype.
+
+Guidelines:
+- Normalize setbacks (“data, not a verdict”), suggest a tiny next step.
+- Use micro-techniques when apt: reframing, scaling (0–10), tiny commitments.
+- If the user makes a clear commitment (e.g., “first chapter tonight”), do not ask a question—confirm and close.
+- Keep language natural, respectful, and concise (2–3 sentences).
+
+Return JSON:
+{
+    "reply_to_user": "Concise reflection + one practical suggestion + optional question",
+    "next_action": "wait_for_response|generate_new_plan|send_motivation|no_reply",
+    "updated_insights": {
+        "new_traits": ["..."],
+        "progress_notes": "What we learned about their progress"
+    }
+}
+"""
+
+# --- RESPONSE SCHEMAS ---
+# Passed as response_schema, so the API returns JSON of exactly this shape
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+PERSONALITY_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "personality_insights": {
+            "type": "object",
+            "properties": {
+                "traits": _STRING_LIST,
+                "interests": _STRING_LIST,
+                "communication_style": {
+                    "type": "string",
+                    "enum": ["direct", "supportive", "analytical", "motivational"],
+                },
+                "motivation_factors": _STRING_LIST,
+            },
+            "required": ["traits", "interests", "communication_style", "motivation_factors"],
+        },
+        "follow_up_question": {"type": "string"},
+        "conversation_context": {"type": "string"},
+    },
+    "required": ["personality_insights", "follow_up_question"],
+}
+
+PLAN_GENERATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "daily_plan": {
+            "type": "object",
+            "properties": {
+                "date": {"type": "string"},
+                "tasks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "type": {"type": "string", "enum": ["physical", "emotional", "mental"]},
+                            "title": {"type": "string"},
+                            "description": {"type": "string"},
+                            "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]},
+                            "personality_fit": {"type": "string"},
+                        },
+                        "required": ["id", "type", "title", "description", "difficulty"],
+                    },
+                },
+                "motivation_message": {"type": "string"},
+            },
+            "required": ["date", "tasks", "motivation_message"],
+        },
+    },
+    "required": ["daily_plan"],
+}
+
+ACCOUNTABILITY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reply_to_user": {"type": "string"},
+        "next_action": {
+            "type": "string",
+            "enum": ["wait_for_response", "generate_new_plan", "send_motivation", "no_reply"],
+        },
+        "updated_insights": {
+            "type": "object",
+            "properties": {
+                "new_traits": _STRING_LIST,
+                "progress_notes": {"type": "string"},
+            },
+        },
+    },
+    "required": ["reply_to_user", "next_action"],
+}
+
 # --- ENHANCED AGENT SYSTEM ---
 class EnhancedAICoach:
-    def __init__(self):
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+    def __init__(self, model=None, breaker=None):
+        # Optional single model for every phase (tests, benchmarks); by default each
+        # phase uses the shared model carrying its own system instruction
+        self.model = model
+        # Handlers check breaker.allow() before a model call; every call reports to it
+        self.breaker = breaker or CircuitBreaker()
+
+    def _model_for(self, instruction):
+        return self.model or get_model(system_instruction=instruction)
+
+    async def _generate_json(self, instruction, schema, prompt, phase, on_text=None, cache=None):
+        """Schema-constrained call with deadline-bounded retries; streamed when on_text is given"""
+        start = time.monotonic()
+        result = await generate_json_async(
+            self._model_for(instruction), prompt, phase, schema, MAX_OUTPUT_TOKENS[phase], on_text, cache=cache
+        )
+        self.breaker.record(result is not None, time.monotonic() - start)
+        return result
         
     async def analyze_personality(self, user_message, user_data):
         """First API call: Analyze response and generate follow-up questions"""
-        rag_context = retrieve_context(user_message)
-        prompt = f"""
-        You are an empathetic, authoritative coaching analyst. Start with brief reflective listening (1 sentence), then infer practical personality signals. Keep it concise and human.
-        
-        User Data: {json.dumps(user_data, indent=2)}
+        rag_chunks = retrieve_chunks(user_message)
+
+        def render(user_json, rag_context):
+            return f"""
+        User Data: {user_json}
         User Message: "{user_message}"
         Retrieved Coaching Knowledge (optional):\n{rag_context}
-        
-        Tasks:
-        1) Reflect what they shared and likely feel (1 sentence).
-        2) Identify traits, interests, communication style, motivation factors.
-        3) Provide at most one focused follow-up question. If the user already made a clear commitment or gave a complete answer, do not ask a question.
-        
-        Return JSON:
-        {{
-            "personality_insights": {{
-                "traits": ["trait1", "trait2"],
-                "interests": ["interest1", "interest2"],
-                "communication_style": "direct|supportive|analytical|motivational",
-                "motivation_factors": ["achievement", "growth", "recognition"]
-            }},
-            "follow_up_question": "One concise question or empty if not needed",
-            "conversation_context": "What we learned from this response"
-        }}
         """
+
+        user_json, rag_context, _ = pack_context(
+            "analyze_personality", user_data, rag_chunks,
+            PROMPT_TOKEN_BUDGETS["analyze_personality"],
+            reserved_text=PERSONALITY_ANALYSIS_INSTRUCTION + render("", ""),
+        )
+        prompt = render(user_json, rag_context)
         
-        try:
-            response = self.model.generate_content(prompt)
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-            return json.loads(cleaned_response)
-        except Exception as e:
-            print(f"Error in personality analysis: {e}")
-            return None
+        return await self._generate_json(
+            PERSONALITY_ANALYSIS_INSTRUCTION, PERSONALITY_ANALYSIS_SCHEMA, prompt, "analyze_personality"
+        )
     
-    async def generate_personalized_plan(self, user_data):
-        """Second API call: Create personalized daily plan based on personality"""
+    async def generate_personalized_plan(self, user_data, on_text=None, cache=None):
+        """Second API call: Create personalized daily plan based on personality.
+
+        cache=False skips the LLM cache: the prompt doesn't change after
+        onboarding, so a regenerated plan would otherwise be the one rejected.
+        """
         prompt = f"""
-        You are an empathetic, practical coach designing a small daily plan. Reflect briefly, then propose tasks that fit the user's personality and goals.
-        
-        User Data: {json.dumps(user_data, indent=2)}
-        
-        Requirements:
-        - 3–4 tasks balancing physical, emotional, and mental development.
-        - Make tasks tiny and specific; reduce friction; include clear cues.
-        - Include difficulty mix (easy/medium/hard) and a brief personality-fit.
-        - Provide a short motivation line matching the user's tone (no hype).
-        
-        Return JSON:
-        {{
-            "daily_plan": {{
-                "date": "YYYY-MM-DD",
-                "tasks": [
-                    {{
-                        "id": 1,
-                        "type": "physical|emotional|mental",
-                        "title": "Task title",
-                        "description": "Brief, concrete action with cue",
-                        "difficulty": "easy|medium|hard",
-                        "personality_fit": "Why this suits them"
-                    }}
-                ],
-                "motivation_message": "Brief personalized motivation"
-            }}
-        }}
+        User Data: {projected_json("generate_personalized_plan", user_data)}
         """
         
-        try:
-            response = self.model.generate_content(prompt)
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-            return json.loads(cleaned_response)
-        except Exception as e:
-            print(f"Error in plan generation: {e}")
-            return None
+        return await self._generate_json(
+            PLAN_GENERATION_INSTRUCTION, PLAN_GENERATION_SCHEMA, prompt, "generate_personalized_plan", on_text, cache
+        )
     
-    async def create_accountability_response(self, user_message, user_data):
+    async def create_accountability_response(self, user_message, user_data, on_text=None):
         """Third API call: Generate accountability and reflection responses"""
-        rag_context = retrieve_context(user_message)
-        prompt = f"""
-        You are an empathetic, authoritative coach responding to a check-in. Start with one reflective sentence. Offer one practical suggestion. End with at most one purposeful question only if needed. Match tone to mood. Avoid hype.
-        
-        User Data: {json.dumps(user_data, indent=2)}
+        rag_chunks = retrieve_chunks(user_message)
+
+        def render(user_json, rag_context):
+            return f"""
+        User Data: {user_json}
         User Message: "{user_message}"
         Retrieved Coaching Knowledge (optional):\n{rag_context}
-        
-        Guidelines:
-        - Normalize setbacks (“data, not a verdict”), suggest a tiny next step.
-        - Use micro-techniques when apt: reframing, scaling (0–10), tiny commitments.
-        - If the user makes a clear commitment (e.g., “first chapter tonight”), do not ask a question—confirm and close.
-        - Keep language natural, respectful, and concise (2–3 sentences).
-        
-        Return JSON:
-        {{
-            "reply_to_user": "Concise reflection + one practical suggestion + optional question",
-            "next_action": "wait_for_response|generate_new_plan|send_motivation|no_reply",
-            "updated_insights": {{
-                "new_traits": ["..."],
-                "progress_notes": "What we learned about their progress"
-            }}
-        }}
         """
+
+        user_json, rag_context, _ = pack_context(
+            "accountability_response", user_data, rag_chunks,
+            PROMPT_TOKEN_BUDGETS["accountability_response"],
+            reserved_text=ACCOUNTABILITY_INSTRUCTION + render("", ""),
+        )
+        prompt = render(user_json, rag_context)
         
-        try:
-            response = self.model.generate_content(prompt)
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-            return json.loads(cleaned_response)
-        except Exception as e:
-            print(f"Error in accountability response: {e}")
-            return None
+        return await self._generate_json(
+            ACCOUNTABILITY_INSTRUCTION, ACCOUNTABILITY_SCHEMA, prompt, "accountability_response", on_text
+        )
 
 # --- ENHANCED PROMPT SYSTEM ---
 ENHANCED_PROMPT = """
@@ -209,9 +325,21 @@ Response Format (strict JSON):
 }
 """
 
-async def get_enhanced_agent_response(chat_id, user_message, user_data):
-    """Enhanced agent response with multiple API calls"""
-    coach = EnhancedAICoach()
+_coach = None
+
+def get_coach():
+    """Process-wide coach; handlers get it injected via bot_data["coach"]"""
+    global _coach
+    if _coach is None:
+        _coach = EnhancedAICoach()
+    return _coach
+
+async def get_enhanced_agent_response(chat_id, user_message, user_data, coach=None, reply=None):
+    """Enhanced agent response with multiple API calls.
+
+    reply is an optional ProgressiveReply the model output is streamed into.
+    """
+    coach = coach or get_coach()
     
     # Determine current phase and appropriate action
     onboarding_step = user_data.get('onboarding', {}).get('current_step', 'start')
@@ -230,11 +358,11 @@ async def get_enhanced_agent_response(chat_id, user_message, user_data):
     
     elif onboarding_step == 'plan_generation':
         # Plan creation phase
-        return await handle_plan_creation(user_data, coach)
+        return await handle_plan_creation(user_data, coach, reply, chat_id)
     
     else:
         # Daily execution phase
-        return await handle_daily_execution(user_message, user_data, coach)
+        return await handle_daily_execution(user_message, user_data, coach, reply)
 
 async def handle_first_interaction(user_message, user_data, coach):
     """Handle the very first interaction with a new user"""
@@ -267,8 +395,20 @@ async def handle_first_interaction(user_message, user_data, coach):
         "personality_insights": {}
     }
 
+def fallback_response(kind, user_message, user_data, next_actions=("wait_for_response",)):
+    """Templated reply while the circuit breaker keeps the model out of the loop; state is unchanged"""
+    return {
+        "reply_to_user": fallback_reply(kind, user_message, user_data),
+        "updated_user_data": user_data,
+        "next_actions": list(next_actions),
+        "personality_insights": {}
+    }
+
 async def handle_personality_assessment(user_message, user_data, coach):
     """Handle personality assessment phase"""
+    if not coach.breaker.allow():
+        return fallback_response("personality_assessment", user_message, user_data)
+
     # First API call: Analyze personality
     personality_analysis = await coach.analyze_personality(user_message, user_data)
     
@@ -323,10 +463,7 @@ async def handle_personality_assessment(user_message, user_data, coach):
         )
 
     # Enforce max one question in follow-up
-    if follow_up.count('?') > MAX_QUESTIONS_PER_REPLY:
-        first_q_idx = follow_up.find('?')
-        if first_q_idx != -1:
-            follow_up = follow_up[: first_q_idx + 1]
+    follow_up = limit_questions(follow_up)
     
     return {
         "reply_to_user": follow_up,
@@ -365,10 +502,40 @@ async def handle_goal_setting(user_message, user_data, coach):
         "personality_insights": {}
     }
 
-async def handle_plan_creation(user_data, coach):
-    """Handle plan creation phase"""
-    # Second API call: Generate personalized plan
-    plan_data = await coach.generate_personalized_plan(user_data)
+# First plans started in the background during onboarding, see speculate_plan()
+plan_speculator = Speculator()
+
+def speculate_plan(chat_id, user_data, coach):
+    """Start generating the chat's plan from user_data now; handle_plan_creation picks it up if still current.
+
+    The habits answer is the plan's last input and the plan is due in the
+    same turn, so the call only gets a head start of the "Give me a sec..."
+    reply, about one Telegram round trip. Before that answer a plan would
+    always be stale, so none is started.
+    """
+    if not coach.breaker.allow() or not user_data.get('goals', {}).get('bad_habits'):
+        return
+    snapshot = copy.deepcopy(user_data)
+    plan_speculator.start(
+        chat_id,
+        projected_json("generate_personalized_plan", snapshot),
+        lambda on_text: coach.generate_personalized_plan(snapshot, on_text if STREAMING_ENABLED else None),
+    )
+
+async def handle_plan_creation(user_data, coach, reply=None, chat_id=None, regenerate=False):
+    """Handle plan creation phase; regenerate asks for a new plan instead of a cached one"""
+    # Second API call: Generate personalized plan, task titles shown as they stream in
+    on_text = reply and (lambda raw: reply.update(visible_plan_text(raw)))
+    plan_data = None
+    if chat_id is not None:
+        # a speculative plan counts only if it was made from the same plan inputs
+        plan_data = await plan_speculator.take(
+            chat_id, projected_json("generate_personalized_plan", user_data), on_text
+        )
+    if not plan_data:
+        if not coach.breaker.allow():
+            return fallback_response("plan_creation", "", user_data, ["generate_plan"])
+        plan_data = await coach.generate_personalized_plan(user_data, on_text, cache=False if regenerate else None)
     
     if not plan_data:
         return {
@@ -407,10 +574,14 @@ Today's tasks:
         "personality_insights": {}
     }
 
-async def handle_daily_execution(user_message, user_data, coach):
+async def handle_daily_execution(user_message, user_data, coach, reply=None):
     """Handle daily execution phase"""
-    # Third API call: Generate accountability response
-    accountability_response = await coach.create_accountability_response(user_message, user_data)
+    if not coach.breaker.allow():
+        return fallback_response("daily_execution", user_message, user_data)
+
+    # Third API call: Generate accountability response, reply_to_user shown as it streams in
+    on_text = reply and (lambda raw: reply.update(visible_reply_text(raw)))
+    accountability_response = await coach.create_accountability_response(user_message, user_data, on_text)
     
     if not accountability_response:
         return {
@@ -427,11 +598,7 @@ async def handle_daily_execution(user_message, user_data, coach):
         user_data['user_info'].update(accountability_response['updated_insights'])
     
     # Ensure a single follow-up question max; optionally strip multiple questions
-    reply_text = accountability_response['reply_to_user']
-    if reply_text.count('?') > MAX_QUESTIONS_PER_REPLY:
-        first_q_idx = reply_text.find('?')
-        if first_q_idx != -1:
-            reply_text = reply_text[: first_q_idx + 1]
+    reply_text = limit_questions(accountability_response['reply_to_user'])
 
     # If model suggests no further interaction, respect it
     next_action = accountability_response.get('next_action', 'wait_for_response')
@@ -446,30 +613,87 @@ async def handle_daily_execution(user_message, user_data, coach):
         "personality_insights": accountability_response.get('updated_insights', {})
     }
 
+async def send_reply(update, reply, text):
+    """Deliver text as the final state of a streamed reply, or as a plain message"""
+    if reply:
+        await reply.finish(text)
+    else:
+        await update.message.reply_text(text)
+
+# Updates are processed concurrently (MAX_CONCURRENT_UPDATES); turns of one chat run in order
+chat_dispatcher = ChatDispatcher()
+# Bursts of messages from one chat (COALESCE_WINDOW_SECONDS) become one turn with one reply
+message_coalescer = MessageCoalescer()
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Enhanced message handler with multiple API calls"""
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    """Process the message after every earlier message of its chat, other chats in parallel"""
+    chat_id = update.message.chat_id
+    coalescer = context.bot_data.get("coalescer") or message_coalescer
+    try:
+        if not await coalescer.add(chat_id, update):
+            return  # answered with the burst it joined
+        async with chat_dispatcher.turn(chat_id):
+            await answer_burst(context, *coalescer.take(chat_id))
+    finally:
+        # cancelled before the turn took the burst: messages that joined it were told
+        # they'd be answered with it, so the burst gets a turn of its own
+        leftover = coalescer.release(chat_id, update)
+        if leftover:
+            context.application.create_task(answer_leftover_burst(context, chat_id, *leftover))
+
+async def answer_burst(context, updates, opened_at):
+    """One reply for a burst, to its latest message; the reply timer starts at the first"""
+    await process_message(updates[-1], context, "\n".join(u.message.text or "" for u in updates), opened_at)
+
+async def answer_leftover_burst(context, chat_id, updates, opened_at):
+    async with chat_dispatcher.turn(chat_id):
+        await answer_burst(context, updates, opened_at)
+
+async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message=None, started=None):
+    """Enhanced message handler with multiple API calls.
+
+    Every model call of the turn (agent reply, plan creation, their retries
+    and hedges) shares one message_deadline(), API_TIMEOUT from the start.
+    """
+    with message_deadline():
+        await _process_message(update, context, user_message, started)
+
+async def _process_message(update, context, user_message, started):
+    store = context.bot_data.get("user_state") or get_user_state()
+    coach = context.bot_data.get("coach") or get_coach()
     chat_id = update.message.chat_id
-    user_message = update.message.text
+    if user_message is None:
+        user_message = update.message.text
+    # Timed from the burst's first message (started) so time-to-first-visible-text
+    # includes the coalescing window and the DB fetch
+    reply = ProgressiveReply(context.bot, chat_id, "reply", started=started) if STREAMING_ENABLED else None
 
     await context.bot.send_chat_action(chat_id=chat_id, action='typing')
 
-    # 1. Fetch user data
+    # 1. Fetch user data; the stored copy is the base of the delta writes below
+    stored = None
     try:
-        db_response = supabase.table('users').select("user_data").eq('chat_id', chat_id).execute()
-        user_data = db_response.data[0]['user_data'] if db_response.data else {}
+        stored = await store.fetch(chat_id)
+        user_data = copy.deepcopy(stored) or {}
     except Exception as e:
         logging.error(f"DB fetch error: {e}")
         user_data = {}
 
+    # A webhook update Telegram redelivers after a slow turn may reach another
+    # instance; the row remembers the last update a turn was saved for
+    update_id = getattr(update, "update_id", None)
+    if update_id is not None and user_data.get('last_update_id', -1) >= update_id:
+        logging.info(f"Skipping update {update_id} for chat {chat_id}, already answered")
+        return
+
     # Optional: silence on acknowledgements
     if AUTO_SILENCE_ON_ACK and (user_message or "").strip().lower() in ACKNOWLEDGEMENT_PHRASES:
         try:
             # Persist minimal heartbeat
-            supabase.table('users').upsert({
-                'chat_id': chat_id,
-                'user_data': {**user_data, 'last_seen': datetime.utcnow().isoformat()}
-            }).execute()
+            heartbeat = {**user_data, 'last_seen': datetime.utcnow().isoformat()}
+            if update_id is not None:
+                heartbeat['last_update_id'] = update_id
+            await store.save(chat_id, heartbeat, stored)
             # Do not reply on simple acks
             return
         except Exception as e:
@@ -477,29 +701,29 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             print(f"Silence-on-ack upsert failed: {e}")
 
     # 2. Get enhanced response from our Agent
+    answered_step = user_data.get('onboarding', {}).get('current_step')
     try:
-        agent_response = await get_enhanced_agent_response(chat_id, user_message, user_data)
+        agent_response = await get_enhanced_agent_response(chat_id, user_message, user_data, coach, reply)
     except Exception as e:
         logging.error(f"Agent error: {e}")
         agent_response = None
 
     if not agent_response:
         try:
-            await update.message.reply_text("I'm having a hiccup. Let's keep it simple—what's one small step you want to take next?")
+            await send_reply(update, reply, "I'm having a hiccup. Let's keep it simple—what's one small step you want to take next?")
         except Exception as send_err:
             logging.error(f"Reply send error (fallback): {send_err}")
         return
 
     # 3. Act on the agent's decision
-    reply_text = agent_response.get("reply_to_user", "Not sure what to say, man. Try again.")
-    if reply_text.count('?') > MAX_QUESTIONS_PER_REPLY:
-        first_q_idx = reply_text.find('?')
-        if first_q_idx != -1:
-            reply_text = reply_text[: first_q_idx + 1]
+    reply_text = limit_questions(agent_response.get("reply_to_user", "Not sure what to say, man. Try again."))
     updated_data = agent_response.get("updated_user_data")
+    if updated_data and answered_step in PLAN_SPECULATION_AFTER_STEPS:
+        # the plan call overlaps sending this reply
+        speculate_plan(chat_id, updated_data, coach)
 
     try:
-        await update.message.reply_text(reply_text)
+        await send_reply(update, reply, reply_text)
     except Exception as send_err:
         logging.error(f"Reply send error: {send_err}")
 
@@ -508,15 +732,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     for action in next_actions:
         if action == "generate_plan":
-            # Generate plan asynchronously
-            plan_response = await handle_plan_creation(updated_data, EnhancedAICoach())
+            # Generate plan asynchronously (usually already running, see speculate_plan)
+            plan_reply = ProgressiveReply(context.bot, chat_id, "plan") if STREAMING_ENABLED else None
+            plan_response = await handle_plan_creation(updated_data, coach, plan_reply, chat_id)
             if plan_response:
-                await update.message.reply_text(plan_response["reply_to_user"])
+                await send_reply(update, plan_reply, plan_response["reply_to_user"])
                 updated_data = plan_response["updated_user_data"]
         elif action == "generate_new_plan":
-            plan_response = await handle_plan_creation(updated_data, EnhancedAICoach())
+            plan_reply = ProgressiveReply(context.bot, chat_id, "plan") if STREAMING_ENABLED else None
+            plan_response = await handle_plan_creation(updated_data, coach, plan_reply, regenerate=True)
             if plan_response:
-                await update.message.reply_text(plan_response["reply_to_user"])
+                await send_reply(update, plan_reply, plan_response["reply_to_user"])
                 updated_data = plan_response["updated_user_data"]
         elif action == "send_motivation":
             # Lightweight motivation message based on current tasks
@@ -531,17 +757,180 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 5. Save updated state to database
     if updated_data:
+        if update_id is not None:
+            updated_data['last_update_id'] = update_id
         try:
-            supabase.table('users').upsert({
-                'chat_id': chat_id,
-                'user_data': updated_data
-            }).execute()
+            await store.save(chat_id, updated_data, stored)
         except Exception as e:
             logging.error(f"DB upsert error: {e}")
 
+async def start_background_tasks(app):
+    """post_init hook: tasks that live as long as the bot"""
+    app.create_task(dump_periodically())
+    state = get_user_state()
+    if hasattr(state, "run_flusher"):
+        app.create_task(state.run_flusher())
+
+async def stop_background_tasks(app):
+    """post_shutdown hook: write back user state still held in memory"""
+    await (app.bot_data.get("user_state") or get_user_state()).close()
+
+def build_application(webhook=False):
+    """The bot with its handlers; webhook=True leaves out the polling Updater"""
+    builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(MAX_CONCURRENT_UPDATES)
+    if webhook:
+        builder = builder.updater(None)
+    else:
+        builder = builder.post_init(start_background_tasks).post_shutdown(stop_background_tasks)
+    application = builder.build()
+    application.bot_data["coach"] = get_coach()
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+# --- WEBHOOK MODE ---
+# Webhook updates all run on one event loop per process, on its own thread,
+# whatever loop the ASGI server calls app() on. A runtime that starts a new loop
+# per request would otherwise need a new Application and UserStore each time,
+# leaking the HTTP connection pools of the old ones.
+_webhook_loop = None
+_webhook_loop_lock = threading.Lock()
+_webhook_lock = None
+_webhook_application = None
+
+def get_webhook_loop():
+    """The process's webhook event loop, started on first use"""
+    global _webhook_loop
+    with _webhook_loop_lock:
+        if _webhook_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="webhook-loop", daemon=True).start()
+            _webhook_loop = loop
+    return _webhook_loop
+
+async def on_webhook_loop(coro):
+    """Await coro run on the webhook loop; cancelling the caller cancels it there"""
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_webhook_loop()))
+
+async def get_webhook_application():
+    """The initialized webhook-mode Application (call on the webhook loop)"""
+    global _webhook_lock, _webhook_application
+    if _webhook_lock is None:
+        _webhook_lock = asyncio.Lock()
+    async with _webhook_lock:
+        if _webhook_application is None:
+            application = build_application(webhook=True)
+            # serverless instances neither share memory nor outlive the request reliably,
+            # so webhook updates read and write Supabase directly instead of a per-instance cache
+            application.bot_data["user_state"] = get_user_store()
+            # every update is its own request, so a burst never forms: don't wait for one
+            application.bot_data["coalescer"] = MessageCoalescer(window_seconds=0)
+            await application.initialize()
+            _webhook_application = application
+    return _webhook_application
+
+# update_ids this process has started on, oldest first (see WEBHOOK_SEEN_UPDATES)
+_seen_update_ids = collections.OrderedDict()
+
+async def stop_webhook_application():
+    """Shut the webhook Application down and close its user store (call on the webhook loop)"""
+    if _webhook_application is not None:
+        await stop_background_tasks(_webhook_application)
+        await _webhook_application.shutdown()
+
+async def process_webhook_update(data):
+    """Run one decoded update through the same handlers as polling, unless this process already has (on the webhook loop)"""
+    update_id = data.get("update_id")
+    if update_id in _seen_update_ids:
+        logging.info(f"Skipping redelivered webhook update {update_id}")
+        return
+    _seen_update_ids[update_id] = None
+    while len(_seen_update_ids) > WEBHOOK_SEEN_UPDATES:
+        _seen_update_ids.popitem(last=False)
+    application = await get_webhook_application()
+    await application.process_update(Update.de_json(data, application.bot))
+
+async def _respond(send, status, body=b""):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def app(scope, receive, send):
+    """ASGI entry point for webhook mode (vercel.json routes every request here).
+
+    A POSTed update is processed within the request, for at most
+    WEBHOOK_MAX_PROCESSING_SECONDS. The 200 is sent first, but Vercel's Python
+    runtime buffers the response, so there Telegram gets it only when
+    processing ends (servers that stream ASGI responses, such as uvicorn,
+    deliver it at once). A turn slow enough for Telegram to redeliver the
+    update is not run twice: process_webhook_update skips update_ids this
+    process has seen, and process_message those already saved to the chat's
+    row. Anything else gets a plain health check reply.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await on_webhook_loop(get_webhook_application())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await on_webhook_loop(stop_webhook_application())
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    if scope["method"] != "POST":
+        return await _respond(send, 200, b"ok")
+    if not TELEGRAM_WEBHOOK_SECRET:
+        # without it anyone who finds the URL could post updates as any chat
+        logging.error("TELEGRAM_WEBHOOK_SECRET is not set, refusing webhook updates")
+        return await _respond(send, 403)
+    headers = dict(scope.get("headers") or [])
+    secret = headers.get(b"x-telegram-bot-api-secret-token", b"")
+    if not hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET.encode()):
+        return await _respond(send, 403)
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return await _respond(send, 400)
+    if not isinstance(data, dict):
+        return await _respond(send, 400)
+    await _respond(send, 200)
+    try:
+        await asyncio.wait_for(on_webhook_loop(process_webhook_update(data)), WEBHOOK_MAX_PROCESSING_SECONDS)
+    except asyncio.TimeoutError:
+        logging.error(f"Webhook update {data.get('update_id')} cut off after {WEBHOOK_MAX_PROCESSING_SECONDS}s")
+    except Exception as e:
+        logging.error(f"Webhook update {data.get('update_id')} failed: {e}")
+
+async def set_webhook(url):
+    """Point Telegram at url (stops getUpdates polling for this bot)"""
+    if not TELEGRAM_WEBHOOK_SECRET:
+        sys.exit("Set TELEGRAM_WEBHOOK_SECRET first: the webhook refuses updates without it")
+    application = build_application(webhook=True)
+    async with application:
+        await application.bot.set_webhook(
+            url,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=["message"],
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    print(f"Webhook set to {url}")
+
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "--set-webhook":
+        asyncio.run(set_webhook(sys.argv[2]))
+        sys.exit()
     print("Starting Jose Marino AI coach...")
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    if RAG_ENABLED:
+        index = get_knowledge_index()
+        get_retriever().search("warm up", top_k=1)
+        print(f"Knowledge index ready: {index.chunk_count} chunks from {index.file_count} files")
+    application = build_application()
     print("Jose Marino is live and ready to coach! 💪")
-    app.run_polling() 
+    application.run_polling() 
@@ -0,0 +1,56 @@
+# Bulk retrieval cost for the nightly scheduler: per-user BM25 loop vs one vectorized TF-IDF pass
+#
+# Usage: python benchmarks/bench_batch_retrieval.py [--users 10000]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import KNOWLEDGE_DIR, RAG_TOP_K
+from knowledge_index import KnowledgeIndex
+from tfidf_retriever import TfidfRetriever
+
+GOAL_WORDS = [
+    "procrastinate", "workout", "reading", "sleep", "phone", "scrolling", "motivation", "habits",
+    "confidence", "stress", "focus", "career", "discipline", "routine", "anxiety", "health",
+    "meditation", "learning", "doubt", "failure", "identity", "energy", "family", "friends",
+]
+
+
+def synthetic_queries(count, seed=7):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(GOAL_WORDS) for _ in range(12)) for _ in range(count)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+
+    index = KnowledgeIndex(KNOWLEDGE_DIR)
+    tfidf = TfidfRetriever(index)
+    tfidf.search("warm up", top_k=1)
+    queries = synthetic_queries(args.users)
+
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, top_k=RAG_TOP_K)
+    loop_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for query in queries:
+        tfidf.search(query, top_k=RAG_TOP_K)
+    tfidf_loop_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tfidf.search_batch(queries, top_k=RAG_TOP_K)
+    batch_s = time.perf_counter() - start
+
+    print(f"{args.users} users, {len(index.chunks)} chunks")
+    print(f"  bm25 per-user loop    {loop_s * 1000:9.1f} ms")
+    print(f"  tfidf per-user loop   {tfidf_loop_s * 1000:9.1f} ms")
+    print(f"  tfidf batch           {batch_s * 1000:9.1f} ms")
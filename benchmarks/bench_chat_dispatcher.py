@@ -0,0 +1,82 @@
+# Lost updates and throughput: sequential updates vs concurrent vs concurrent with per-chat ordering
+#
+# Every message is a handle_message-style turn: read the chat's user_data,
+# wait for the "model" (--llm-ms), write the blob back with the message
+# appended. Chats send --burst messages at once. Sequential is the bot
+# without concurrent_updates; concurrent runs every update as it arrives;
+# dispatched runs updates concurrently through ChatDispatcher.
+#
+# Usage: python benchmarks/bench_chat_dispatcher.py [--chats 200] [--burst 3] [--llm-ms 50]
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_dispatcher import ChatDispatcher
+
+
+class MemoryStore:
+    def __init__(self, rtt_s):
+        self.rtt_s = rtt_s
+        self.rows = {}
+
+    async def fetch(self, chat_id):
+        await asyncio.sleep(self.rtt_s)
+        return copy.deepcopy(self.rows.get(chat_id))
+
+    async def save(self, chat_id, user_data):
+        await asyncio.sleep(self.rtt_s)
+        self.rows[chat_id] = copy.deepcopy(user_data)
+
+
+async def turn(store, chat_id, message, llm_s, rng):
+    user_data = await store.fetch(chat_id) or {"messages": []}
+    await asyncio.sleep(llm_s * rng.uniform(0.5, 1.5))
+    user_data["messages"].append(message)
+    await store.save(chat_id, user_data)
+
+
+async def run(mode, chats, burst, llm_s, rtt_s, seed):
+    rng = random.Random(seed)
+    store = MemoryStore(rtt_s)
+    dispatcher = ChatDispatcher()
+    updates = [(chat_id, f"{chat_id}.{i}") for i in range(burst) for chat_id in range(chats)]
+
+    async def handle(chat_id, message):
+        context = dispatcher.turn(chat_id) if mode == "dispatched" else contextlib.nullcontext()
+        async with context:
+            await turn(store, chat_id, message, llm_s, rng)
+
+    start = time.perf_counter()
+    if mode == "sequential":
+        for chat_id, message in updates:
+            await handle(chat_id, message)
+    else:
+        await asyncio.gather(*(handle(chat_id, message) for chat_id, message in updates))
+    elapsed = time.perf_counter() - start
+    kept = sum(len(row["messages"]) for row in store.rows.values())
+    in_order = sum(row["messages"] == [f"{chat_id}.{i}" for i in range(burst)] for chat_id, row in store.rows.items())
+    print(f"  {mode:10}  {len(updates) / elapsed:8.1f} msg/s  lost updates {len(updates) - kept:5}/{len(updates)}"
+          f"  chats with every message in order {in_order}/{chats}")
+    if mode == "dispatched":
+        print(f"  dispatcher: {dispatcher.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--burst", type=int, default=3)
+    parser.add_argument("--llm-ms", type=float, default=50)
+    parser.add_argument("--rtt-ms", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for mode in ("sequential", "concurrent", "dispatched"):
+        asyncio.run(run(mode, args.chats, args.burst, args.llm_ms / 1000, args.rtt_ms / 1000, args.seed))
@@ -0,0 +1,76 @@
+# Reply latency through a provider brownout, with and without the circuit breaker
+#
+# Messages go through handle_daily_execution one after another. The fake
+# model answers in ~10 ms, except during the brownout when every call hangs
+# past the message deadline. Times are scaled down: a 0.5 s message deadline,
+# 0.2 s slow-call threshold and 1 s open period.
+#
+# Usage: python benchmarks/bench_circuit_breaker.py [--healthy 40] [--brownout 80]
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from circuit_breaker import CircuitBreaker
+from enhanced_main import EnhancedAICoach, handle_daily_execution
+from llm_client import message_deadline
+
+REPLY = json.dumps({"reply_to_user": "Nice run. Same time tomorrow?", "next_action": "wait_for_response"})
+USER_DATA = {
+    "onboarding": {"current_step": "complete"},
+    "daily_plan": {"tasks": [{"id": 1, "title": "20 minute run", "difficulty": "medium"}]},
+}
+
+
+class FakeResponse:
+    text = REPLY
+    usage_metadata = None
+
+
+class FakeModel:
+    degraded = False
+
+    def generate_content(self, prompt, **kwargs):
+        time.sleep(1.0 if self.degraded else 0.01)
+        return FakeResponse()
+
+
+async def run(label, breaker, healthy, brownout):
+    model = FakeModel()
+    coach = EnhancedAICoach(model, breaker or CircuitBreaker(min_calls=10**9))
+    periods = [("healthy", healthy, False), ("brownout", brownout, True), ("recovered", healthy, False)]
+    print(f"  {label}")
+    for period, messages, degraded in periods:
+        model.degraded = degraded
+        latencies, fallbacks = [], 0
+        for _ in range(messages):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), message_deadline(0.5):
+                response = await handle_daily_execution("did my run", dict(USER_DATA), coach)
+            latencies.append(time.perf_counter() - start)
+            fallbacks += not response["reply_to_user"].startswith("Nice run")
+            await asyncio.sleep(0.02)
+        print(f"    {period:9} p50 {statistics.median(latencies) * 1000:6.0f} ms  max {max(latencies) * 1000:6.0f} ms"
+              f"  templated/failed replies {fallbacks}/{messages}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--healthy", type=int, default=40)
+    parser.add_argument("--brownout", type=int, default=80)
+    args = parser.parse_args()
+
+    asyncio.run(run("no breaker", None, args.healthy, args.brownout))
+    breaker = CircuitBreaker(window=10, min_calls=5, failure_rate=0.5, slow_call_seconds=0.2, open_seconds=1.0)
+    asyncio.run(run("breaker", breaker, args.healthy, args.brownout))
+    print(f"  breaker: {breaker.stats()}")
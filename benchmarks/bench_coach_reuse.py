@@ -0,0 +1,64 @@
+# Per-message overhead of building a coach + GenerativeModel per message vs one shared instance
+#
+# The Gemini transport is replaced by an in-process stub that returns a canned
+# response, so the numbers are the client-side cost only (no network).
+#
+# Usage: python benchmarks/bench_coach_reuse.py [--messages 2000]
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.ai import generativelanguage as glm
+
+REPLY = '{"reply_to_user": "Nice work.", "next_action": "wait_for_response", "updated_insights": {}}'
+
+
+class StubGenerativeClient:
+    def generate_content(self, request, **kwargs):
+        return glm.GenerateContentResponse(
+            candidates=[glm.Candidate(content=glm.Content(parts=[glm.Part(text=REPLY)], role="model"))]
+        )
+
+
+def per_message(fn, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn()
+    return (time.perf_counter() - start) / messages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    from enhanced_main import EnhancedAICoach  # configures genai at import
+
+    genai.configure(api_key="bench")
+    genai_client._client_manager.clients["generative"] = StubGenerativeClient()
+
+    def fresh():
+        # what every message did before: a new coach and a new GenerativeModel, plus the
+        # plan branches' second coach
+        EnhancedAICoach(genai.GenerativeModel("gemini-1.5-flash")).model.generate_content("hi").text
+        EnhancedAICoach(genai.GenerativeModel("gemini-1.5-flash"))
+
+    shared = EnhancedAICoach(genai.GenerativeModel("gemini-1.5-flash"))
+
+    def reused():
+        shared.model.generate_content("hi").text
+
+    fresh_s = per_message(fresh, args.messages)
+    reused_s = per_message(reused, args.messages)
+    print(f"{args.messages} messages, stub transport")
+    print(f"  new coach/model per message  {fresh_s * 1e6:8.1f} us/message")
+    print(f"  shared coach/model           {reused_s * 1e6:8.1f} us/message")
+    print(f"  saved                        {(fresh_s - reused_s) * 1e6:8.1f} us/message")
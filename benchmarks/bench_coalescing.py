@@ -0,0 +1,81 @@
+# Model calls, DB writes and replies for bursty chats, with and without message coalescing
+#
+# Each chat types a burst of --burst messages with --gap-ms (jittered)
+# between them, like "did the walk" / "but skipped reading" / "tired today".
+# Every turn is fetch -> model (--llm-ms) -> upsert -> one reply, run through
+# ChatDispatcher as in handle_message. The default window and max wait (150 /
+# 600 ms) are COALESCE_WINDOW_SECONDS / COALESCE_MAX_WAIT_SECONDS; gaps are
+# scaled down to tens of ms, so the ratios are what matters.
+#
+# Usage: python benchmarks/bench_coalescing.py [--chats 100] [--burst 3] [--gap-ms 60] [--window-ms 150]
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_dispatcher import ChatDispatcher, MessageCoalescer
+
+
+async def run(label, window_s, chats, burst, gap_s, llm_s, seed):
+    rng = random.Random(seed)
+    dispatcher = ChatDispatcher()
+    coalescer = MessageCoalescer(window_s or 0, (window_s or 0) * 4)
+    counts = {"model calls": 0, "db writes": 0, "replies": 0}
+    last_sent = {}
+    answered = []  # seconds from a burst's last message to the reply covering it
+
+    async def process(chat_id, text):
+        await asyncio.sleep(0.005)  # fetch
+        counts["model calls"] += 1
+        await asyncio.sleep(llm_s * rng.uniform(0.5, 1.5))
+        counts["db writes"] += 1
+        await asyncio.sleep(0.005)  # upsert
+        counts["replies"] += 1
+        if text.endswith(f"#{burst - 1}"):
+            answered.append(time.perf_counter() - last_sent[chat_id])
+
+    async def handle_message(chat_id, text):
+        if window_s is None:  # a turn per message
+            async with dispatcher.turn(chat_id):
+                return await process(chat_id, text)
+        if not await coalescer.add(chat_id, text):
+            return
+        async with dispatcher.turn(chat_id):
+            items, _ = coalescer.take(chat_id)
+            await process(chat_id, "\n".join(items))
+
+    async def user(chat_id):
+        tasks = []
+        for i in range(burst):
+            if i:
+                await asyncio.sleep(gap_s * rng.uniform(0.5, 1.5))
+            last_sent[chat_id] = time.perf_counter()
+            tasks.append(asyncio.ensure_future(handle_message(chat_id, f"message #{i}")))
+        await asyncio.gather(*tasks)
+
+    await asyncio.gather(*(user(chat_id) for chat_id in range(chats)))
+    messages = chats * burst
+    print(f"  {label:22} " + "  ".join(f"{name} {count:4}/{messages}" for name, count in counts.items())
+          + f"  last message -> reply p50 {statistics.median(answered) * 1000:5.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--burst", type=int, default=3)
+    parser.add_argument("--gap-ms", type=float, default=60)
+    parser.add_argument("--window-ms", type=float, default=150)
+    parser.add_argument("--llm-ms", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    modes = (("turn per message", None), ("coalesce, no window", 0), (f"{args.window_ms:.0f} ms window", args.window_ms))
+    for label, window_ms in modes:
+        window_s = None if window_ms is None else window_ms / 1000
+        asyncio.run(run(label, window_s, args.chats, args.burst, args.gap_ms / 1000, args.llm_ms / 1000, args.seed))
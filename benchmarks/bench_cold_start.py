@@ -0,0 +1,74 @@
+# Cold start: mmapping the prebuilt knowledge artifact vs building the index at import
+#
+# Each measurement runs in a fresh interpreter and reports the time from process
+# start to the first answered query plus the process peak RSS (Linux only).
+#
+# Usage: python benchmarks/bench_cold_start.py [--scale 100]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from bench_retrieval import make_synthetic_corpus
+from knowledge_artifact import build_artifact
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repo!r})
+from knowledge_artifact import load_artifact
+from knowledge_index import KnowledgeIndex
+if {mode!r} == "artifact":
+    index = load_artifact({artifact!r}, {knowledge_dir!r})
+    assert index is not None
+else:
+    index = KnowledgeIndex({knowledge_dir!r})
+index.search("I keep procrastinating, motivation is low", top_k=4)
+elapsed = time.perf_counter() - start
+# VmHWM, not ru_maxrss: the latter is inherited from the parent across exec
+with open("/proc/self/status") as f:
+    peak_kb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+print(json.dumps({{"ms": elapsed * 1000, "rss_mb": peak_kb / 1024}}))
+"""
+
+
+def measure(mode, knowledge_dir, artifact, runs=5):
+    results = []
+    for _ in range(runs):
+        code = CHILD.format(repo=REPO, mode=mode, knowledge_dir=knowledge_dir, artifact=artifact)
+        out = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout))
+    best = min(results, key=lambda r: r["ms"])
+    return best["ms"], best["rss_mb"]
+
+
+def run(label, knowledge_dir):
+    artifact = os.path.join(tempfile.mkdtemp(prefix="kidx_"), "knowledge.idx")
+    try:
+        chunks, terms, size = build_artifact(knowledge_dir, artifact)
+        print(f"{label}: {chunks} chunks, {terms} terms, artifact {size / 1024:.0f} KiB")
+        for mode in ("build", "artifact"):
+            ms, rss = measure(mode, knowledge_dir, artifact)
+            print(f"  {mode:9s} first answer after {ms:8.1f} ms, peak RSS {rss:6.1f} MiB")
+    finally:
+        shutil.rmtree(os.path.dirname(artifact), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=100)
+    args = parser.parse_args()
+
+    run("knowledge/", os.path.join(REPO, "knowledge"))
+    synthetic = make_synthetic_corpus(args.scale)
+    try:
+        run(f"synthetic x{args.scale}", synthetic)
+    finally:
+        shutil.rmtree(synthetic, ignore_errors=True)
@@ -0,0 +1,79 @@
+# Bytes written per update: full user_data upserts vs JSON patches through patch_user_data
+#
+# Chats with --days of accumulated history (see bench_projection.py) go
+# through a day of typical writes: ack heartbeats (last_seen), task
+# completions, a progress note and a new daily plan. Each write goes through
+# UserStore.save_changes against the PostgREST stand-in of bench_user_store.py,
+# which applies patches like the SQL function. The stored rows are compared
+# with the expected documents at the end.
+#
+# Usage: python benchmarks/bench_delta_persistence.py [--chats 50] [--days 30 90 365]
+
+import argparse
+import asyncio
+import copy
+import datetime
+import os
+import sys
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_projection import sample_user_data
+from bench_user_store import KEY, PostgrestStandIn, start_stand_in
+from user_store import UserStore
+
+
+def day_of_updates(user_data):
+    """The documents a chat's writes produce over one day, in order"""
+    docs = []
+
+    def step(change):
+        doc = copy.deepcopy(docs[-1] if docs else user_data)
+        change(doc)
+        docs.append(doc)
+
+    for hour in (8, 12, 18):
+        step(lambda d, h=hour: d.update(last_seen=datetime.datetime(2026, 10, 18, h).isoformat()))
+    for task in range(3):
+        step(lambda d, t=task: d["daily_plan"]["tasks"][t].update(completed=True))
+    step(lambda d: d["user_info"].update(progress_notes=d["user_info"]["progress_notes"] + " Day 31: all done."))
+    step(lambda d: d["daily_plan"].update(date="2026-10-19", tasks=[
+        {"id": 1, "type": "physical", "title": "30 minute run", "difficulty": "medium"},
+        {"id": 2, "type": "mental", "title": "Read 15 pages", "difficulty": "easy"},
+    ]))
+    return docs
+
+
+async def run(label, url, chats, days, deltas):
+    store = UserStore(url, KEY)
+    store.deltas_enabled = deltas
+    PostgrestStandIn.rows.clear()
+    start = sample_user_data(days)
+    await store.save_many([(chat_id, start) for chat_id in range(chats)])
+    PostgrestStandIn.requests = PostgrestStandIn.bytes_received = 0
+    updates = day_of_updates(start)
+    base = start
+    for doc in updates:
+        await store.save_changes([(chat_id, base, doc) for chat_id in range(chats)])
+        base = doc
+    await store.close()
+    correct = sum(row["user_data"] == updates[-1] for row in PostgrestStandIn.rows.values())
+    writes = chats * len(updates)
+    print(f"  {days:4} days  {label:12} {PostgrestStandIn.bytes_received / writes:9.0f} bytes/write"
+          f"  (document {store.full_bytes / writes:6.0f})  patched {store.patched_rows:4}  full {store.full_rows:4}"
+          f"  rows correct {correct}/{chats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--days", type=int, nargs="+", default=[30, 90, 365])
+    args = parser.parse_args()
+
+    server, url = start_stand_in(0, 0)
+    for days in args.days:
+        for label, deltas in (("full upserts", False), ("json patch", True)):
+            asyncio.run(run(label, url, args.chats, days, deltas))
+    server.shutdown()
@@ -0,0 +1,98 @@
+# Offline load test: coach throughput and latency under concurrency against the fake LLM backend
+#
+# Every model call goes through llm_backend.FakeBackend (no network, no
+# quota): lognormal latency, injected 503s and truncated JSON, schema-valid
+# replies. Concurrent chats each send messages back to back through
+# handle_daily_execution / handle_plan_creation. With the sync path the calls
+# queue on llm_client's LLM_MAX_CONCURRENT_CALLS pool, as Gemini calls do, so
+# the knee in the curve is the pool's backpressure; --native-async awaits the
+# fake's async path instead. Same --seed, same draws.
+#
+# Usage: python benchmarks/bench_fake_backend.py [--chats 8 32 128] [--messages 5] [--error-rate 0.02]
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import os
+import statistics
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from circuit_breaker import CircuitBreaker
+from config import LLM_MAX_CONCURRENT_CALLS
+from enhanced_main import EnhancedAICoach, handle_daily_execution, handle_plan_creation
+import llm_client
+from llm_backend import FakeBackend, set_backend
+from llm_client import message_deadline
+
+# model latency is what's measured: identical prompts must reach the model, not the LLM cache
+llm_client.LLM_CACHE_ENABLED = False
+
+USER_DATA = {
+    "onboarding": {"current_step": "complete"},
+    "user_info": {"vision_statement": "Run a marathon", "weaknesses": ["procrastination"]},
+    "daily_plan": {"tasks": [{"id": 1, "title": "20 minute run", "difficulty": "medium"}]},
+}
+
+
+class CountingCoach(EnhancedAICoach):
+    """Counts coach calls that gave up (no usable reply within the deadline)"""
+
+    failed = 0
+
+    async def _generate_json(self, *args, **kwargs):
+        result = await super()._generate_json(*args, **kwargs)
+        self.failed += result is None
+        return result
+
+
+async def run(chats, messages, backend):
+    set_backend(backend)
+    coach = CountingCoach(breaker=CircuitBreaker(min_calls=10**9))
+    latencies = []
+
+    async def chat(i):
+        for m in range(messages):
+            start = time.perf_counter()
+            with message_deadline(5):
+                if m % 5 == 4:
+                    await handle_plan_creation(copy.deepcopy(USER_DATA), coach)
+                else:
+                    await handle_daily_execution(f"did my run {i}.{m}", copy.deepcopy(USER_DATA), coach)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(chat(i) for i in range(chats)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"  {chats:4} chats  {len(latencies) / elapsed:7.1f} msg/s  p50 {statistics.median(latencies) * 1000:6.0f} ms"
+          f"  p99 {p99 * 1000:6.0f} ms  model calls {backend.calls:5}  failed replies {coach.failed}/{len(latencies)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--first-token-ms", type=float, default=60)
+    parser.add_argument("--ms-per-token", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--malformed-rate", type=float, default=0.02)
+    parser.add_argument("--native-async", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = "async path" if args.native_async else f"thread pool of {LLM_MAX_CONCURRENT_CALLS}"
+    print(f"fake backend, {path}: median first token {args.first_token_ms:.0f} ms, "
+          f"{args.error_rate:.0%} errors, {args.malformed_rate:.0%} malformed")
+    for chats in args.chats:
+        backend = FakeBackend(args.first_token_ms, 0.5, args.ms_per_token, args.error_rate,
+                              args.malformed_rate, args.seed, args.native_async)
+        asyncio.run(run(chats, args.messages, backend))
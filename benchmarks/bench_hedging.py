@@ -0,0 +1,71 @@
+# Tail latency of a JSON coach call with and without request hedging
+#
+# A fake model is fast most of the time and very slow for a few percent of
+# requests (independently per request, like a slow backend replica), which is
+# the case hedging targets. Latencies are scaled down: ~20 ms typical, 400 ms tail.
+#
+# Usage: python benchmarks/bench_hedging.py [--messages 1000] [--slow-rate 0.04]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_client
+from llm_client import generate_json_async, hedge_stats
+
+REPLY = json.dumps({"reply_to_user": "Nice work.", "next_action": "wait_for_response"})
+
+
+class FakeResponse:
+    text = REPLY
+    usage_metadata = None
+
+
+class FakeModel:
+    def __init__(self, slow_rate, rng):
+        self.slow_rate = slow_rate
+        self.rng = rng
+
+    def generate_content(self, prompt, **kwargs):
+        slow = self.rng.random() < self.slow_rate
+        time.sleep(0.4 if slow else self.rng.uniform(0.01, 0.03))
+        return FakeResponse()
+
+
+def percentile(ranked, p):
+    return ranked[min(len(ranked) - 1, int(len(ranked) * p / 100))]
+
+
+async def run(label, hedge, messages, slow_rate):
+    model = FakeModel(slow_rate, random.Random(11))
+    phase = f"bench_{label}"
+    latencies = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        await generate_json_async(model, "hi", phase, hedge=hedge)
+        latencies.append(time.perf_counter() - start)
+    ranked = sorted(latencies)
+    stats = hedge_stats().get(phase, {"hedges": 0, "hedge_wins": 0})
+    print(f"  {label:9} p50 {percentile(ranked, 50) * 1000:5.0f} ms  p95 {percentile(ranked, 95) * 1000:5.0f} ms"
+          f"  p99 {percentile(ranked, 99) * 1000:5.0f} ms  hedged {stats['hedges'] / messages:5.1%}"
+          f"  hedge won {stats['hedge_wins']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--slow-rate", type=float, default=0.04)
+    args = parser.parse_args()
+
+    print(f"{args.messages} calls, {args.slow_rate:.0%} slow, hedge at p{llm_client.HEDGE_PERCENTILE},"
+          f" max hedge rate {llm_client.HEDGE_MAX_RATE:.0%}")
+    asyncio.run(run("no hedge", False, args.messages, args.slow_rate))
+    asyncio.run(run("hedged", True, args.messages, args.slow_rate))
@@ -0,0 +1,87 @@
+# Malformed-reply handling: one json.loads attempt vs schema-mode retries under a message deadline
+#
+# A fake model answers after a random latency and returns broken JSON at a
+# given rate. "single" is the old behaviour: a bad reply becomes a
+# "Not catching that" message and the user has to send again. "retried"
+# runs llm_client.generate_json_async under message_deadline().
+#
+# Usage: python benchmarks/bench_json_retries.py [--messages 400] [--malformed 0.1]
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_client import generate_json_async, message_deadline, parse_json_reply
+
+REPLY = json.dumps({"reply_to_user": "Nice work.", "next_action": "wait_for_response"})
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeModel:
+    def __init__(self, malformed_rate, mean_latency_s, rng):
+        self.malformed_rate = malformed_rate
+        self.mean_latency_s = mean_latency_s
+        self.rng = rng
+
+    def generate_content(self, prompt, **kwargs):
+        time.sleep(self.rng.expovariate(1 / self.mean_latency_s))
+        if self.rng.random() < self.malformed_rate:
+            return FakeResponse(REPLY[: len(REPLY) // 2])
+        return FakeResponse(REPLY)
+
+
+async def single(model):
+    response = await asyncio.get_running_loop().run_in_executor(None, model.generate_content, "hi")
+    try:
+        return parse_json_reply(response.text)
+    except ValueError:
+        return None
+
+
+async def retried(model):
+    with message_deadline():
+        return await generate_json_async(model, "hi", "bench")
+
+
+async def run(label, fn, model, messages):
+    latencies, failures = [], 0
+    for _ in range(messages):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # per-attempt error logs
+            result = await fn(model)
+        if result is None:
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"  {label:8} failed replies {failures / messages:6.1%}  p50 {statistics.median(latencies) * 1000:6.0f} ms"
+          f"  p99 {p99 * 1000:6.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--malformed", type=float, default=0.1)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, {args.malformed:.0%} malformed replies, ~{args.latency_ms:.0f} ms per call")
+    for label, fn in (("single", single), ("retried", retried)):
+        model = FakeModel(args.malformed, args.latency_ms / 1000, random.Random(7))
+        asyncio.run(run(label, fn, model, args.messages))
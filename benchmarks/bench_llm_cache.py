@@ -0,0 +1,79 @@
+# API calls and latency for repeated plan / check-in generations, with and without the LLM cache
+#
+# Replays a scheduler run over N users twice (a rerun in the same hour) while
+# a duplicate of each plan request arrives concurrently (the generate_plan /
+# generate_new_plan branches firing together). The fake model sleeps per call
+# and counts calls, so the numbers are API calls saved and wall time.
+#
+# Usage: python benchmarks/bench_llm_cache.py [--users 200] [--latency-ms 50]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_cache import llm_cache_stats
+from llm_client import generate_json_async, generate_text_async
+
+PLAN = json.dumps({"daily_plan": {"date": "2026-10-18", "tasks": [], "motivation_message": "Go."}})
+
+
+class FakeResponse:
+    usage_metadata = None
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    model_name = "models/fake"
+
+    def __init__(self, latency_s):
+        self.latency_s = latency_s
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency_s)
+        return FakeResponse(PLAN if "plan" in prompt else "Morning! Today: run, read.")
+
+
+async def scheduler_pass(model, users, cache):
+    async def one(user):
+        prompt = f"plan for user {user}"
+        await asyncio.gather(
+            generate_json_async(model, prompt, "daily_plan", cache=cache),
+            generate_json_async(model, prompt, "daily_plan", cache=cache),  # duplicate branch
+            generate_text_async(model, f"morning for user {user}", "morning_check_in", cache=cache),
+        )
+    await asyncio.gather(*(one(user) for user in range(users)))
+
+
+async def run(label, cache, users, latency_s):
+    model = FakeModel(latency_s)
+    start = time.perf_counter()
+    await scheduler_pass(model, users, cache)
+    await scheduler_pass(model, users, cache)  # rerun within the hour
+    elapsed = time.perf_counter() - start
+    print(f"  {label:9} API calls {model.calls:5d}  wall {elapsed:6.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    print(f"{args.users} users x (2 plan requests + 1 morning) x 2 passes, {args.latency_ms:.0f} ms per call")
+    asyncio.run(run("no cache", False, args.users, args.latency_ms / 1000))
+    asyncio.run(run("cached", True, args.users, args.latency_ms / 1000))
+    print(f"  cache: {llm_cache_stats()}")
@@ -0,0 +1,118 @@
+# Overhead of per-call LLM metrics, and a sample of the JSON / Prometheus dumps
+#
+# Drives generate_json_async / generate_text_async against a fake model whose
+# responses carry usage_metadata (and that fails now and then, to exercise the
+# retry histogram), then times record_call on its own and writes both dump
+# formats to --out.
+#
+# Usage: python benchmarks/bench_llm_metrics.py [--calls 2000] [--out /tmp/llm-metrics]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_client
+from llm_client import generate_json_async, generate_text_async
+from llm_metrics import LLMMetrics, llm_metrics
+
+PHASES = {
+    # phase: (mean prompt tokens, mean output tokens)
+    "analyze_personality": (900, 300),
+    "accountability_response": (1100, 200),
+    "daily_plan": (700, 600),
+    "morning_check_in": (400, 120),
+}
+
+
+class Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.cached_content_token_count = 0
+
+
+class FakeResponse:
+    def __init__(self, text, usage):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class FakeModel:
+    model_name = "models/fake"
+
+    def __init__(self, phase, error_rate, rng):
+        self.prompt_tokens, self.output_tokens = PHASES[phase]
+        self.error_rate = error_rate
+        self.rng = rng
+
+    def generate_content(self, prompt, **kwargs):
+        time.sleep(self.rng.uniform(0.001, 0.01))
+        if self.rng.random() < self.error_rate:
+            raise RuntimeError("503 service unavailable")
+        usage = Usage(int(self.rng.gauss(self.prompt_tokens, 80)), int(self.rng.gauss(self.output_tokens, 40)))
+        return FakeResponse(json.dumps({"reply": "ok"}), usage)
+
+
+async def drive(calls, error_rate, seed):
+    rng = random.Random(seed)
+    models = {phase: FakeModel(phase, error_rate, rng) for phase in PHASES}
+    phases = list(PHASES)
+
+    async def one(i):
+        phase = phases[i % len(phases)]
+        if phase == "morning_check_in":
+            await generate_text_async(models[phase], f"prompt {i}", phase, cache=False)
+        else:
+            await generate_json_async(models[phase], f"prompt {i}", phase, hedge=False, cache=False)
+
+    await asyncio.gather(*(one(i) for i in range(calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out", default="/tmp/llm-metrics")
+    args = parser.parse_args()
+
+    llm_client.RETRY_BASE_DELAY_SECONDS = 0.001
+    start = time.perf_counter()
+    asyncio.run(drive(args.calls, args.error_rate, args.seed))
+    print(f"{args.calls} coach calls in {time.perf_counter() - start:.2f}s")
+
+    usage = Usage(900, 300)
+    metrics = LLMMetrics()
+    n = 100_000
+    start = time.perf_counter()
+    for i in range(n):
+        metrics.record_call("analyze_personality", 0.8, usage, i % 3)
+    print(f"record_call: {(time.perf_counter() - start) / n * 1e6:.2f} us per call")
+
+    os.makedirs(args.out, exist_ok=True)
+    for name in ("llm_metrics.json", "llm_metrics.prom"):
+        path = os.path.join(args.out, name)
+        start = time.perf_counter()
+        llm_metrics.dump(path)
+        print(f"dump {path}: {os.path.getsize(path)} bytes in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    print(f"\n{'phase':26} {'calls ok/err':>13} {'mean prompt':>12} {'mean output':>12} {'retried':>8}")
+    for phase, data in llm_metrics.to_dict()["phases"].items():
+        counters, histograms = data["counters"], data["histograms"]
+        ok, errors = counters.get("llm_calls_total_ok", 0), counters.get("llm_calls_total_error", 0)
+        retries = histograms["llm_call_retries"]
+        retried = retries["count"] - retries["buckets"]["0"]
+        print(f"{phase:26} {f'{ok}/{errors}':>13} {counters['llm_prompt_tokens_total'] / ok:>12.0f} "
+              f"{counters['llm_output_tokens_total'] / ok:>12.0f} {retried:>8}")
+
+
+if __name__ == "__main__":
+    main()
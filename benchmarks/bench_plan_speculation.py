@@ -0,0 +1,125 @@
+# Wait for the first plan at the end of onboarding, with and without speculative plan generation
+#
+# Chats answer the last goal-setting questions (vision, weaknesses, habits)
+# through process_message, --think-ms apart, against the fake LLM backend and
+# a bot whose every call takes --telegram-ms. Measured is the time from the
+# habits answer to the finished "Plan ready" message, and the model calls
+# spent on plans. user_data lives in memory instead of Supabase.
+#
+# Usage: python benchmarks/bench_plan_speculation.py [--chats 20] [--think-ms 2000] [--telegram-ms 150]
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import os
+import statistics
+import sys
+import time
+import types
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import enhanced_main
+import llm_client
+from circuit_breaker import CircuitBreaker
+from enhanced_main import EnhancedAICoach, Speculator, process_message
+from llm_backend import FakeBackend, set_backend
+
+# model latency is what's measured: identical prompts must reach the model, not the LLM cache
+llm_client.LLM_CACHE_ENABLED = False
+
+USER_DATA = {
+    "user_info": {"name": "Sam", "personality_traits": ["driven"], "communication_style": "direct"},
+    "onboarding": {"phase": "goal_setting", "current_step": "vision_statement", "responses": {}},
+    "goals": {},
+}
+ANSWERS = ["Up at 6, running every day, calm and focused", "I procrastinate and lose focus", "Phone in bed, skipping breakfast"]
+
+
+class MemoryState:
+    def __init__(self):
+        self.rows = {}
+
+    async def fetch(self, chat_id):
+        return copy.deepcopy(self.rows.get(chat_id))
+
+    async def save(self, chat_id, user_data, base=None):
+        self.rows[chat_id] = copy.deepcopy(user_data)
+
+
+class Bot:
+    """Telegram calls that take rtt_s each; records when each chat's plan was delivered"""
+
+    def __init__(self, rtt_s):
+        self.rtt_s = rtt_s
+        self.plan_done = {}
+
+    async def _call(self, chat_id, text=""):
+        await asyncio.sleep(self.rtt_s)
+        if text.strip().startswith("Plan ready"):
+            self.plan_done[chat_id] = time.perf_counter()
+        return types.SimpleNamespace(message_id=1)
+
+    async def send_chat_action(self, chat_id, action):
+        await self._call(chat_id)
+
+    async def send_message(self, chat_id, text):
+        return await self._call(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        return await self._call(chat_id, text)
+
+
+def make_update(bot, chat_id, text):
+    message = types.SimpleNamespace(chat_id=chat_id, text=text)
+    message.reply_text = lambda reply: bot.send_message(chat_id, reply)
+    return types.SimpleNamespace(message=message)
+
+
+async def run(label, steps, chats, think_s, backend, bot_rtt_s):
+    set_backend(backend)
+    state = MemoryState()
+    enhanced_main.get_user_state = lambda: state
+    enhanced_main.PLAN_SPECULATION_AFTER_STEPS = steps
+    enhanced_main.plan_speculator = Speculator()
+    bot = Bot(bot_rtt_s)
+    context = types.SimpleNamespace(bot=bot, bot_data={"coach": EnhancedAICoach(breaker=CircuitBreaker(min_calls=10**9))})
+    habits_sent = {}
+
+    async def chat(chat_id):
+        state.rows[chat_id] = copy.deepcopy(USER_DATA)
+        for i, answer in enumerate(ANSWERS):
+            if i:
+                await asyncio.sleep(think_s)
+            if i == len(ANSWERS) - 1:
+                habits_sent[chat_id] = time.perf_counter()
+            await process_message(make_update(bot, chat_id, answer), context)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(chat(chat_id) for chat_id in range(chats)))
+    waits = [bot.plan_done[c] - habits_sent[c] for c in bot.plan_done]
+    complete = sum(row["onboarding"]["current_step"] == "complete" for row in state.rows.values())
+    print(f"  {label:24} habits answer -> plan p50 {statistics.median(waits) * 1000:6.0f} ms"
+          f"  max {max(waits) * 1000:6.0f} ms  model calls {backend.calls:3}  onboarded {complete}/{chats}"
+          f"  {enhanced_main.plan_speculator.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--think-ms", type=float, default=2000)
+    parser.add_argument("--telegram-ms", type=float, default=150)
+    parser.add_argument("--first-token-ms", type=float, default=600)
+    parser.add_argument("--ms-per-token", type=float, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # "weaknesses" starts nothing (the habits answer is still missing) and must cost no extra model calls
+    modes = (("no speculation", []), ("after habits", ["habits"]), ("after weaknesses + habits", ["weaknesses", "habits"]))
+    for label, steps in modes:
+        backend = FakeBackend(args.first_token_ms, 0.5, args.ms_per_token, 0.0, 0.0, args.seed, True)
+        asyncio.run(run(label, steps, args.chats, args.think_ms / 1000, backend, args.telegram_ms / 1000))
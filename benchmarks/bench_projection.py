@@ -0,0 +1,74 @@
+# Prompt tokens per phase: full json.dumps(user_data, indent=2) vs the per-phase projection
+#
+# Uses a user who has finished onboarding and had a couple of weeks of
+# accountability insights merged into user_info. Token counts are estimates
+# (context_packer.estimate_tokens).
+#
+# Usage: python benchmarks/bench_projection.py [--days 14]
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_packer import projection_report
+
+
+def sample_user_data(days):
+    return {
+        "onboarding": {
+            "phase": "complete",
+            "current_step": "complete",
+            "deep_dive_count": 2,
+            "responses": {
+                "week_highlight": "Finally ran 5k without stopping, and I finished a book I had abandoned twice.",
+                "frustration": "I lose the evenings to my phone and then feel behind the next morning.",
+                "personality_deep_dive": "I like tracking numbers, streaks keep me going, vague goals don't.",
+                "vision_statement": "A year from now I train four times a week and read every night.",
+                "weaknesses": "I overcommit on Mondays and burn out by Wednesday.",
+                "habits": "Late-night scrolling, skipping breakfast.",
+            },
+        },
+        "user_info": {
+            "name": "Sam",
+            "personality_traits": ["analytical", "competitive", "self-critical"],
+            "interests": ["running", "fiction", "cooking"],
+            "communication_style": "direct",
+            "motivation_factors": ["achievement", "growth"],
+            "new_traits": ["responds well to streaks"],
+            "progress_notes": " ".join(f"Day {d}: completed the run, skipped reading." for d in range(days)),
+        },
+        "goals": {
+            "vision_statement": "Train four times a week and read every night.",
+            "weaknesses": "Overcommitting early in the week.",
+            "bad_habits": "Late-night scrolling.",
+        },
+        "daily_plan": {
+            "date": "2026-10-18",
+            "tasks": [
+                {"id": 1, "type": "physical", "title": "20 minute easy run",
+                 "description": "Shoes by the door the night before; run straight after coffee.",
+                 "difficulty": "medium", "personality_fit": "Measurable and streak-friendly."},
+                {"id": 2, "type": "mental", "title": "Read 10 pages",
+                 "description": "Phone charges in the kitchen; book on the pillow.",
+                 "difficulty": "easy", "personality_fit": "Small, countable target."},
+                {"id": 3, "type": "emotional", "title": "Two-line journal",
+                 "description": "One win, one lesson, before bed.",
+                 "difficulty": "easy", "personality_fit": "Turns self-criticism into data."},
+            ],
+            "motivation_message": "Small wins compound.",
+        },
+        "progress_tracking": {"streak_days": days, "completed_tasks": days * 2, "missed_tasks": days},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=14)
+    args = parser.parse_args()
+
+    report = projection_report(sample_user_data(args.days))
+    print(f"{'phase':28} {'full':>6} {'projected':>10} {'saved':>7}")
+    for phase, (full, projected) in report.items():
+        print(f"{phase:28} {full:6d} {projected:10d} {1 - projected / full:7.0%}")
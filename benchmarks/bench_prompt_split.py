@@ -0,0 +1,98 @@
+# Static vs dynamic input per phase after moving fixed instructions into system_instruction
+#
+# Token counts are estimates (context_packer.estimate_tokens). The static part is
+# what explicit context caching could serve from cache; it is only cached once
+# it reaches GEMINI_CONTEXT_CACHE_MIN_TOKENS. The coach phases are then run
+# against an in-process stub transport to exercise the per-phase accounting.
+#
+# Usage: python benchmarks/bench_prompt_split.py [--calls 200]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.ai import generativelanguage as glm
+
+from config import GEMINI_CONTEXT_CACHE_MIN_TOKENS
+from context_packer import estimate_tokens
+
+REPLY = '{"reply_to_user": "Nice work.", "next_action": "wait_for_response", "updated_insights": {}}'
+MESSAGE = "did my workout this morning but skipped reading again"
+USER_DATA = {
+    "onboarding": {"current_step": "complete"},
+    "user_info": {"name": "Sam", "personality_traits": ["analytical"], "interests": ["running", "books"]},
+    "goals": {"vision_statement": "Fit and well read", "bad_habits": "late-night scrolling"},
+    "daily_plan": {"tasks": [{"id": 1, "type": "physical", "title": "20 minute run"}]},
+}
+
+
+class StubGenerativeClient:
+    def generate_content(self, request, **kwargs):
+        return glm.GenerateContentResponse(
+            candidates=[glm.Candidate(content=glm.Content(parts=[glm.Part(text=REPLY)], role="model"))],
+            usage_metadata=glm.GenerateContentResponse.UsageMetadata(
+                prompt_token_count=estimate_tokens(str(request.system_instruction) + str(request.contents))
+            ),
+        )
+
+
+async def run_coach(calls):
+    from enhanced_main import EnhancedAICoach
+
+    coach = EnhancedAICoach()
+    for _ in range(calls):
+        await coach.analyze_personality(MESSAGE, USER_DATA)
+        await coach.create_accountability_response(MESSAGE, USER_DATA)
+        await coach.generate_personalized_plan(USER_DATA)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    import enhanced_main  # configures genai at import
+    import main
+    import scheduler
+    import llm_client
+    from llm_metrics import llm_metrics
+
+    # model latency is what's measured: identical prompts must reach the model, not the LLM cache
+    llm_client.LLM_CACHE_ENABLED = False
+
+    genai.configure(api_key="bench")
+    genai_client._client_manager.clients["generative"] = StubGenerativeClient()
+
+    dynamic = f'User Data: {json.dumps(USER_DATA, indent=2)}\nUser Message: "{MESSAGE}"'
+    phases = [
+        ("analyze_personality", enhanced_main.PERSONALITY_ANALYSIS_INSTRUCTION),
+        ("generate_personalized_plan", enhanced_main.PLAN_GENERATION_INSTRUCTION),
+        ("accountability_response", enhanced_main.ACCOUNTABILITY_INSTRUCTION),
+        ("agent_response", main.GOD_PROMPT),
+        ("morning_check_in", scheduler.MORNING_CHECK_IN_INSTRUCTION),
+        ("evening_reflection", scheduler.EVENING_REFLECTION_INSTRUCTION),
+        ("daily_plan", scheduler.DAILY_PLAN_INSTRUCTION),
+    ]
+    print(f"{'phase':28} {'static':>7} {'dynamic':>8} {'static %':>9}  cacheable (>= {GEMINI_CONTEXT_CACHE_MIN_TOKENS})")
+    for phase, instruction in phases:
+        static_tokens, dynamic_tokens = estimate_tokens(instruction), estimate_tokens(dynamic)
+        share = static_tokens / (static_tokens + dynamic_tokens)
+        cacheable = "yes" if static_tokens >= GEMINI_CONTEXT_CACHE_MIN_TOKENS else "no"
+        print(f"{phase:28} {static_tokens:7d} {dynamic_tokens:8d} {share:9.0%}  {cacheable}")
+
+    asyncio.run(run_coach(args.calls))
+    print(f"\n{args.calls} calls per coach phase, stub transport")
+    for phase, stats in llm_metrics.to_dict()["phases"].items():
+        latency = stats["histograms"]["llm_call_latency_seconds"]
+        calls = latency["count"]
+        print(f"  {phase:28} {latency['sum'] * 1000 / calls:7.3f} ms"
+              f"  {stats['counters']['llm_prompt_tokens_total'] / calls:6.0f} prompt tokens"
+              f"  {stats['counters']['llm_cached_tokens_total'] / calls:6.0f} cached")
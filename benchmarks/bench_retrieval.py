@@ -0,0 +1,113 @@
+# Per-message retrieval cost: legacy directory scan vs the in-process BM25 chunk index
+#
+# Usage: python benchmarks/bench_retrieval.py [--scale 1000] [--repeat 20]
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import KNOWLEDGE_DIR, RAG_MAX_CONTEXT_CHARS, RAG_TOP_K
+from knowledge_index import KnowledgeIndex, pack_chunks
+
+SAMPLE_MESSAGES = [
+    "did my workout this morning but skipped reading again",
+    "I keep procrastinating on my habits, motivation is low",
+    "feeling stuck, my mindset is negative and I doubt myself",
+    "what small step should I take to build a better routine",
+]
+
+
+def legacy_retrieve_context(query, knowledge_dir):
+    """The original os.walk-per-call retriever, kept here as the baseline"""
+    ctx_chunks = []
+    for root, _, files in os.walk(knowledge_dir):
+        for name in files:
+            if not name.lower().endswith((".txt", ".md")):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                text = f.read()
+            keywords = [w for w in re.findall(r"[a-zA-Z]{4,}", query.lower())]
+            score = sum(1 for k in keywords if k in text.lower())
+            if score > 0:
+                ctx_chunks.append(f"Source: {name}\n{text[: RAG_MAX_CONTEXT_CHARS]}")
+    return "\n\n".join(ctx_chunks)[: RAG_MAX_CONTEXT_CHARS]
+
+
+def indexed_retrieve_context(query, index):
+    return pack_chunks(index.search(query, top_k=RAG_TOP_K), RAG_MAX_CONTEXT_CHARS)
+
+
+def make_synthetic_corpus(scale):
+    """Copy every knowledge file `scale` times into a temp dir"""
+    target = tempfile.mkdtemp(prefix="knowledge_x%d_" % scale)
+    for name in os.listdir(KNOWLEDGE_DIR):
+        src = os.path.join(KNOWLEDGE_DIR, name)
+        if not os.path.isfile(src):
+            continue
+        stem, ext = os.path.splitext(name)
+        for i in range(scale):
+            shutil.copyfile(src, os.path.join(target, f"{stem}_{i:04d}{ext}"))
+    return target
+
+
+def time_per_message(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in SAMPLE_MESSAGES:
+            fn(message)
+    return (time.perf_counter() - start) / (repeat * len(SAMPLE_MESSAGES))
+
+
+def run(label, knowledge_dir, repeat):
+    build_start = time.perf_counter()
+    index = KnowledgeIndex(knowledge_dir)
+    build_s = time.perf_counter() - build_start
+
+    legacy_chars = sum(len(legacy_retrieve_context(m, knowledge_dir)) for m in SAMPLE_MESSAGES)
+    indexed_chars = sum(len(indexed_retrieve_context(m, index)) for m in SAMPLE_MESSAGES)
+
+    legacy = time_per_message(lambda m: legacy_retrieve_context(m, knowledge_dir), repeat)
+    indexed = time_per_message(lambda m: indexed_retrieve_context(m, index), repeat)
+    print(f"{label}: {index.file_count} files / {len(index.chunks)} chunks, index build {build_s * 1000:.1f} ms")
+    print(f"  legacy scan   {legacy * 1000:10.3f} ms/message  {legacy_chars / len(SAMPLE_MESSAGES):6.0f} context chars")
+    print(f"  indexed       {indexed * 1000:10.3f} ms/message  {indexed_chars / len(SAMPLE_MESSAGES):6.0f} context chars")
+
+    # Incremental maintenance: no-op check, one edited file, full rebuild
+    noop_start = time.perf_counter()
+    index.refresh()
+    noop_s = time.perf_counter() - noop_start
+    edited = sorted(os.path.join(knowledge_dir, n) for n in os.listdir(knowledge_dir) if n.endswith(".md"))[0]
+    with open(edited, "a", encoding="utf-8") as f:
+        f.write("\n- Procrastination: shrink the task until it takes two minutes\n")
+    edit_start = time.perf_counter()
+    index.refresh()
+    edit_s = time.perf_counter() - edit_start
+    rebuild_start = time.perf_counter()
+    index.rebuild()
+    rebuild_s = time.perf_counter() - rebuild_start
+    print(f"  refresh: unchanged {noop_s * 1000:.1f} ms, one file edited {edit_s * 1000:.1f} ms, full rebuild {rebuild_s * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    copy = make_synthetic_corpus(1)
+    try:
+        run("knowledge/", copy, args.repeat)
+    finally:
+        shutil.rmtree(copy, ignore_errors=True)
+    synthetic = make_synthetic_corpus(args.scale)
+    try:
+        run(f"synthetic x{args.scale}", synthetic, max(1, args.repeat // 10))
+    finally:
+        shutil.rmtree(synthetic, ignore_errors=True)
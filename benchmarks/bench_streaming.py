@@ -0,0 +1,137 @@
+# Time to first visible text: whole-reply delivery vs streaming into an edited Telegram message
+#
+# A fake model emits the reply in chunks at a fixed token rate and a fake bot
+# records when text becomes visible and how many edits were made, so the
+# numbers isolate the delivery strategy (no network).
+#
+# Usage: python benchmarks/bench_streaming.py [--chunk-ms 60] [--chunk-chars 24] [--interval 1.0]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_client
+from enhanced_main import EnhancedAICoach, handle_daily_execution, handle_plan_creation, send_reply
+from telegram_stream import ProgressiveReply
+
+# model latency is what's measured: identical prompts must reach the model, not the LLM cache
+llm_client.LLM_CACHE_ENABLED = False
+
+ACCOUNTABILITY_REPLY = json.dumps({
+    "reply_to_user": "Solid run this morning, that is the streak doing its job. Reading slipped again, so shrink it: "
+                     "two pages with the phone in the kitchen before you sit down. What time tonight works?",
+    "next_action": "wait_for_response",
+    "updated_insights": {"new_traits": ["morning-driven"], "progress_notes": "Runs consistently, reading lags."},
+})
+PLAN_REPLY = json.dumps({"daily_plan": {
+    "date": "2026-10-18",
+    "tasks": [
+        {"id": 1, "type": "physical", "title": "20 minute easy run", "description": "Shoes by the door tonight.",
+         "difficulty": "medium", "personality_fit": "Measurable, streak-friendly."},
+        {"id": 2, "type": "mental", "title": "Read 10 pages", "description": "Phone charges in the kitchen.",
+         "difficulty": "easy", "personality_fit": "Small countable target."},
+        {"id": 3, "type": "emotional", "title": "Two-line journal", "description": "One win, one lesson.",
+         "difficulty": "easy", "personality_fit": "Turns self-criticism into data."},
+    ],
+    "motivation_message": "Small wins compound.",
+}})
+USER_DATA = {"onboarding": {"current_step": "complete"}, "user_info": {"name": "Sam"}, "goals": {}, "daily_plan": {}}
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeStream:
+    def __init__(self, text, chunk_chars, chunk_s, stream):
+        self.text = text
+        self.usage_metadata = None
+        self._chunks = [text[i : i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        self._chunk_s = chunk_s
+        if not stream:
+            time.sleep(chunk_s * len(self._chunks))
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(self._chunk_s)
+            yield Chunk(chunk)
+
+
+class FakeModel:
+    def __init__(self, text, chunk_chars, chunk_s):
+        self.text = text
+        self.chunk_chars = chunk_chars
+        self.chunk_s = chunk_s
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        return FakeStream(self.text, self.chunk_chars, self.chunk_s, stream)
+
+
+class FakeMessage:
+    message_id = 1
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def reply_text(self, text):
+        return await self.bot.send_message(chat_id=1, text=text)
+
+
+class FakeUpdate:
+    def __init__(self, bot):
+        self.message = FakeMessage(bot)
+
+
+class FakeBot:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_visible = None
+        self.sends = self.edits = 0
+
+    async def send_message(self, chat_id, text):
+        self.sends += 1
+        if self.first_visible is None:
+            self.first_visible = time.monotonic() - self.started
+        return FakeMessage(self)
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.edits += 1
+
+
+async def deliver(kind, streamed, args):
+    bot = FakeBot()
+    reply = ProgressiveReply(bot, 1, kind, started=bot.started, interval=args.interval) if streamed else None
+    text = ACCOUNTABILITY_REPLY if kind == "reply" else PLAN_REPLY
+    coach = EnhancedAICoach(FakeModel(text, args.chunk_chars, args.chunk_ms / 1000))
+    if kind == "reply":
+        response = await handle_daily_execution("ran, skipped reading", dict(USER_DATA), coach, reply)
+    else:
+        response = await handle_plan_creation({**USER_DATA, "onboarding": {}}, coach, reply)
+    await send_reply(FakeUpdate(bot), reply, response["reply_to_user"])
+    return bot, time.monotonic() - bot.started
+
+
+async def main(args):
+    print(f"fake model: {args.chunk_chars} chars every {args.chunk_ms} ms, edit interval {args.interval} s")
+    for kind in ("reply", "plan"):
+        for streamed in (False, True):
+            bot, total = await deliver(kind, streamed, args)
+            label = "streamed" if streamed else "whole"
+            print(f"  {kind:5} {label:8}  first visible {bot.first_visible * 1000:7.0f} ms"
+                  f"  complete {total * 1000:7.0f} ms  sends {bot.sends}  edits {bot.edits}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk-ms", type=int, default=60)
+    parser.add_argument("--chunk-chars", type=int, default=24)
+    parser.add_argument("--interval", type=float, default=1.0)
+    asyncio.run(main(parser.parse_args()))
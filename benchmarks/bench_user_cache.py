@@ -0,0 +1,71 @@
+# DB requests and per-message DB time for chatty users, with and without the write-behind user state cache
+#
+# Runs against the PostgREST stand-in of bench_user_store.py. Every chat sends
+# --messages messages one after another; each is fetch -> model (--llm-ms) ->
+# save, as in handle_message. The write-behind store flushes every
+# --flush-ms, and is closed (final flush) before the rows are compared with
+# what each chat saved last.
+#
+# Usage: python benchmarks/bench_user_cache.py [--chats 50] [--messages 10] [--rtt-ms 20]
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import warnings
+
+warnings.simplefilter("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_user_store import KEY, PostgrestStandIn, start_stand_in
+from user_store import UserStore, WriteBehindUserStore
+
+
+async def run(label, url, chats, messages, llm_s, flush_s):
+    store = UserStore(url, KEY)
+    if label == "write-behind":
+        store = WriteBehindUserStore(store, flush_seconds=flush_s)
+        flusher = asyncio.ensure_future(store.run_flusher())
+    PostgrestStandIn.rows.clear()
+    PostgrestStandIn.requests = 0
+    latencies = []
+
+    async def chat(chat_id):
+        for m in range(messages):
+            start = time.perf_counter()
+            user_data = await store.fetch(chat_id) or {"messages": 0}
+            fetched = time.perf_counter()
+            await asyncio.sleep(llm_s)
+            user_data["messages"] += 1
+            saved = time.perf_counter()
+            await store.save(chat_id, user_data)
+            latencies.append(fetched - start + time.perf_counter() - saved)
+
+    await asyncio.gather(*(chat(chat_id) for chat_id in range(chats)))
+    if label == "write-behind":
+        flusher.cancel()
+        stats = store.stats()
+    await store.close()
+    correct = sum(row["user_data"]["messages"] == messages for row in PostgrestStandIn.rows.values())
+    print(f"  {label:13} DB requests {PostgrestStandIn.requests:5}  DB time per message"
+          f" p50 {statistics.median(latencies) * 1000:6.1f} ms  max {max(latencies) * 1000:6.1f} ms"
+          f"  rows up to date after close {correct}/{chats}")
+    if label == "write-behind":
+        print(f"  cache: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--rtt-ms", type=float, default=20)
+    parser.add_argument("--llm-ms", type=float, default=100)
+    parser.add_argument("--flush-ms", type=float, default=500)
+    args = parser.parse_args()
+
+    server, url = start_stand_in(args.rtt_ms, 0)
+    for label in ("store", "write-behind"):
+        asyncio.run(run(label, url, args.chats, args.messages, args.llm_ms / 1000, args.flush_ms / 1000))
+    server.shutdown()
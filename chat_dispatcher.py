@@ -0,0 +1,120 @@
+# Per-chat ordering and burst merging for concurrently processed Telegram updates
+
+import asyncio
+import collections
+import contextlib
+import time
+
+from config import COALESCE_MAX_WAIT_SECONDS, COALESCE_WINDOW_SECONDS
+
+
+class ChatDispatcher:
+    """Runs work for one chat strictly in arrival order while different chats run in parallel.
+
+    handle_message reads user_data, waits on the model and writes the whole
+    blob back; two overlapping turns of one chat would lose one update. Each
+    chat gets a FIFO lock for as long as it has a turn running or waiting,
+    and the lock is dropped as soon as the chat is idle, so memory follows
+    the number of busy chats rather than of all chats ever seen.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._waiting = collections.Counter()
+        self.turns = 0
+        self.queued_turns = 0
+        self.max_queue_depth = 0
+        self.wait_s = 0.0
+
+    @contextlib.asynccontextmanager
+    async def turn(self, chat_id):
+        """async with dispatcher.turn(chat_id): ... runs after every earlier turn of the chat"""
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._waiting[chat_id] += 1
+        depth = self._waiting[chat_id]
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self.queued_turns += depth > 1
+        start = time.perf_counter()
+        try:
+            async with lock:
+                self.wait_s += time.perf_counter() - start
+                self.turns += 1
+                yield
+        finally:
+            self._waiting[chat_id] -= 1
+            if not self._waiting[chat_id]:
+                # idle: nobody holds or waits for the lock
+                del self._waiting[chat_id]
+                del self._locks[chat_id]
+
+    def stats(self):
+        return {
+            "active_chats": len(self._locks),
+            "turns": self.turns,
+            "queued_turns": self.queued_turns,
+            "max_queue_depth": self.max_queue_depth,
+            "mean_wait_ms": self.wait_s * 1000 / self.turns if self.turns else 0.0,
+        }
+
+
+class MessageCoalescer:
+    """Merges a burst of messages from one chat into a single turn.
+
+    The first message of a burst waits until the chat has been quiet for
+    window_seconds (at most max_wait_seconds). Messages arriving meanwhile,
+    or while the burst waits for its ChatDispatcher turn, join it instead of
+    starting turns of their own. A caller cancelled between add() and take()
+    must release() the burst, whose joined messages nobody else will answer.
+    """
+
+    def __init__(self, window_seconds=COALESCE_WINDOW_SECONDS, max_wait_seconds=COALESCE_MAX_WAIT_SECONDS):
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self._bursts = {}  # chat_id -> (items, asyncio.Event set on each new item, monotonic open time)
+        self.bursts = 0
+        self.messages = 0
+
+    async def add(self, chat_id, item):
+        """True when item opened a burst (the caller runs the turn, see release()), False when it joined one"""
+        self.messages += 1
+        burst = self._bursts.get(chat_id)
+        if burst is not None:
+            burst[0].append(item)
+            burst[1].set()
+            return False
+        arrived = asyncio.Event()
+        self._bursts[chat_id] = ([item], arrived, time.monotonic())
+        self.bursts += 1
+        deadline = time.monotonic() + self.max_wait_seconds
+        while self.window_seconds > 0:
+            arrived.clear()
+            timeout = min(self.window_seconds, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            try:
+                await asyncio.wait_for(arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                break  # quiet for a whole window
+        return True
+
+    def take(self, chat_id):
+        """(items, opened_at): every item of the chat's burst, oldest first, and the
+        time.monotonic() its first item arrived; later messages start a new burst"""
+        items, _, opened_at = self._bursts.pop(chat_id)
+        return items, opened_at
+
+    def release(self, chat_id, item):
+        """take() for the burst item opened if it was never taken (its turn was cancelled), else None"""
+        burst = self._bursts.get(chat_id)
+        if burst is None or burst[0][0] is not item:
+            return None
+        return self.take(chat_id)
+
+    def stats(self):
+        return {
+            "messages": self.messages,
+            "turns": self.bursts,
+            "merged_messages": self.messages - self.bursts,
+        }
@@ -0,0 +1,109 @@
+# Circuit breaker for model calls: stop waiting on a degraded provider, probe until it recovers
+
+import collections
+import threading
+import time
+
+from config import (
+    BREAKER_FAILURE_RATE,
+    BREAKER_HALF_OPEN_PROBES,
+    BREAKER_MIN_CALLS,
+    BREAKER_OPEN_SECONDS,
+    BREAKER_SLOW_CALL_SECONDS,
+    BREAKER_WINDOW,
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over the outcomes of the last `window` calls.
+
+    A call fails when it errors (or returns nothing usable) or takes longer
+    than slow_call_seconds. Once at least min_calls outcomes are in the window
+    and the failed share reaches failure_rate, the breaker opens: allow()
+    returns False and callers answer without the provider. After open_seconds
+    up to half_open_probes calls are let through; a successful probe closes
+    the breaker, a failed one opens it for another open_seconds.
+    """
+
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_rate=BREAKER_FAILURE_RATE,
+                 slow_call_seconds=BREAKER_SLOW_CALL_SECONDS, open_seconds=BREAKER_OPEN_SECONDS,
+                 half_open_probes=BREAKER_HALF_OPEN_PROBES, clock=time.monotonic):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = collections.deque()  # start times of probes in flight
+        self.opens = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self.clock() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self.clock()
+        self._probes.clear()
+        self.opens += 1
+
+    def allow(self):
+        """Whether a call may go to the provider now"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = self.clock()
+            if self._state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self._state = HALF_OPEN
+            # a probe that never reported back (its caller failed first) frees its slot after open_seconds
+            while self._probes and now - self._probes[0] >= self.open_seconds:
+                self._probes.popleft()
+            if len(self._probes) < self.half_open_probes:
+                self._probes.append(now)
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok, latency_s):
+        """Report a call's outcome; slow successes count as failures"""
+        failed = not ok or latency_s > self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if self._probes:
+                    self._probes.popleft()
+                if failed:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self._state == OPEN:
+                return  # a call admitted before the breaker opened
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and sum(self._outcomes) >= self.failure_rate * len(self._outcomes):
+                self._open()
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "window_failure_rate": sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0,
+                "opens": self.opens,
+                "rejected": self.rejected,
+            }
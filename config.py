@@ -5,6 +5,41 @@ SYSTEM_NAME = "Catalyst"
 SYSTEM_VERSION = "2.0"
 MAX_API_RETRIES = 3
 API_TIMEOUT = 30
+# Gemini calls run on a bounded thread pool so async handlers never block the
+# event loop; this caps how many calls are in flight per process
+LLM_MAX_CONCURRENT_CALLS = 16
+# Telegram updates handled at once per process; messages of one chat still run
+# one after another (chat_dispatcher.py)
+MAX_CONCURRENT_UPDATES = 256
+# Messages a chat sends in a burst are answered together: a turn starts once the
+# chat has been quiet for COALESCE_WINDOW_SECONDS (at most COALESCE_MAX_WAIT_SECONDS
+# after its first message). Messages that arrive while the chat's previous turn
+# is still running join the next turn either way; 0 starts turns without waiting,
+# which webhook mode always does. 150 ms is the window bench_coalescing.py measured
+COALESCE_WINDOW_SECONDS = 0.15
+COALESCE_MAX_WAIT_SECONDS = 0.6
+# One shared model (and gRPC channel) per process, see llm_client.get_model()
+GEMINI_MODEL_NAME = "gemini-1.5-flash"
+# Explicit context caching of each phase's static system instruction. The API
+# rejects caches below its minimum size (32k tokens for 1.5 models) and needs a
+# versioned model name, so smaller instructions just go out uncached
+GEMINI_CONTEXT_CACHE_ENABLED = True
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = 32768
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = 3600
+# Model backend (llm_backend.py): "gemini", or "fake" for offline load tests
+# without quota or network; the fake is tuned under LLM BACKEND CONFIGURATION
+LLM_BACKEND = "gemini"
+# Supabase is reached through one pooled async HTTP client per process
+# (user_store.py); idle connections are kept open for reuse by later messages
+DB_MAX_CONNECTIONS = 20
+DB_KEEPALIVE_SECONDS = 120
+DB_TIMEOUT_SECONDS = 10
+# Changed user_data is written as a JSON patch through the patch_user_data RPC
+# (json_patch.PATCH_USER_DATA_SQL) when the patch is at most DELTA_MAX_RATIO of
+# the full document; otherwise, and without the RPC installed, the whole
+# document is upserted
+DELTA_PERSISTENCE_ENABLED = True
+DELTA_MAX_RATIO = 0.5
 MAX_DEEP_DIVE_QUESTIONS = 3
 MAX_QUESTIONS_PER_REPLY = 1
 
@@ -116,6 +151,34 @@ ONBOARDING_STEPS = {
     }
 }
 
+# --- PLAN SPECULATION CONFIGURATION ---
+# The first plan is generated in the background as soon as the user answers one
+# of these onboarding steps, while the reply to that answer is still being sent.
+# It is used only if the plan inputs (PHASE_FIELDS["generate_personalized_plan"])
+# are unchanged when the plan is due, otherwise it is discarded and regenerated.
+# The habits answer is the last plan input and the plan follows in the same turn,
+# so this saves about one Telegram round trip; earlier steps start nothing, since
+# their plan would always be stale
+PLAN_SPECULATION_AFTER_STEPS = ["habits"]
+# Unclaimed speculative plans (e.g. the user never answered) are dropped after this
+PLAN_SPECULATION_TTL_SECONDS = 900
+
+# --- USER STATE CACHE CONFIGURATION ---
+# The bot keeps hot user_data in memory (user_store.WriteBehindUserStore): reads
+# are served from the LRU and writes are flushed to Supabase in batches
+USER_CACHE_ENABLED = True
+USER_CACHE_SIZE = 10000
+# Cached entries are re-read after this long, picking up the scheduler's writes.
+# Flushes re-read their rows first and merge into what the scheduler wrote
+# meanwhile, so a stale entry never overwrites it
+USER_CACHE_TTL_SECONDS = 300
+# Crash-safety limits: unsaved updates are at most USER_CACHE_FLUSH_SECONDS old,
+# and a flush starts at once when USER_CACHE_MAX_DIRTY chats have unsaved updates
+USER_CACHE_FLUSH_SECONDS = 5
+USER_CACHE_MAX_DIRTY = 500
+# Rows per multi-row upsert
+USER_CACHE_BATCH_SIZE = 100
+
 # --- DAILY EXECUTION CONFIGURATION ---
 DAILY_CHECK_IN_TIMES = {
     "morning": "09:00",
@@ -125,8 +188,135 @@ DAILY_CHECK_IN_TIMES = {
 # --- RAG / KNOWLEDGE BASE CONFIGURATION ---
 # If true, prompts will be augmented with retrieved context from local knowledge files
 RAG_ENABLED = True
+# Retrieval backend: "bm25" (pure Python inverted index) or "tfidf" (NumPy matrix,
+# vectorized batch queries for the scheduler; falls back to bm25 without numpy)
+RAG_BACKEND = "bm25"
 KNOWLEDGE_DIR = "knowledge"
 RAG_MAX_CONTEXT_CHARS = 1400
+# Knowledge files are split into ## sections / bullets and ranked with BM25;
+# at most this many whole chunks are packed into RAG_MAX_CONTEXT_CHARS
+RAG_TOP_K = 4
+# Seconds between mtime/size checks of KNOWLEDGE_DIR; the first lookup after this
+# interval re-indexes changed files on a background thread (0 disables; use
+# rebuild_knowledge_index())
+KNOWLEDGE_REFRESH_SECONDS = 30
+# Prebuilt index from `python knowledge_artifact.py`; when present and matching the
+# knowledge files it is mmapped at startup instead of parsing the markdown
+KNOWLEDGE_ARTIFACT = "knowledge/knowledge.idx"
+# LRU/TTL cache of retrieval results keyed on the sorted query keywords; flushed
+# whenever the knowledge index changes (0 disables)
+RAG_CACHE_SIZE = 1024
+RAG_CACHE_TTL_SECONDS = 3600
+
+# --- PROMPT BUDGET CONFIGURATION ---
+# Approximate total input tokens per coach call (instructions + user message +
+# packed context). Whole knowledge chunks and user_data fields are added by
+# priority until the budget is full (see context_packer.py)
+PROMPT_TOKEN_BUDGETS = {
+    "analyze_personality": 1400,
+    "accountability_response": 1600,
+}
+
+# --- STRUCTURED OUTPUT CONFIGURATION ---
+# JSON calls ask for application/json against a response schema and are
+# retried (up to MAX_API_RETRIES) with jittered exponential backoff, but only
+# while the message's API_TIMEOUT deadline leaves time for another attempt
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 4
+# Output cap per call; replies are short, so this only stops runaway generations
+MAX_OUTPUT_TOKENS = {
+    "analyze_personality": 512,
+    "generate_personalized_plan": 1024,
+    "accountability_response": 512,
+    "morning_check_in": 256,
+    "evening_reflection": 256,
+    "daily_plan": 1024,
+}
+
+# --- LLM RESPONSE CACHE CONFIGURATION ---
+# Replies of these calls are cached by sha256(model, generation config, prompt):
+# byte-identical requests (re-sent plans, scheduler reruns) skip the API
+LLM_CACHE_ENABLED = True
+LLM_CACHED_PHASES = ["generate_personalized_plan", "daily_plan", "morning_check_in", "evening_reflection"]
+LLM_CACHE_SIZE = 512
+LLM_CACHE_TTL_SECONDS = 3600
+# Optional cache shared by all processes / instances in front of the API:
+# None or "redis" (uses REDIS_URL); the in-process cache is always consulted first
+LLM_CACHE_SHARED_BACKEND = None
+
+# --- REQUEST HEDGING CONFIGURATION ---
+# For these calls a duplicate request is sent when the first one is slower than
+# HEDGE_PERCENTILE of the last HEDGE_WINDOW latencies; the first good reply wins
+HEDGE_ENABLED = True
+HEDGED_PHASES = ["analyze_personality", "accountability_response"]
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 200
+# No hedging until this many latencies have been seen for the phase
+HEDGE_MIN_SAMPLES = 20
+# At most this share of the last HEDGE_WINDOW calls may send a duplicate,
+# which bounds the extra quota spent on hedges
+HEDGE_MAX_RATE = 0.05
+
+# --- CIRCUIT BREAKER CONFIGURATION ---
+# Coach calls that fail or take longer than BREAKER_SLOW_CALL_SECONDS count as
+# failures. At BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls (and at
+# least BREAKER_MIN_CALLS), replies come from RESPONSE_TEMPLATES /
+# ERROR_MESSAGES for BREAKER_OPEN_SECONDS, then BREAKER_HALF_OPEN_PROBES
+# calls test whether the model has recovered
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 10
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_SLOW_CALL_SECONDS = 10
+BREAKER_OPEN_SECONDS = 30
+BREAKER_HALF_OPEN_PROBES = 1
+
+# --- WEBHOOK CONFIGURATION ---
+# Webhook mode (the ASGI app in enhanced_main.py, served from api/ on Vercel).
+# Vercel stops the function after functions.maxDuration in vercel.json; keep
+# WEBHOOK_MAX_DURATION_SECONDS equal to it. Processing of an update is cut off
+# WEBHOOK_SHUTDOWN_MARGIN_SECONDS earlier, so the function ends on its own terms
+WEBHOOK_MAX_DURATION_SECONDS = 60
+WEBHOOK_SHUTDOWN_MARGIN_SECONDS = 10
+WEBHOOK_MAX_PROCESSING_SECONDS = WEBHOOK_MAX_DURATION_SECONDS - WEBHOOK_SHUTDOWN_MARGIN_SECONDS
+# Telegram redelivers an update it got no timely 200 for; the update_ids a process
+# has seen are remembered (an LRU of this many) and repeats are skipped
+WEBHOOK_SEEN_UPDATES = 1000
+# Parallel webhook requests Telegram may open (1-100), see set_webhook()
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# --- STREAMING CONFIGURATION ---
+# Stream accountability replies and new plans into Telegram: send a first
+# message as soon as there is something to show, then edit it as text arrives
+STREAMING_ENABLED = True
+# Telegram starts flood-limiting at about one edit per second per chat
+STREAM_EDIT_INTERVAL_SECONDS = 1.0
+# Wait for at least this much reply text before the first message goes out
+STREAM_MIN_FIRST_CHARS = 12
+
+# --- LLM METRICS CONFIGURATION ---
+# Every model call is recorded with its phase, latency, retry number and token
+# usage; the histograms cover the last LLM_METRICS_WINDOW_SECONDS
+LLM_METRICS_WINDOW_SECONDS = 3600
+# Written every LLM_METRICS_DUMP_SECONDS: JSON for *.json, Prometheus text
+# format otherwise (e.g. for the node_exporter textfile collector)
+LLM_METRICS_FILE = "metrics/llm_metrics.prom"
+LLM_METRICS_DUMP_SECONDS = 60
+
+# --- LLM BACKEND CONFIGURATION ---
+# The fake backend (LLM_BACKEND = "fake") answers with schema-valid JSON after
+# a lognormal time to first token (median FAKE_LLM_FIRST_TOKEN_MS, shape
+# FAKE_LLM_FIRST_TOKEN_SIGMA) plus FAKE_LLM_MS_PER_TOKEN per output token
+FAKE_LLM_FIRST_TOKEN_MS = 600
+FAKE_LLM_FIRST_TOKEN_SIGMA = 0.5
+FAKE_LLM_MS_PER_TOKEN = 4
+# Share of calls that fail with a retryable 503, and that return truncated JSON
+FAKE_LLM_ERROR_RATE = 0.0
+FAKE_LLM_MALFORMED_RATE = 0.0
+# Seed of the fake's RNG; the same seed and call order give the same run
+FAKE_LLM_SEED = 0
+# False runs fake calls on llm_client's thread pool like Gemini's (same
+# backpressure); True awaits the async path instead
+FAKE_LLM_NATIVE_ASYNC = False
 
 # --- CONVERSATION SILENCE POLICY ---
 # If the user sends low-content acknowledgements (e.g., "ok", "thanks"),
@@ -0,0 +1,232 @@
+# Token-budget-aware packing of prompt context: retrieved knowledge chunks + user state
+
+import json
+
+from knowledge_index import format_chunk
+
+# Rough Gemini tokenizer ratio for English text and JSON; good enough to keep
+# prompt size bounded without a network round trip to count_tokens
+CHARS_PER_TOKEN = 4
+
+# user_data fields each call needs, in the order it values them. Fields listed
+# as "core" go in before any knowledge chunk; "extra" fields only fill what the
+# chunks leave. Anything not listed (full onboarding history, insights merged
+# into user_info) never reaches the prompt.
+PHASE_FIELDS = {
+    "analyze_personality": {
+        "core": [
+            "onboarding.current_step",
+            "user_info.name",
+            "user_info.personality_traits",
+            "user_info.interests",
+            "user_info.communication_style",
+        ],
+        "extra": [
+            "user_info.motivation_factors",
+            "onboarding.responses",
+            "onboarding.deep_dive_count",
+        ],
+    },
+    "generate_personalized_plan": {
+        "core": [
+            "user_info.name",
+            "user_info.personality_traits",
+            "user_info.interests",
+            "user_info.communication_style",
+            "user_info.motivation_factors",
+            "goals",
+        ],
+        "extra": [
+            "onboarding.responses",
+        ],
+    },
+    "accountability_response": {
+        "core": [
+            "daily_plan",
+            "goals",
+            "user_info.communication_style",
+            "user_info.name",
+        ],
+        "extra": [
+            "user_info.personality_traits",
+            "user_info.motivation_factors",
+            "progress_tracking",
+            "user_info.progress_notes",
+            "user_info.interests",
+        ],
+    },
+    "morning_check_in": {
+        "core": [
+            "user_info.name",
+            "user_info.communication_style",
+            "daily_plan",
+        ],
+        "extra": [
+            "user_info.personality_traits",
+            "goals.vision_statement",
+        ],
+    },
+    "evening_reflection": {
+        "core": [
+            "user_info.name",
+            "user_info.communication_style",
+            "daily_plan",
+        ],
+        "extra": [
+            "progress_tracking",
+            "goals.vision_statement",
+        ],
+    },
+    "daily_plan": {
+        "core": [
+            "user_info.name",
+            "user_info.personality_traits",
+            "user_info.interests",
+            "user_info.communication_style",
+            "goals",
+            "daily_plan",
+        ],
+        "extra": [
+            "user_info.motivation_factors",
+            "progress_tracking",
+        ],
+    },
+}
+
+# Only these keys of each item are kept for lists of dicts (the plan's tasks:
+# descriptions and personality_fit notes are for the user, not the next prompt)
+LIST_ITEM_FIELDS = {
+    "tasks": ("id", "type", "title", "difficulty"),
+}
+
+# Shorter, still self-explanatory keys for the JSON that goes into prompts
+KEY_ALIASES = {
+    "onboarding": "onb",
+    "current_step": "step",
+    "deep_dive_count": "dives",
+    "user_info": "user",
+    "personality_traits": "traits",
+    "communication_style": "style",
+    "motivation_factors": "motivators",
+    "progress_notes": "notes",
+    "vision_statement": "vision",
+    "weaknesses": "weak",
+    "bad_habits": "habits",
+    "daily_plan": "plan",
+    "motivation_message": "motivation",
+    "progress_tracking": "progress",
+}
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _lookup(data, path):
+    node = data
+    for key in path.split("."):
+        if not isinstance(node, dict) or key not in node:
+            return False, None
+        node = node[key]
+    return True, node
+
+
+def _assign(target, path, value):
+    keys = [KEY_ALIASES.get(key, key) for key in path.split(".")]
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    target[keys[-1]] = value
+
+
+def shorten(value):
+    """value with aliased keys, empty entries dropped and list items cut to LIST_ITEM_FIELDS"""
+    if isinstance(value, dict):
+        shortened = {}
+        for key, item in value.items():
+            if isinstance(item, list) and key in LIST_ITEM_FIELDS:
+                keep = LIST_ITEM_FIELDS[key]
+                item = [{k: v for k, v in entry.items() if k in keep} if isinstance(entry, dict) else entry
+                        for entry in item]
+            item = shorten(item)
+            if item not in (None, "", [], {}):
+                shortened[KEY_ALIASES.get(key, key)] = item
+        return shortened
+    if isinstance(value, list):
+        return [shorten(item) for item in value]
+    return value
+
+
+def _projected_field(user_data, path):
+    """(alias, shortened value) of one user_data field, or None if it is missing or empty"""
+    found, value = _lookup(user_data, path)
+    if not found:
+        return None
+    key = path.rsplit(".", 1)[-1]
+    return next(iter(shorten({key: value}).items()), None)
+
+
+def project_user_data(phase, user_data):
+    """Only the user_data fields phase declares in PHASE_FIELDS, with shortened keys"""
+    fields = PHASE_FIELDS[phase]
+    projected = {}
+    for path in fields["core"] + fields["extra"]:
+        field = _projected_field(user_data or {}, path)
+        if field:
+            _assign(projected, path, field[1])
+    return projected
+
+
+def projected_json(phase, user_data):
+    """Minified JSON of project_user_data(), for prompts that aren't budget-packed"""
+    return compact_json(project_user_data(phase, user_data))
+
+
+def projection_report(user_data, phases=None):
+    """{phase: (tokens of the full indented dump, tokens of the projection)}"""
+    full = estimate_tokens(json.dumps(user_data, indent=2))
+    return {
+        phase: (full, estimate_tokens(projected_json(phase, user_data)))
+        for phase in (phases or PHASE_FIELDS)
+    }
+
+
+def pack_context(phase, user_data, ranked_chunks, budget_tokens, reserved_text=""):
+    """Fill budget_tokens greedily with whole user_data fields and whole ranked chunks.
+
+    reserved_text is the rest of the prompt (instructions, user message) and is
+    charged against the budget first. Returns (user_data_json, rag_context,
+    estimated_prompt_tokens).
+    """
+    fields = PHASE_FIELDS[phase]
+    user_data = user_data or {}
+    candidates = (
+        [("field", path) for path in fields["core"]]
+        + [("chunk", chunk) for chunk, _ in ranked_chunks]
+        + [("field", path) for path in fields["extra"]]
+    )
+
+    used = estimate_tokens(reserved_text) + estimate_tokens("{}")
+    state = {}
+    blocks = []
+    for kind, item in candidates:
+        if kind == "field":
+            field = _projected_field(user_data, item)
+            if not field:
+                continue
+            alias, value = field
+            cost = estimate_tokens(f'"{alias}":{compact_json(value)},')
+        else:
+            block = format_chunk(item)
+            cost = estimate_tokens(block + "\n\n")
+        if used + cost > budget_tokens:
+            continue
+        used += cost
+        if kind == "field":
+            _assign(state, item, value)
+        else:
+            blocks.append(block)
+    return compact_json(state), "\n\n".join(blocks), used
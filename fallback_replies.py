@@ -0,0 +1,51 @@
+# Instant replies rendered from config templates while the model is unavailable (circuit breaker open)
+
+import re
+from datetime import datetime
+
+from config import ERROR_MESSAGES, RESPONSE_TEMPLATES
+
+MISSED_PHRASES = ("didn't", "didnt", "did not", "skipped", "missed", "couldn't", "couldnt", "failed", "forgot", "not yet")
+DONE_PHRASES = ("done", "did it", "finished", "completed", "crushed", "nailed")
+# From this hour on the no-status fallback asks for the evening reflection
+EVENING_HOUR = 17
+
+
+def _words(text):
+    return set(re.findall(r"[a-z]{4,}", (text or "").lower()))
+
+
+def format_tasks(tasks):
+    return "\n".join(
+        f"• {t.get('title', 'Task')}{' (' + t['difficulty'] + ')' if t.get('difficulty') else ''}"
+        for t in tasks if isinstance(t, dict)
+    )
+
+
+def matching_task(user_message, tasks):
+    """The task whose title shares the most words with the message, else the first task"""
+    message_words = _words(user_message)
+    tasks = [t for t in tasks if isinstance(t, dict)]
+    return max(tasks, key=lambda t: len(message_words & _words(t.get("title"))), default=None)
+
+
+def fallback_reply(kind, user_message, user_data, now=None):
+    """Reply text for a handler kind ("daily_execution", "personality_assessment", "plan_creation")"""
+    if kind == "plan_creation":
+        return ERROR_MESSAGES["timeout_error"]
+    if kind != "daily_execution":
+        return ERROR_MESSAGES["api_error"]
+
+    tasks = (user_data or {}).get("daily_plan", {}).get("tasks", [])
+    if not tasks:
+        return ERROR_MESSAGES["timeout_error"]
+    message = (user_message or "").lower()
+    task = matching_task(user_message, tasks)
+    task_name = task.get("title", "today's task") if task else "today's task"
+    if any(p in message for p in MISSED_PHRASES):
+        return RESPONSE_TEMPLATES["task_incomplete_support"].format(task_name=task_name)
+    if any(p in message for p in DONE_PHRASES):
+        return RESPONSE_TEMPLATES["task_completion_celebration"].format(task_name=task_name)
+    if (now or datetime.now()).hour >= EVENING_HOUR:
+        return RESPONSE_TEMPLATES["evening_reflection"]
+    return RESPONSE_TEMPLATES["daily_motivation"].format(tasks_list="\n" + format_tasks(tasks))
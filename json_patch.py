@@ -0,0 +1,90 @@
+# Minimal JSON Patch (RFC 6902 add / replace / remove) between two user_data documents
+
+import copy
+
+# Postgres function applying the patches server-side (run once in the Supabase SQL editor).
+# Takes [{"chat_id": ..., "ops": [...]}, ...] and returns the chat_ids that have no row yet.
+PATCH_USER_DATA_SQL = """
+create or replace function patch_user_data(p_rows jsonb) returns setof bigint
+language plpgsql as $$
+declare
+  r jsonb;
+  op jsonb;
+  doc jsonb;
+  path text[];
+begin
+  for r in select * from jsonb_array_elements(p_rows) loop
+    select user_data into doc from users where chat_id = (r->>'chat_id')::bigint for update;
+    if not found then
+      return next (r->>'chat_id')::bigint;
+      continue;
+    end if;
+    doc := coalesce(doc, '{}'::jsonb);
+    for op in select * from jsonb_array_elements(r->'ops') loop
+      select array_agg(replace(replace(part, '~1', '/'), '~0', '~') order by n) into path
+        from unnest(string_to_array(substr(op->>'path', 2), '/')) with ordinality as t(part, n);
+      if op->>'op' = 'remove' then
+        doc := doc #- path;
+      else
+        doc := jsonb_set(doc, path, op->'value', true);
+      end if;
+    end loop;
+    update users set user_data = doc, updated_at = now() where chat_id = (r->>'chat_id')::bigint;
+  end loop;
+end $$;
+"""
+
+
+def _pointer(path, key):
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def diff(old, new, path=""):
+    """Operations turning old into new. Objects are compared key by key; lists and scalars are replaced whole"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _pointer(path, key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": value})
+            else:
+                ops.extend(diff(old[key], value, _pointer(path, key)))
+        return ops
+    if old == new and type(old) is type(new):
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _overlaps(path, other):
+    return path == other or path.startswith(other + "/") or other.startswith(path + "/")
+
+
+def rebase(base, theirs, mine):
+    """mine's changes to base applied to theirs, a version of base changed elsewhere meanwhile.
+
+    Where both changed the same value, or one changed a value inside the
+    other's, theirs is kept.
+    """
+    changed = [op["path"] for op in diff(base, theirs)]
+    ops = [op for op in diff(base, mine) if not any(_overlaps(op["path"], path) for path in changed)]
+    return apply(theirs, ops)
+
+
+def apply(doc, ops):
+    """doc with ops applied (a new document; doc is left unchanged)"""
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        keys = [k.replace("~1", "/").replace("~0", "~") for k in op["path"].split("/")[1:]]
+        if not keys:
+            doc = copy.deepcopy(op["value"])
+            continue
+        parent = doc
+        for key in keys[:-1]:
+            parent = parent[key]
+        if op["op"] == "remove":
+            parent.pop(keys[-1], None)
+        else:
+            parent[keys[-1]] = copy.deepcopy(op["value"])
+    return doc
@@ -0,0 +1,304 @@
+# Prebuilt, memory-mapped knowledge index for serverless cold starts
+#
+# Build step (run after editing the knowledge files; the artifact is committed and deployed):
+#     python knowledge_artifact.py [--knowledge-dir knowledge] [--output knowledge/knowledge.idx]
+# Freshness check (exits 1 when the artifact no longer matches the files, e.g. in CI):
+#     python knowledge_artifact.py --check
+#
+# The artifact holds the chunk-level BM25 index of knowledge_index.py as flat
+# little-endian arrays. A cold start mmaps it and answers queries straight
+# from the mapped pages, without reading or chunking any markdown.
+
+import argparse
+import bisect
+import hashlib
+import heapq
+import math
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from config import KNOWLEDGE_ARTIFACT, KNOWLEDGE_DIR
+from knowledge_index import BM25_B, BM25_K1, KnowledgeIndex, index_terms, scan_knowledge_dir
+
+MAGIC = b"KIDX"
+VERSION = 2
+# magic, version, chunks, terms, postings, total_length, stat fingerprint, content fingerprint
+HEADER = struct.Struct("<4sIIIIQ32s32s")
+SECTION = struct.Struct("<QQ")
+SECTION_NAMES = (
+    "term_offsets",    # u32[terms + 1] into term_blob
+    "term_blob",       # utf-8 terms, sorted bytewise
+    "post_offsets",    # u32[terms + 1] into post_chunks / post_tf
+    "post_chunks",     # u32[postings] chunk number
+    "post_tf",         # u32[postings] term frequency in that chunk
+    "chunk_lengths",   # u32[chunks] BM25 document length
+    "string_offsets",  # u32[chunks * 4 + 1] into string_blob
+    "string_blob",     # utf-8 source, title, section, text per chunk
+)
+CHUNK_FIELDS = ("source", "title", "section", "text")
+
+
+def knowledge_fingerprint(knowledge_dir):
+    """Hash of (relative path, size) for every knowledge file.
+
+    Sizes rather than mtimes, because deploys don't preserve mtimes; stat
+    only, so checking freshness at cold start reads no file contents.
+    """
+    digest = hashlib.sha256()
+    for path, (_, size, _) in sorted(scan_knowledge_dir(knowledge_dir).items()):
+        rel = os.path.relpath(path, knowledge_dir).replace(os.sep, "/")
+        digest.update(f"{rel}\0{size}\n".encode("utf-8"))
+    return digest.digest()
+
+
+def knowledge_content_fingerprint(knowledge_dir):
+    """Hash of (relative path, content hash) for every knowledge file.
+
+    Catches edits that keep a file's size, which knowledge_fingerprint()
+    misses. Reads every file, so it only runs off the cold-start path: on a
+    background thread (MappedKnowledgeIndex.maybe_refresh) or in --check.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(scan_knowledge_dir(knowledge_dir)):
+        rel = os.path.relpath(path, knowledge_dir).replace(os.sep, "/")
+        try:
+            with open(path, "rb") as f:
+                content = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            content = ""
+        digest.update(f"{rel}\0{content}\n".encode("utf-8"))
+    return digest.digest()
+
+
+def _u32(values):
+    arr = array("I", values)
+    if arr.itemsize != 4:
+        arr = array("L", values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def build_artifact(knowledge_dir, output_path):
+    """Index knowledge_dir and write it to output_path; returns (chunks, terms, bytes written)"""
+    index = KnowledgeIndex(knowledge_dir)
+    chunks = index.chunks
+    chunk_ids = sorted(chunks)
+    number = {chunk_id: n for n, chunk_id in enumerate(chunk_ids)}
+
+    postings = {}
+    for chunk_id in chunk_ids:
+        for term, tf in chunks[chunk_id]["tf"].items():
+            postings.setdefault(term.encode("utf-8"), []).append((number[chunk_id], tf))
+    terms = sorted(postings)
+
+    term_offsets, post_offsets, post_chunks, post_tf = [0], [0], [], []
+    for term in terms:
+        term_offsets.append(term_offsets[-1] + len(term))
+        for n, tf in postings[term]:
+            post_chunks.append(n)
+            post_tf.append(tf)
+        post_offsets.append(len(post_chunks))
+
+    string_offsets, strings = [0], []
+    for chunk_id in chunk_ids:
+        for field in CHUNK_FIELDS:
+            encoded = chunks[chunk_id][field].encode("utf-8")
+            strings.append(encoded)
+            string_offsets.append(string_offsets[-1] + len(encoded))
+
+    sections = [
+        _u32(term_offsets),
+        b"".join(terms),
+        _u32(post_offsets),
+        _u32(post_chunks),
+        _u32(post_tf),
+        _u32(chunks[chunk_id]["length"] for chunk_id in chunk_ids),
+        _u32(string_offsets),
+        b"".join(strings),
+    ]
+
+    header = HEADER.pack(
+        MAGIC, VERSION, len(chunk_ids), len(terms), len(post_chunks),
+        sum(chunks[chunk_id]["length"] for chunk_id in chunk_ids),
+        knowledge_fingerprint(knowledge_dir),
+        knowledge_content_fingerprint(knowledge_dir),
+    )
+    offset = HEADER.size + SECTION.size * len(sections)
+    table, body = [], []
+    for data in sections:
+        padding = -offset % 8  # keep every array 8-byte aligned for the mmap casts
+        body.append(b"\0" * padding)
+        offset += padding
+        table.append(SECTION.pack(offset, len(data)))
+        body.append(data)
+        offset += len(data)
+
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(b"".join(table))
+        f.write(b"".join(body))
+    os.replace(tmp_path, output_path)
+    return len(chunk_ids), len(terms), offset
+
+
+class MappedKnowledgeIndex:
+    """Read-only BM25 index served from an mmapped artifact; same search API as KnowledgeIndex"""
+
+    # read-only, so the contents never change under the same object
+    version = 0
+
+    def __init__(self, path, knowledge_dir=KNOWLEDGE_DIR, refresh_seconds=0):
+        self.path = path
+        self.knowledge_dir = knowledge_dir
+        self.refresh_seconds = refresh_seconds
+        self.stale = False
+        # the first check runs on the first lookup: the cold-start check compared sizes only
+        self._last_check = float("-inf")
+        self._checking = threading.Lock()
+        self._chunks = None
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mm)
+        (magic, version, self._n_chunks, self._n_terms, _, self._total_length,
+         self.fingerprint, self.content_fingerprint) = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION or sys.byteorder != "little":
+            raise ValueError(f"{path} is not a compatible knowledge artifact")
+        sections = {}
+        for i, name in enumerate(SECTION_NAMES):
+            start, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            data = view[start : start + length]
+            sections[name] = data if name.endswith("_blob") else data.cast("I")
+        self._term_offsets = sections["term_offsets"]
+        self._term_blob = sections["term_blob"]
+        self._post_offsets = sections["post_offsets"]
+        self._post_chunks = sections["post_chunks"]
+        self._post_tf = sections["post_tf"]
+        self._chunk_lengths = sections["chunk_lengths"]
+        self._string_offsets = sections["string_offsets"]
+        self._string_blob = sections["string_blob"]
+
+    def _term_at(self, i):
+        return self._term_blob[self._term_offsets[i] : self._term_offsets[i + 1]].tobytes()
+
+    def _term_id(self, term):
+        key = term.encode("utf-8")
+        i = bisect.bisect_left(range(self._n_terms), key, key=self._term_at)
+        if i < self._n_terms and self._term_at(i) == key:
+            return i
+        return None
+
+    def _chunk(self, n):
+        offsets = self._string_offsets
+        fields = {
+            field: self._string_blob[offsets[n * 4 + i] : offsets[n * 4 + i + 1]].tobytes().decode("utf-8")
+            for i, field in enumerate(CHUNK_FIELDS)
+        }
+        fields["length"] = self._chunk_lengths[n]
+        return fields
+
+    @property
+    def chunk_count(self):
+        return self._n_chunks
+
+    @property
+    def file_count(self):
+        return len({self._chunk(n)["source"] for n in range(self._n_chunks)})
+
+    @property
+    def chunks(self):
+        """Every chunk decoded, with term frequencies (used by the tfidf backend); built once"""
+        if self._chunks is None:
+            chunks = {n: dict(self._chunk(n), tf={}) for n in range(self._n_chunks)}
+            for t in range(self._n_terms):
+                term = self._term_at(t).decode("utf-8")
+                for p in range(self._post_offsets[t], self._post_offsets[t + 1]):
+                    chunks[self._post_chunks[p]]["tf"][term] = self._post_tf[p]
+            self._chunks = chunks
+        return self._chunks
+
+    def search(self, query, top_k=5):
+        """Top-k (chunk, BM25 score) pairs for the query, best first"""
+        n = self._n_chunks
+        if not n:
+            return []
+        avg_length = self._total_length / n or 1.0
+        lengths = self._chunk_lengths
+        scores = {}
+        for term in set(index_terms(query)):
+            t = self._term_id(term)
+            if t is None:
+                continue
+            start, end = self._post_offsets[t], self._post_offsets[t + 1]
+            idf = math.log(1 + (n - (end - start) + 0.5) / (end - start + 0.5))
+            for p in range(start, end):
+                chunk_n, tf = self._post_chunks[p], self._post_tf[p]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[chunk_n] / avg_length)
+                scores[chunk_n] = scores.get(chunk_n, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [(self._chunk(chunk_n), score) for chunk_n, score in best]
+
+    def search_batch(self, queries, top_k=5):
+        return [self.search(query, top_k) for query in queries]
+
+    def maybe_refresh(self):
+        """Mark the artifact stale once the knowledge files' contents no longer match it.
+
+        The contents are hashed on a daemon thread at most once per
+        refresh_seconds; the result shows up on a later call.
+        """
+        if self.stale or self.refresh_seconds <= 0:
+            return self.stale
+        if time.monotonic() - self._last_check >= self.refresh_seconds and self._checking.acquire(blocking=False):
+            self._last_check = time.monotonic()
+            threading.Thread(target=self._check_contents, name="knowledge-artifact-check", daemon=True).start()
+        return self.stale
+
+    def _check_contents(self):
+        try:
+            self.stale = knowledge_content_fingerprint(self.knowledge_dir) != self.content_fingerprint
+        except Exception as e:
+            logging.error(f"Knowledge artifact check failed: {e}")
+        finally:
+            self._checking.release()
+
+
+def load_artifact(path=KNOWLEDGE_ARTIFACT, knowledge_dir=KNOWLEDGE_DIR, refresh_seconds=0):
+    """MappedKnowledgeIndex for path if it exists and matches knowledge_dir, else None"""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        index = MappedKnowledgeIndex(path, knowledge_dir, refresh_seconds)
+    except (OSError, ValueError, struct.error) as e:
+        logging.warning(f"Ignoring knowledge artifact {path}: {e}")
+        return None
+    if index.fingerprint != knowledge_fingerprint(knowledge_dir):
+        logging.warning(f"Ignoring stale knowledge artifact {path}; rebuild it with `python knowledge_artifact.py`")
+        return None
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the knowledge base into a memory-mappable index")
+    parser.add_argument("--knowledge-dir", default=KNOWLEDGE_DIR)
+    parser.add_argument("--output", default=KNOWLEDGE_ARTIFACT)
+    parser.add_argument("--check", action="store_true", help="exit 1 if the artifact is missing or stale")
+    args = parser.parse_args()
+    if args.check:
+        index = load_artifact(args.output, args.knowledge_dir)
+        if index is None or index.content_fingerprint != knowledge_content_fingerprint(args.knowledge_dir):
+            print(f"{args.output} is missing or stale; rebuild it with `python knowledge_artifact.py`")
+            sys.exit(1)
+        print(f"{args.output} matches {args.knowledge_dir}")
+        sys.exit()
+    start = time.perf_counter()
+    n_chunks, n_terms, size = build_artifact(args.knowledge_dir, args.output)
+    print(f"Wrote {args.output}: {n_chunks} chunks, {n_terms} terms, {size} bytes "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,483 @@
+# In-process inverted index over the local knowledge base
+
+import collections
+import functools
+import heapq
+import itertools
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+from config import (
+    KNOWLEDGE_ARTIFACT,
+    KNOWLEDGE_DIR,
+    KNOWLEDGE_REFRESH_SECONDS,
+    RAG_BACKEND,
+    RAG_CACHE_SIZE,
+    RAG_CACHE_TTL_SECONDS,
+)
+
+KNOWLEDGE_EXTENSIONS = (".txt", ".md")
+TERM_PATTERN = re.compile(r"[a-zA-Z]{4,}")
+BULLET_PATTERN = re.compile(r"^(?:[-*•]|\d+[.)])\s+")
+# Sections that describe the file rather than coach the user are not turned into chunks
+SKIPPED_SECTIONS = {"keywords"}
+STOPWORDS = {
+    "about", "after", "again", "also", "been", "before", "being", "could", "does", "doing",
+    "from", "going", "have", "into", "just", "keep", "like", "more", "most", "much", "need",
+    "only", "over", "really", "should", "some", "than", "that", "their", "them", "then",
+    "there", "they", "thing", "this", "today", "very", "want", "were", "what", "when",
+    "where", "which", "will", "with", "would", "your",
+}
+# Light suffix stripping so "habits"/"habit" and "procrastinating"/"procrastinate" meet
+SUFFIXES = ("ations", "ation", "ings", "ing", "edly", "ed", "ies", "es", "s", "e")
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def extract_terms(text):
+    """Lowercased 4+ letter words, the same keywords retrieval has always used"""
+    return TERM_PATTERN.findall((text or "").lower())
+
+
+@functools.lru_cache(maxsize=65536)
+def stem(term):
+    for suffix in SUFFIXES:
+        if term.endswith(suffix) and len(term) - len(suffix) >= 4:
+            return term[: -len(suffix)]
+    return term
+
+
+def index_terms(text):
+    """Stemmed, stopword-free terms used on both the index and the query side"""
+    return [stem(t) for t in extract_terms(text) if t not in STOPWORDS]
+
+
+def chunk_markdown(name, text):
+    """Split a knowledge file at its ## headings and top-level bullets.
+
+    Nested bullets and wrapped lines stay with their parent bullet, so a
+    technique keeps its "When to use" line. Returns a list of chunk dicts.
+    """
+    title = os.path.splitext(name)[0].replace("_", " ").title()
+    section = ""
+    chunks = []
+    current = []
+
+    def flush():
+        body = "\n".join(current).strip()
+        current.clear()
+        if body and section.lower() not in SKIPPED_SECTIONS:
+            chunks.append({"source": name, "title": title, "section": section, "text": body})
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if line.startswith("## "):
+            flush()
+            section = line[3:].strip()
+        elif line.startswith("# "):
+            flush()
+            title = re.sub(r"^TITLE:\s*", "", line[2:].strip()) or title
+        elif not stripped:
+            flush()
+        elif BULLET_PATTERN.match(line):
+            flush()
+            current.append(stripped)
+        else:
+            current.append(line.rstrip())
+    flush()
+    return chunks
+
+
+def scan_knowledge_dir(knowledge_dir):
+    """path -> (mtime_ns, size, name) for every knowledge file; stat only, no reads"""
+    found = {}
+    if not os.path.isdir(knowledge_dir):
+        return found
+    for root, _, names in os.walk(knowledge_dir):
+        for name in names:
+            if not name.lower().endswith(KNOWLEDGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found[path] = (st.st_mtime_ns, st.st_size, name)
+    return found
+
+
+# Every snapshot gets a process-unique version so caches can tell when the index changed
+_snapshot_versions = itertools.count(1)
+
+
+def _empty_snapshot():
+    return {"files": {}, "chunks": {}, "postings": {}, "total_length": 0, "next_id": 0, "version": 0}
+
+
+class KnowledgeIndex:
+    """Chunk-level BM25 index over every knowledge file, maintained incrementally in memory.
+
+    Each refresh builds a new snapshot copy-on-write (only the postings of
+    touched terms are copied) and swaps it in with one assignment, so a
+    concurrent search always reads a complete index.
+    """
+
+    def __init__(self, knowledge_dir=KNOWLEDGE_DIR, refresh_seconds=0):
+        self.knowledge_dir = knowledge_dir
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._snapshot = _empty_snapshot()
+        self._last_refresh = 0.0
+        self.refresh()
+
+    def _apply(self, old, scanned):
+        """New snapshot from `old` with changed/added/deleted files re-indexed; None if nothing changed"""
+        changed = sorted(p for p, stat in scanned.items() if old["files"].get(p, {}).get("stat") != stat[:2])
+        deleted = [p for p in old["files"] if p not in scanned]
+        if not changed and not deleted:
+            return None
+
+        files = dict(old["files"])
+        chunks = dict(old["chunks"])
+        postings = dict(old["postings"])
+        copied = set()
+        total_length = old["total_length"]
+        next_id = old["next_id"]
+
+        def own(term):
+            # copy a posting dict the first time this refresh touches it
+            if term not in copied:
+                postings[term] = dict(postings.get(term, {}))
+                copied.add(term)
+            return postings[term]
+
+        for path in deleted + [p for p in changed if p in files]:
+            for chunk_id in files.pop(path)["chunk_ids"]:
+                chunk = chunks.pop(chunk_id)
+                total_length -= chunk["length"]
+                for term in chunk["tf"]:
+                    plist = own(term)
+                    plist.pop(chunk_id, None)
+                    if not plist:
+                        del postings[term]
+                        copied.discard(term)
+
+        for path in changed:
+            mtime_ns, size, name = scanned[path]
+            chunk_ids = []
+            text = ""
+            if size > 0:
+                try:
+                    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                        text = f.read()
+                except OSError as e:
+                    logging.warning(f"Skipping knowledge file {path}: {e}")
+                    continue
+            for chunk in chunk_markdown(name, text):
+                terms = index_terms(f"{chunk['title']} {chunk['section']} {chunk['text']}")
+                tf = {}
+                for term in terms:
+                    tf[term] = tf.get(term, 0) + 1
+                chunk["length"] = len(terms)
+                chunk["tf"] = tf
+                chunks[next_id] = chunk
+                chunk_ids.append(next_id)
+                total_length += chunk["length"]
+                for term, count in tf.items():
+                    own(term)[next_id] = count
+                next_id += 1
+            files[path] = {"stat": (mtime_ns, size), "chunk_ids": chunk_ids}
+
+        return {"files": files, "chunks": chunks, "postings": postings,
+                "total_length": total_length, "next_id": next_id, "version": next(_snapshot_versions)}
+
+    def _refresh_locked(self):
+        self._last_refresh = time.monotonic()
+        snapshot = self._apply(self._snapshot, scan_knowledge_dir(self.knowledge_dir))
+        if snapshot is None:
+            return False
+        self._snapshot = snapshot
+        return True
+
+    def refresh(self):
+        """Re-index files whose mtime/size changed and drop deleted ones; returns True if the index changed"""
+        with self._lock:
+            return self._refresh_locked()
+
+    def maybe_refresh(self):
+        """Start a refresh in the background at most once per refresh_seconds.
+
+        Lookups run inside async handlers, and scanning a large knowledge
+        directory would stall the event loop, so the scan runs on a daemon
+        thread and lookups keep the current snapshot until it is swapped.
+        Always returns False: a change shows up in version once it lands.
+        """
+        if self.refresh_seconds <= 0 or time.monotonic() - self._last_refresh < self.refresh_seconds:
+            return False
+        if not self._lock.acquire(blocking=False):
+            return False
+        self._last_refresh = time.monotonic()
+        threading.Thread(target=self._background_refresh, name="knowledge-refresh", daemon=True).start()
+        return False
+
+    def _background_refresh(self):
+        try:
+            self._refresh_locked()
+        except Exception as e:
+            logging.error(f"Knowledge refresh failed: {e}")
+        finally:
+            self._lock.release()
+
+    def rebuild(self):
+        """Re-read every knowledge file from scratch; lookups keep using the old snapshot until the swap"""
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            self._snapshot = self._apply(_empty_snapshot(), scan_knowledge_dir(self.knowledge_dir)) or _empty_snapshot()
+            return len(self._snapshot["chunks"])
+
+    @property
+    def chunks(self):
+        return self._snapshot["chunks"]
+
+    @property
+    def version(self):
+        return self._snapshot["version"]
+
+    @property
+    def chunk_count(self):
+        return len(self._snapshot["chunks"])
+
+    @property
+    def file_count(self):
+        return len(self._snapshot["files"])
+
+    def search(self, query, top_k=5):
+        """Top-k (chunk, BM25 score) pairs for the query, best first"""
+        snapshot = self._snapshot
+        chunks = snapshot["chunks"]
+        if not chunks:
+            return []
+        n = len(chunks)
+        avg_length = snapshot["total_length"] / n or 1.0
+        scores = {}
+        for term in set(index_terms(query)):
+            plist = snapshot["postings"].get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for chunk_id, tf in plist.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * chunks[chunk_id]["length"] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [(chunks[chunk_id], score) for chunk_id, score in best]
+
+    def search_batch(self, queries, top_k=5):
+        """search() for each query; the tfidf backend vectorizes this instead"""
+        return [self.search(query, top_k) for query in queries]
+
+
+def format_chunk(chunk):
+    heading = f"{chunk['title']} · {chunk['section']}" if chunk["section"] else chunk["title"]
+    return f"[{heading}]\n{chunk['text']}"
+
+
+def pack_chunks(ranked, max_chars):
+    """Whole formatted chunks in rank order, skipping any that would overflow max_chars"""
+    blocks = []
+    used = 0
+    for chunk, _ in ranked:
+        block = format_chunk(chunk)
+        cost = len(block) + (2 if blocks else 0)
+        if used + cost > max_chars:
+            continue
+        blocks.append(block)
+        used += cost
+    return "\n\n".join(blocks)
+
+
+class RetrievalCache:
+    """Bounded LRU + TTL cache of packed retrieval results.
+
+    Keys are the sorted set of query keywords, so "did my workout" and
+    "workout did my" share an entry. Entries are tagged with the index they
+    were computed from; the whole cache is flushed when the index changes.
+    """
+
+    def __init__(self, maxsize=1024, ttl_seconds=3600):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                self.flushes += 1
+            self._entries.clear()
+            self._generation = generation
+
+    def get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if self.ttl_seconds <= 0 or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.flushes += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "flushes": self.flushes,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+def cache_key(query, top_k, max_chars):
+    return (tuple(sorted(set(extract_terms(query)))), top_k, max_chars)
+
+
+_index = None
+_index_lock = threading.Lock()
+_context_cache = RetrievalCache(RAG_CACHE_SIZE, RAG_CACHE_TTL_SECONDS)
+_retriever = (None, None)
+
+
+def _load_index():
+    from knowledge_artifact import load_artifact
+    return (
+        load_artifact(KNOWLEDGE_ARTIFACT, KNOWLEDGE_DIR, KNOWLEDGE_REFRESH_SECONDS)
+        or KnowledgeIndex(KNOWLEDGE_DIR, KNOWLEDGE_REFRESH_SECONDS)
+    )
+
+
+def get_knowledge_index():
+    """Process-wide index: the prebuilt artifact if it is fresh, else built on first use, kept in sync with KNOWLEDGE_DIR"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _load_index()
+    elif _index.maybe_refresh() and getattr(_index, "stale", False):
+        # the mmapped artifact is read-only; once the files move on, index them live
+        with _index_lock:
+            if getattr(_index, "stale", False):
+                _index = KnowledgeIndex(KNOWLEDGE_DIR, KNOWLEDGE_REFRESH_SECONDS)
+    return _index
+
+
+def rebuild_knowledge_index():
+    """Force a re-read of KNOWLEDGE_DIR, e.g. after editing playbooks"""
+    global _index
+    index = get_knowledge_index()
+    if isinstance(index, KnowledgeIndex):
+        return index.rebuild()
+    with _index_lock:
+        _index = KnowledgeIndex(KNOWLEDGE_DIR, KNOWLEDGE_REFRESH_SECONDS)
+        return _index.chunk_count
+
+
+def get_retriever():
+    """The RAG_BACKEND selected in config: the BM25 index itself, or the NumPy TF-IDF engine on top of it"""
+    global _retriever
+    index = get_knowledge_index()
+    if RAG_BACKEND != "tfidf":
+        return index
+    source, retriever = _retriever
+    if source is not index:
+        try:
+            from tfidf_retriever import TfidfRetriever
+            retriever = TfidfRetriever(index)
+        except ImportError as e:
+            logging.warning(f"TF-IDF backend unavailable ({e}), falling back to BM25")
+            retriever = index
+        _retriever = (index, retriever)
+    return retriever
+
+
+def retrieve_packed(query, top_k, max_chars):
+    """Ranked chunks for query packed into max_chars, served from the LRU cache when possible"""
+    retriever = get_retriever()
+    index = get_knowledge_index()
+    generation = (index, index.version)
+    key = cache_key(query, top_k, max_chars)
+    context = _context_cache.get(key, generation)
+    if context is None:
+        context = pack_chunks(retriever.search(query, top_k=top_k), max_chars)
+        _context_cache.put(key, generation, context)
+    return context
+
+
+def retrieve_ranked(query, top_k):
+    """Ranked (chunk, score) pairs for query, cached like retrieve_packed; for callers that pack by tokens"""
+    retriever = get_retriever()
+    index = get_knowledge_index()
+    generation = (index, index.version)
+    key = cache_key(query, top_k, None)
+    ranked = _context_cache.get(key, generation)
+    if ranked is None:
+        ranked = retriever.search(query, top_k=top_k)
+        _context_cache.put(key, generation, ranked)
+    return ranked
+
+
+def retrieve_packed_batch(queries, top_k, max_chars):
+    """retrieve_packed for many queries; cache misses are searched together in one batch"""
+    retriever = get_retriever()
+    index = get_knowledge_index()
+    generation = (index, index.version)
+    keys = [cache_key(query, top_k, max_chars) for query in queries]
+    contexts = [_context_cache.get(key, generation) for key in keys]
+    missing = [i for i, context in enumerate(contexts) if context is None]
+    if missing:
+        ranked_lists = retriever.search_batch([queries[i] for i in missing], top_k=top_k)
+        for i, ranked in zip(missing, ranked_lists):
+            contexts[i] = pack_chunks(ranked, max_chars)
+            _context_cache.put(keys[i], generation, contexts[i])
+    return contexts
+
+
+def retrieval_cache_stats():
+    """Hit/miss/eviction counters of the retrieval cache, for sizing RAG_CACHE_SIZE"""
+    return _context_cache.stats()
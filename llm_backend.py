@@ -0,0 +1,250 @@
+# Model backends behind llm_client: Gemini, or a deterministic local fake for offline load tests
+#
+# A backend hands out model objects for a (model name, system instruction).
+# A model has the two generate paths of genai.GenerativeModel:
+#
+#   generate_content(prompt, stream=False, generation_config=None, request_options=None)
+#   await generate_content_async(prompt, generation_config=None, request_options=None)
+#
+# and returns a response with .text and .usage_metadata; with stream=True the
+# response is an iterable of chunks with .text and is complete once consumed.
+# llm_client runs the sync path on its thread pool, or awaits the async path
+# for models that set native_async = True.
+
+import asyncio
+import datetime
+import json
+import logging
+import math
+import random
+import threading
+import time
+from typing import Protocol
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+from config import (
+    FAKE_LLM_ERROR_RATE,
+    FAKE_LLM_FIRST_TOKEN_MS,
+    FAKE_LLM_FIRST_TOKEN_SIGMA,
+    FAKE_LLM_MALFORMED_RATE,
+    FAKE_LLM_MS_PER_TOKEN,
+    FAKE_LLM_NATIVE_ASYNC,
+    FAKE_LLM_SEED,
+    GEMINI_CONTEXT_CACHE_ENABLED,
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS,
+    GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+    LLM_BACKEND,
+)
+from context_packer import estimate_tokens
+
+
+class LLMModel(Protocol):
+    def generate_content(self, prompt, stream=False, generation_config=None, request_options=None): ...
+
+    async def generate_content_async(self, prompt, generation_config=None, request_options=None): ...
+
+
+class LLMBackend(Protocol):
+    def configure(self, api_key): ...
+
+    def create_model(self, model_name, system_instruction=None):
+        """(model, monotonic expiry) for llm_client.get_model's process-wide cache"""
+        ...
+
+
+class GeminiBackend:
+    """google.generativeai models, context-cached when the system instruction is large enough"""
+
+    def configure(self, api_key):
+        genai.configure(api_key=api_key)
+
+    def _cached_model(self, model_name, system_instruction):
+        """GenerativeModel backed by an explicit context cache of system_instruction, or None"""
+        if not GEMINI_CONTEXT_CACHE_ENABLED or estimate_tokens(system_instruction) < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=model_name,
+                display_name=f"{model_name}-system",
+                system_instruction=system_instruction,
+                ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS),
+            )
+            return genai.GenerativeModel.from_cached_content(cache)
+        except Exception as e:
+            logging.warning(f"Context caching unavailable for {model_name}, sending the instruction inline: {e}")
+            return None
+
+    def create_model(self, model_name, system_instruction=None):
+        model = system_instruction and self._cached_model(model_name, system_instruction)
+        if model:
+            # recreate a little before the server-side cache expires
+            return model, time.monotonic() + GEMINI_CONTEXT_CACHE_TTL_SECONDS * 0.9
+        return genai.GenerativeModel(model_name, system_instruction=system_instruction), float("inf")
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = 0
+
+
+class FakeChunk:
+    usage_metadata = None
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    """Whole reply, or (streaming) an iterator over its chunks that paces them like the API"""
+
+    def __init__(self, text, usage, chunk_delays=None):
+        self.text = text
+        self.usage_metadata = usage
+        self._chunk_delays = chunk_delays
+
+    def __iter__(self):
+        size = math.ceil(len(self.text) / len(self._chunk_delays))
+        for i, delay in enumerate(self._chunk_delays):
+            time.sleep(delay)
+            yield FakeChunk(self.text[i * size:(i + 1) * size])
+
+
+def example_from_schema(schema, rng, key="value"):
+    """A random value that satisfies a response_schema dict (object / array / enum / scalar types)"""
+    kind = schema.get("type", "string").lower()
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if kind == "object":
+        return {name: example_from_schema(prop, rng, name) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [example_from_schema(schema.get("items", {}), rng, key) for _ in range(rng.randint(1, 3))]
+    if kind == "integer":
+        return rng.randint(1, 5)
+    if kind == "number":
+        return round(rng.uniform(0, 1), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if key == "date":
+        return datetime.date.today().isoformat()
+    return f"Fake {key.replace('_', ' ')} #{rng.randint(1, 999)}"
+
+
+class FakeModel:
+    """Deterministic stand-in for a GenerativeModel; see FakeBackend for the knobs"""
+
+    def __init__(self, backend, model_name, system_instruction=None):
+        self.backend = backend
+        self.model_name = f"fake/{model_name}"
+        self._system_instruction = system_instruction
+        self.native_async = backend.native_async
+
+    def _reply(self, prompt, generation_config):
+        """(text, usage, first-token s, latency s, error?) for one call, from the backend's seeded RNG"""
+        config = generation_config or {}
+        backend = self.backend
+        with backend.lock:
+            rng = backend.rng
+            error = rng.random() < backend.error_rate
+            if config.get("response_schema"):
+                text = json.dumps(example_from_schema(config["response_schema"], rng))
+            elif config.get("response_mime_type") == "application/json":
+                text = json.dumps({"reply_to_user": f"Fake reply #{rng.randint(1, 999)}"})
+            else:
+                text = f"Fake message #{rng.randint(1, 999)}: one small step today."
+            if rng.random() < backend.malformed_rate:
+                text = text[:rng.randint(0, max(0, len(text) - 2))]  # truncated mid-object
+            first_token_s = rng.lognormvariate(math.log(backend.first_token_ms / 1000), backend.first_token_sigma)
+            backend.calls += 1
+        usage = FakeUsage(estimate_tokens((self._system_instruction or "") + str(prompt)), estimate_tokens(text))
+        latency_s = first_token_s + usage.candidates_token_count * backend.ms_per_token / 1000
+        return text, usage, first_token_s, latency_s, error
+
+    @staticmethod
+    def _timeout(request_options):
+        return (request_options or {}).get("timeout")
+
+    def generate_content(self, prompt, stream=False, generation_config=None, request_options=None):
+        text, usage, first_token_s, latency_s, error = self._reply(prompt, generation_config)
+        timeout = self._timeout(request_options)
+        if timeout is not None and latency_s > timeout:
+            time.sleep(timeout)
+            raise api_exceptions.DeadlineExceeded("fake model: deadline exceeded")
+        if error:
+            time.sleep(first_token_s)
+            raise api_exceptions.ServiceUnavailable("fake model: injected error")
+        if stream:
+            chunks = max(1, min(8, len(text) // 40))
+            rest = (latency_s - first_token_s) / max(1, chunks - 1)
+            return FakeResponse(text, usage, [first_token_s] + [rest] * (chunks - 1))
+        time.sleep(latency_s)
+        return FakeResponse(text, usage)
+
+    async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+        text, usage, first_token_s, latency_s, error = self._reply(prompt, generation_config)
+        timeout = self._timeout(request_options)
+        if timeout is not None and latency_s > timeout:
+            await asyncio.sleep(timeout)
+            raise api_exceptions.DeadlineExceeded("fake model: deadline exceeded")
+        if error:
+            await asyncio.sleep(first_token_s)
+            raise api_exceptions.ServiceUnavailable("fake model: injected error")
+        await asyncio.sleep(latency_s)
+        return FakeResponse(text, usage)
+
+
+class FakeBackend:
+    """Offline models with reproducible latency, errors and malformed output.
+
+    Latency per call is a lognormal time to first token (median
+    first_token_ms, shape first_token_sigma) plus ms_per_token for each
+    output token. error_rate of calls raise ServiceUnavailable (retryable,
+    like a 503); malformed_rate return truncated JSON. Calls longer than
+    their request_options timeout raise DeadlineExceeded at the timeout.
+    JSON replies follow the call's response_schema. All draws come from one
+    RNG seeded with seed, so a run is repeatable for the same call order.
+    """
+
+    def __init__(self, first_token_ms=FAKE_LLM_FIRST_TOKEN_MS, first_token_sigma=FAKE_LLM_FIRST_TOKEN_SIGMA,
+                 ms_per_token=FAKE_LLM_MS_PER_TOKEN, error_rate=FAKE_LLM_ERROR_RATE,
+                 malformed_rate=FAKE_LLM_MALFORMED_RATE, seed=FAKE_LLM_SEED, native_async=FAKE_LLM_NATIVE_ASYNC):
+        self.first_token_ms = first_token_ms
+        self.first_token_sigma = first_token_sigma
+        self.ms_per_token = ms_per_token
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.native_async = native_async
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def configure(self, api_key):
+        pass
+
+    def create_model(self, model_name, system_instruction=None):
+        return FakeModel(self, model_name, system_instruction), float("inf")
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """Process-wide backend, LLM_BACKEND unless set_backend() chose another"""
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[LLM_BACKEND]()
+    return _backend
+
+
+def set_backend(backend):
+    """Use backend for every model obtained from now on (load tests, benchmarks)"""
+    global _backend
+    _backend = backend
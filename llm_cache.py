@@ -0,0 +1,222 @@
+# Content-addressed cache of model replies for calls whose output is a function of their input
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from config import LLM_CACHE_SHARED_BACKEND, LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS
+from llm_metrics import llm_metrics
+
+
+def model_identity(model):
+    """What besides the prompt determines a model's reply: name, system instruction, context cache"""
+    instruction = getattr(model, "_system_instruction", None)
+    return {
+        "model": getattr(model, "model_name", type(model).__name__),
+        "system_instruction": str(instruction) if instruction else "",
+        "cached_content": getattr(model, "cached_content", None) or "",
+    }
+
+
+def llm_cache_key(model, prompt, generation_config=None):
+    """sha256 over (model identity, generation config, final prompt)"""
+    payload = json.dumps(
+        {"model": model_identity(model), "config": generation_config or {}, "prompt": prompt},
+        sort_keys=True, default=str, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """In-process LRU with per-entry expiry"""
+
+    blocking = False
+
+    def __init__(self, maxsize=LLM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    """Shared cache across processes / serverless instances (needs the redis package and REDIS_URL)"""
+
+    # network calls: LLMCache runs them off the event loop
+    blocking = True
+
+    def __init__(self, url=None, prefix="llm-cache:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("the redis package is required for LLM_CACHE_SHARED_BACKEND = 'redis'") from e
+        self.client = redis.Redis.from_url(url or os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl_seconds):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl_seconds)))
+
+
+SHARED_BACKENDS = {
+    "redis": RedisCacheBackend,
+}
+
+
+class LLMCache:
+    """Reply text by content key: the in-process backend first, then an optional shared one.
+
+    Concurrent misses on the same key are coalesced onto a single generation,
+    so identical requests never reach the API twice at the same time either.
+    Any object with get(key) and set(key, value, ttl_seconds) can be the
+    shared backend; set blocking = True on it if those calls do I/O.
+    """
+
+    def __init__(self, local=None, shared=None, ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        self.local = local if local is not None else MemoryCacheBackend()
+        self.shared = shared
+        self.ttl_seconds = ttl_seconds
+        self._inflight = {}
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def _call(self, backend, method, *args):
+        try:
+            if backend.blocking:
+                return await asyncio.to_thread(getattr(backend, method), *args)
+            return getattr(backend, method)(*args)
+        except Exception as e:
+            # a cache outage must never fail the reply
+            self.errors += 1
+            logging.error(f"LLM cache {method} failed: {e}")
+            return None
+
+    async def get(self, key):
+        value = await self._call(self.local, "get", key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.shared is not None:
+            value = await self._call(self.shared, "get", key)
+            if value is not None:
+                self.shared_hits += 1
+                await self._call(self.local, "set", key, value, self.ttl_seconds)
+                return value
+        return None
+
+    async def set(self, key, value):
+        await self._call(self.local, "set", key, value, self.ttl_seconds)
+        if self.shared is not None:
+            await self._call(self.shared, "set", key, value, self.ttl_seconds)
+
+    async def get_or_generate(self, key, generate):
+        """Cached text for key, else the result of await generate() (stored unless it is None)"""
+        value = await self.get(key)
+        if value is not None:
+            return value
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            value = await asyncio.shield(inflight)
+            if value is not None:
+                return value
+            # the shared generation failed; try on our own
+            return await generate()
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        value = None
+        try:
+            value = await generate()
+            if value is not None:
+                await self.set(key, value)
+            return value
+        finally:
+            del self._inflight[key]
+            future.set_result(value)
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "errors": self.errors,
+            "size": len(self.local) if hasattr(self.local, "__len__") else None,
+        }
+
+
+_llm_cache = None
+
+
+def get_llm_cache():
+    """Process-wide LLMCache per config (LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS, LLM_CACHE_SHARED_BACKEND)"""
+    global _llm_cache
+    if _llm_cache is None:
+        shared = None
+        if LLM_CACHE_SHARED_BACKEND:
+            try:
+                shared = SHARED_BACKENDS[LLM_CACHE_SHARED_BACKEND]()
+            except Exception as e:
+                logging.warning(f"Shared LLM cache '{LLM_CACHE_SHARED_BACKEND}' unavailable, using the in-process cache only: {e}")
+        _llm_cache = LLMCache(MemoryCacheBackend(LLM_CACHE_SIZE), shared, LLM_CACHE_TTL_SECONDS)
+    return _llm_cache
+
+
+def llm_cache_stats():
+    return get_llm_cache().stats()
+
+
+def _cache_metrics():
+    if _llm_cache is None:
+        return []
+    stats = _llm_cache.stats()
+    samples = [
+        ("llm_cache_requests_total", {"result": result}, stats[result])
+        for result in ("hits", "shared_hits", "misses", "coalesced")
+    ]
+    samples.append(("llm_cache_errors_total", {}, stats["errors"]))
+    if stats["size"] is not None:
+        samples.append(("llm_cache_entries", {}, stats["size"]))
+    return samples
+
+
+llm_metrics.register(_cache_metrics)
@@ -0,0 +1,376 @@
+# Non-blocking access to the synchronous Gemini SDK from async handlers
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as api_exceptions
+
+from config import (
+    API_TIMEOUT,
+    HEDGE_ENABLED,
+    HEDGE_MAX_RATE,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_PERCENTILE,
+    HEDGE_WINDOW,
+    HEDGED_PHASES,
+    LLM_CACHE_ENABLED,
+    LLM_CACHED_PHASES,
+    MAX_API_RETRIES,
+    RETRY_BASE_DELAY_SECONDS,
+    RETRY_MAX_DELAY_SECONDS,
+    GEMINI_MODEL_NAME,
+    LLM_MAX_CONCURRENT_CALLS,
+)
+from llm_backend import get_backend
+from llm_cache import get_llm_cache, llm_cache_key
+from llm_metrics import llm_metrics
+
+# Every Gemini round trip runs on this pool, so the event loop keeps serving
+# other chats while one waits on the model. Calls beyond the pool size queue
+# here instead of opening unbounded concurrent requests against our quota.
+_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENT_CALLS, thread_name_prefix="gemini")
+
+async def generate_content_async(model, prompt, phase="default", attempt=0, **kwargs):
+    """await model.generate_content(prompt, **kwargs) without blocking the event loop.
+
+    The call is timed and its usage_metadata recorded under phase (attempt is
+    the retry number, for llm_metrics). Without streaming the whole reply
+    arrives at once, so the latency is also the time to first token. Models
+    with native_async (see llm_backend) are awaited instead of using the pool.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        if getattr(model, "native_async", False):
+            response = await model.generate_content_async(prompt, **kwargs)
+        else:
+            response = await loop.run_in_executor(
+                _executor, functools.partial(model.generate_content, prompt, **kwargs)
+            )
+    except BaseException:
+        llm_metrics.record_call(phase, time.perf_counter() - start, retries=attempt, ok=False)
+        raise
+    llm_metrics.record_call(phase, time.perf_counter() - start, getattr(response, "usage_metadata", None), attempt)
+    return response
+
+
+def _stream_into(model, prompt, kwargs, loop, queue):
+    """Worker thread: push each streamed text chunk onto queue, then None; returns the response"""
+    try:
+        response = model.generate_content(prompt, stream=True, **kwargs)
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:  # a chunk without text parts (e.g. only the finish reason)
+                continue
+            if text:
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+        return response
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+
+async def stream_content_async(model, prompt, phase="default", on_text=None, attempt=0, **kwargs):
+    """Streamed generate_content on the same pool as generate_content_async.
+
+    on_text(text_so_far) is awaited as chunks arrive; chunks that pile up while
+    it runs are merged into the next call. Returns the complete response, so
+    callers read response.text exactly as with generate_content_async.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    start = time.perf_counter()
+    future = loop.run_in_executor(_executor, _stream_into, model, prompt, kwargs, loop, queue)
+    parts = []
+    first_token_s = None
+    done = False
+    try:
+        while not done:
+            text = await queue.get()
+            while text is not None and not queue.empty():
+                parts.append(text)
+                text = queue.get_nowait()
+            if text is None:
+                done = True
+            else:
+                parts.append(text)
+            if parts and first_token_s is None:
+                first_token_s = time.perf_counter() - start
+            if parts and on_text and not done:
+                await on_text("".join(parts))
+        response = await future
+    except BaseException:
+        llm_metrics.record_call(phase, time.perf_counter() - start, retries=attempt, ok=False)
+        raise
+    llm_metrics.record_call(
+        phase, time.perf_counter() - start, getattr(response, "usage_metadata", None), attempt,
+        first_token_s=first_token_s,
+    )
+    return response
+
+
+# Requests the API will reject the same way however often they are sent
+NON_RETRYABLE_ERRORS = (
+    api_exceptions.InvalidArgument,
+    api_exceptions.PermissionDenied,
+    api_exceptions.Unauthenticated,
+)
+
+# Monotonic deadline shared by every JSON call made for the current message
+_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+
+@contextlib.contextmanager
+def message_deadline(seconds=API_TIMEOUT):
+    """Give every generate_json_async call inside the block one shared deadline, seconds from now"""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def parse_json_reply(text):
+    """json.loads a model reply, tolerating ``` fences around it"""
+    return json.loads(text.strip().replace("```json", "").replace("```", ""))
+
+
+class HedgePolicy:
+    """When to send a duplicate request for one phase.
+
+    Tracks the phase's recent latencies and which recent calls were hedged.
+    The hedge delay is HEDGE_PERCENTILE of the latencies; a hedge is only
+    allowed while hedged calls are below HEDGE_MAX_RATE of the window.
+    """
+
+    def __init__(self, window=HEDGE_WINDOW, percentile=HEDGE_PERCENTILE,
+                 min_samples=HEDGE_MIN_SAMPLES, max_rate=HEDGE_MAX_RATE):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        self._latencies = collections.deque(maxlen=window)
+        self._hedged = collections.deque(maxlen=window)
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """Seconds to wait before hedging, or None while there is too little history"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        ranked = sorted(self._latencies)
+        return ranked[min(len(ranked) - 1, int(len(ranked) * self.percentile / 100))]
+
+    def allow_hedge(self):
+        """Whether hedging this call keeps the hedged share of the window within max_rate"""
+        return sum(self._hedged) + 1 <= self.max_rate * (len(self._hedged) + 1)
+
+    def record(self, latency_s, hedged, hedge_won=False):
+        self._latencies.append(latency_s)
+        self._hedged.append(hedged)
+        self.hedges += hedged
+        self.hedge_wins += hedge_won
+
+
+_hedge_policies = collections.defaultdict(HedgePolicy)
+
+
+def hedge_stats():
+    """{phase: current hedge delay (ms), hedges sent, hedges that won}"""
+    return {
+        phase: {
+            "hedge_delay_ms": None if policy.delay() is None else policy.delay() * 1000,
+            "hedges": policy.hedges,
+            "hedge_wins": policy.hedge_wins,
+        }
+        for phase, policy in list(_hedge_policies.items())
+    }
+
+
+def _hedge_metrics():
+    samples = []
+    for phase, stats in hedge_stats().items():
+        samples.append(("llm_hedges_total", {"phase": phase}, stats["hedges"]))
+        samples.append(("llm_hedge_wins_total", {"phase": phase}, stats["hedge_wins"]))
+        if stats["hedge_delay_ms"] is not None:
+            samples.append(("llm_hedge_delay_seconds", {"phase": phase}, stats["hedge_delay_ms"] / 1000))
+    return samples
+
+
+llm_metrics.register(_hedge_metrics)
+
+
+async def _json_attempt(model, prompt, phase, kwargs, on_text, attempt=0):
+    if on_text:
+        response = await stream_content_async(model, prompt, phase, on_text, attempt, **kwargs)
+    else:
+        response = await generate_content_async(model, prompt, phase, attempt, **kwargs)
+    return parse_json_reply(response.text)
+
+
+async def _hedged_json_attempt(model, prompt, phase, kwargs, on_text, attempt=0):
+    """_json_attempt, duplicated once it runs past the phase's hedge delay; first good reply wins.
+
+    The loser is cancelled on our side. The sync SDK gives no handle to abort
+    its RPC, so that request still runs to its timeout in the pool.
+    """
+    policy = _hedge_policies[phase]
+    delay = policy.delay()
+    start = time.perf_counter()
+    streaming = []
+
+    def relay(i):
+        # only the request that streams first is shown to the user
+        async def forward(text):
+            if not streaming:
+                streaming.append(i)
+            if streaming[0] == i:
+                await on_text(text)
+        return forward if on_text else None
+
+    tasks = [asyncio.ensure_future(_json_attempt(model, prompt, phase, kwargs, relay(0), attempt))]
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and policy.allow_hedge():
+                tasks.append(asyncio.ensure_future(_json_attempt(model, prompt, phase, kwargs, relay(1), attempt)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    policy.record(time.perf_counter() - start, len(tasks) > 1, task is tasks[-1] and len(tasks) > 1)
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def generate_json_async(model, prompt, phase="default", schema=None, max_output_tokens=None, on_text=None,
+                              hedge=None, cache=None):
+    """JSON reply for prompt, parsed; None when every attempt in the time left failed.
+
+    The API is asked for application/json (checked against schema when given).
+    Errors and unparseable replies are retried with full-jitter exponential
+    backoff, at most MAX_API_RETRIES times and never past the message deadline
+    (see message_deadline; API_TIMEOUT from now outside one). Each attempt's
+    RPC timeout is the time remaining. on_text streams the reply as in
+    stream_content_async. hedge (default: phase in HEDGED_PHASES) sends a
+    duplicate request when an attempt is slower than usual, see HedgePolicy.
+    cache (default: phase in LLM_CACHED_PHASES) serves byte-identical
+    requests from the LLM cache.
+    """
+    generation_config = {"response_mime_type": "application/json"}
+    if schema:
+        generation_config["response_schema"] = schema
+    if max_output_tokens:
+        generation_config["max_output_tokens"] = max_output_tokens
+    if hedge is None:
+        hedge = HEDGE_ENABLED and phase in HEDGED_PHASES
+    if cache is None:
+        cache = LLM_CACHE_ENABLED and phase in LLM_CACHED_PHASES
+    if not cache:
+        return await _generate_json(model, prompt, phase, generation_config, on_text, hedge)
+
+    async def generate():
+        reply = await _generate_json(model, prompt, phase, generation_config, on_text, hedge)
+        return None if reply is None else json.dumps(reply, ensure_ascii=False)
+
+    text = await get_llm_cache().get_or_generate(llm_cache_key(model, prompt, generation_config), generate)
+    return None if text is None else json.loads(text)
+
+
+async def _generate_json(model, prompt, phase, generation_config, on_text, hedge):
+    attempt_fn = _hedged_json_attempt if hedge else _json_attempt
+
+    def call(timeout, attempt):
+        kwargs = {"generation_config": generation_config, "request_options": {"timeout": timeout}}
+        return attempt_fn(model, prompt, phase, kwargs, on_text, attempt)
+
+    return await _retry_until_deadline(phase, call)
+
+
+async def _retry_until_deadline(phase, call):
+    """await call(timeout, attempt) until it succeeds; None once retries or the message deadline run out.
+
+    timeout is the time left before the deadline, passed on as the RPC
+    timeout; the attempt is also cancelled on our side when it runs out.
+    """
+    deadline = _deadline.get() or time.monotonic() + API_TIMEOUT
+
+    for attempt in range(MAX_API_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            return await asyncio.wait_for(call(remaining, attempt), remaining)
+        except NON_RETRYABLE_ERRORS as e:
+            logging.error(f"Error in {phase}, not retrying: {e}")
+            return None
+        except Exception as e:
+            logging.warning(f"Error in {phase} (attempt {attempt + 1}): {e!r}")
+        delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+        if attempt == MAX_API_RETRIES or time.monotonic() + delay >= deadline:
+            break
+        await asyncio.sleep(delay)
+    return None
+
+
+async def generate_text_async(model, prompt, phase="default", generation_config=None, cache=None):
+    """Reply text of a plain-text call; None when every attempt in the time left failed.
+
+    Retried and bounded by the message deadline like generate_json_async, so
+    a hung call can't hold a pool thread (or a scheduler run) forever.
+    Cached like generate_json_async (default: phase in LLM_CACHED_PHASES).
+    """
+    if cache is None:
+        cache = LLM_CACHE_ENABLED and phase in LLM_CACHED_PHASES
+
+    async def call(timeout, attempt):
+        response = await generate_content_async(
+            model, prompt, phase, attempt, generation_config=generation_config, request_options={"timeout": timeout}
+        )
+        return response.text
+
+    async def generate():
+        return await _retry_until_deadline(phase, call)
+
+    if not cache:
+        return await generate()
+    return await get_llm_cache().get_or_generate(llm_cache_key(model, prompt, generation_config), generate)
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(model_name=GEMINI_MODEL_NAME, system_instruction=None):
+    """Process-wide model per (backend, model name, system instruction).
+
+    The SDK caches its gRPC client per process, so sharing the model also
+    shares one long-lived channel (persistent HTTP/2 connection) across all
+    chats instead of rebuilding model objects per message. The static
+    instruction travels as system_instruction, and is context-cached when it
+    is large enough for the API to accept; the cache is recreated once its
+    TTL has run out. The backend is llm_backend.get_backend() (LLM_BACKEND).
+    """
+    backend = get_backend()
+    key = (backend, model_name, system_instruction)
+    entry = _models.get(key)
+    if entry is None or entry[1] <= time.monotonic():
+        with _models_lock:
+            entry = _models.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                entry = _models[key] = backend.create_model(model_name, system_instruction)
+    return entry[0]
@@ -0,0 +1,225 @@
+# Per-call token and latency accounting for model calls, as rolling histograms per phase
+#
+# Every generate_content call (each retry and hedge included) is recorded with
+# its phase, wall latency, time to first token, retry number and the token
+# counts from the response's usage_metadata; streamed replies add the time from
+# the user's message to the first visible text. Modules with their own live
+# state (hedging, the LLM cache) register collectors that are read at export.
+# dump() writes the last LLM_METRICS_WINDOW_SECONDS as JSON (*.json) or
+# Prometheus text exposition format (anything else).
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from config import LLM_METRICS_DUMP_SECONDS, LLM_METRICS_FILE, LLM_METRICS_WINDOW_SECONDS
+
+LATENCY_BUCKETS_SECONDS = (0.25, 0.5, 1, 2, 4, 8, 16, 32)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RETRY_BUCKETS = (0, 1, 2, 3)
+
+HISTOGRAMS = {
+    # name: (bucket upper bounds, help text, label)
+    "llm_call_latency_seconds": (LATENCY_BUCKETS_SECONDS, "Wall latency of one model call", "phase"),
+    "llm_first_token_seconds": (
+        LATENCY_BUCKETS_SECONDS, "Time to the first streamed text (the whole latency when not streamed)", "phase"
+    ),
+    "llm_prompt_tokens": (TOKEN_BUCKETS, "Input tokens per call (usage_metadata.prompt_token_count)", "phase"),
+    "llm_output_tokens": (TOKEN_BUCKETS, "Output tokens per call (usage_metadata.candidates_token_count)", "phase"),
+    "llm_call_retries": (RETRY_BUCKETS, "Retry number of the call (0 = first attempt)", "phase"),
+    "reply_first_visible_seconds": (
+        LATENCY_BUCKETS_SECONDS, "User message to the first visible text of a streamed reply", "kind"
+    ),
+}
+# JSON section per histogram label
+LABEL_SECTIONS = {"phase": "phases", "kind": "replies"}
+COUNTERS = {
+    "llm_calls_total": "Model calls, by outcome",
+    "llm_prompt_tokens_total": "Input tokens billed",
+    "llm_cached_tokens_total": "Input tokens served from a context cache",
+    "llm_output_tokens_total": "Output tokens billed",
+}
+# Read from registered collectors at export: name -> (type, help text)
+COLLECTED = {
+    "llm_hedges_total": ("counter", "Duplicate requests sent by request hedging"),
+    "llm_hedge_wins_total": ("counter", "Hedged requests that answered first"),
+    "llm_hedge_delay_seconds": ("gauge", "Current hedge delay (the phase's latency percentile)"),
+    "llm_cache_requests_total": ("counter", "LLM cache lookups, by result"),
+    "llm_cache_errors_total": ("counter", "LLM cache backend failures"),
+    "llm_cache_entries": ("gauge", "Entries in the in-process LLM cache"),
+}
+
+
+class RollingHistogram:
+    """Bucket counts over the last window_seconds, kept in `slots` time slices that age out"""
+
+    def __init__(self, bounds, window_seconds=LLM_METRICS_WINDOW_SECONDS, slots=60):
+        self.bounds = bounds
+        self.slot_seconds = window_seconds / slots
+        self._slots = [None] * slots  # (slot number, counts, sum) per slice
+
+    def _slot(self, now):
+        number = int(now // self.slot_seconds)
+        i = number % len(self._slots)
+        if self._slots[i] is None or self._slots[i][0] != number:
+            self._slots[i] = (number, [0] * (len(self.bounds) + 1), [0.0])
+        return self._slots[i]
+
+    def observe(self, value, now=None):
+        _, counts, total = self._slot(time.time() if now is None else now)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        total[0] += value
+
+    def snapshot(self, now=None):
+        """{"buckets": [(le, cumulative count)], "count", "sum"} over the window"""
+        oldest = int((time.time() if now is None else now) // self.slot_seconds) - len(self._slots) + 1
+        counts = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        for slot in self._slots:
+            if slot is not None and slot[0] >= oldest:
+                counts = [a + b for a, b in zip(counts, slot[1])]
+                total += slot[2][0]
+        cumulative, buckets = 0, []
+        for bound, count in zip(list(self.bounds) + ["+Inf"], counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"buckets": buckets, "count": cumulative, "sum": total}
+
+
+class LLMMetrics:
+    def __init__(self, window_seconds=LLM_METRICS_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, phase) -> RollingHistogram
+        self._counters = {}  # (name, phase, outcome) -> lifetime total
+        self._collectors = []
+
+    def register(self, collect):
+        """Add collect() -> [(name in COLLECTED, {label: value}, value)], called on every export"""
+        self._collectors.append(collect)
+
+    def _collected(self):
+        samples = []
+        for collect in self._collectors:
+            try:
+                samples.extend(collect())
+            except Exception as e:
+                logging.error(f"Metrics collector {collect.__name__} failed: {e}")
+        return samples
+
+    def _observe(self, name, phase, value):
+        key = (name, phase)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = RollingHistogram(HISTOGRAMS[name][0], self.window_seconds)
+        histogram.observe(value)
+
+    def _count(self, name, phase, amount, outcome=""):
+        key = (name, phase, outcome)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def record_call(self, phase, latency_s, usage=None, retries=0, ok=True, first_token_s=None):
+        """Record one call; usage is the response's usage_metadata (None when the call failed)"""
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        with self._lock:
+            self._count("llm_calls_total", phase, 1, "ok" if ok else "error")
+            self._observe("llm_call_latency_seconds", phase, latency_s)
+            self._observe("llm_call_retries", phase, retries)
+            if ok:
+                self._observe("llm_first_token_seconds", phase, latency_s if first_token_s is None else first_token_s)
+            if usage is not None:
+                self._observe("llm_prompt_tokens", phase, prompt_tokens)
+                self._observe("llm_output_tokens", phase, output_tokens)
+                self._count("llm_prompt_tokens_total", phase, prompt_tokens)
+                self._count("llm_cached_tokens_total", phase, cached_tokens)
+                self._count("llm_output_tokens_total", phase, output_tokens)
+
+    def record_visible_text(self, kind, seconds):
+        """Record when a streamed reply of this kind first showed text, seconds after the user's message"""
+        with self._lock:
+            self._observe("reply_first_visible_seconds", kind, seconds)
+
+    def to_dict(self):
+        sections = {section: {} for section in LABEL_SECTIONS.values()}
+        with self._lock:
+            phases = sections["phases"]
+            for (name, phase, outcome), value in sorted(self._counters.items()):
+                counters = phases.setdefault(phase, {"counters": {}, "histograms": {}})["counters"]
+                counters[f"{name}{'_' + outcome if outcome else ''}"] = value
+            for (name, label), histogram in sorted(self._histograms.items()):
+                snapshot = histogram.snapshot()
+                snapshot["buckets"] = {str(le): count for le, count in snapshot["buckets"]}
+                section = sections[LABEL_SECTIONS[HISTOGRAMS[name][2]]]
+                section.setdefault(label, {"counters": {}, "histograms": {}})["histograms"][name] = snapshot
+        collected = {}
+        for name, labels, value in self._collected():
+            collected.setdefault(name, []).append({"labels": labels, "value": value})
+        return {"generated_at": time.time(), "window_seconds": self.window_seconds, **sections, "collected": collected}
+
+    def to_prometheus(self):
+        """Prometheus text format; histograms cover the rolling window, counters the process lifetime"""
+        lines = []
+        with self._lock:
+            for name, help_text in COUNTERS.items():
+                series = [(k, v) for k, v in sorted(self._counters.items()) if k[0] == name]
+                if not series:
+                    continue
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for (_, phase, outcome), value in series:
+                    labels = f'phase="{phase}"' + (f',outcome="{outcome}"' if outcome else "")
+                    lines.append(f"{name}{{{labels}}} {value}")
+            for name, (_, help_text, label) in HISTOGRAMS.items():
+                series = [(k[1], h) for k, h in sorted(self._histograms.items()) if k[0] == name]
+                if not series:
+                    continue
+                lines += [f"# HELP {name} {help_text} (last {self.window_seconds}s)", f"# TYPE {name} histogram"]
+                for value, histogram in series:
+                    snapshot = histogram.snapshot()
+                    for le, count in snapshot["buckets"]:
+                        lines.append(f'{name}_bucket{{{label}="{value}",le="{le}"}} {count}')
+                    lines.append(f'{name}_sum{{{label}="{value}"}} {snapshot["sum"]}')
+                    lines.append(f'{name}_count{{{label}="{value}"}} {snapshot["count"]}')
+        samples = self._collected()
+        for name, (metric_type, help_text) in COLLECTED.items():
+            series = [(labels, value) for sample_name, labels, value in samples if sample_name == name]
+            if not series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+            for labels, value in series:
+                rendered = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=LLM_METRICS_FILE):
+        """Write the metrics to path atomically: JSON for *.json, Prometheus text otherwise"""
+        text = json.dumps(self.to_dict(), indent=2) if path.endswith(".json") else self.to_prometheus()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+llm_metrics = LLMMetrics()
+
+
+async def dump_periodically(path=LLM_METRICS_FILE, interval_seconds=LLM_METRICS_DUMP_SECONDS):
+    """Background task: rewrite the metrics file every interval_seconds"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            llm_metrics.dump(path)
+        except OSError as e:
+            logging.error(f"Could not write LLM metrics to {path}: {e}")
@@ -1,10 +1,11 @@
 import os
 import json
-import google.generativeai as genai
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from supabase import create_client, Client
 from dotenv import load_dotenv
+from llm_backend import get_backend
+from llm_client import generate_json_async, get_model
+from user_store import get_user_store
 
 load_dotenv()
 
@@ -14,8 +15,7 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-genai.configure(api_key=GEMINI_API_KEY)
-# supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+get_backend().configure(GEMINI_API_KEY)
 
 # --- THE AGENT'S SOUL ---
 GOD_PROMPT = """
@@ -41,7 +41,8 @@ You are "Catalyst", an AI mindset coach. Your purpose is to logically guide the
 """
 
 async def get_agent_response(chat_id, user_message, user_data):
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    # GOD_PROMPT is the static system instruction; only the user's state and message vary per turn
+    model = get_model(system_instruction=GOD_PROMPT)
 
     # Construct a prompt for the model
     prompt = f"""
@@ -50,35 +51,23 @@ async def get_agent_response(chat_id, user_message, user_data):
 
     The user's latest message is: "{user_message}"
 
-    Follow the logic in your core instructions (the GOD_PROMPT) to generate the next response.
+    Follow the logic in your system instructions to generate the next response.
     """
 
-    full_prompt = GOD_PROMPT + "\n" + prompt
-
-    try:
-        response = model.generate_content(full_prompt)
-        # Clean the response to be valid JSON
-        cleaned_response_text = response.text.strip().replace("```json", "").replace("```", "")
-        return json.loads(cleaned_response_text)
-    except Exception as e:
-        print(f"Error parsing AI response: {e}")
-        print(f"Raw response was: {response.text}")
-        return None
+    # JSON mode without a schema: updated_user_data is free-form. Failed or
+    # malformed replies are retried within API_TIMEOUT
+    return await generate_json_async(model, prompt, "agent_response")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    store = get_user_store()
     chat_id = update.message.chat_id
     user_message = update.message.text
 
     await context.bot.send_chat_action(chat_id=chat_id, action='typing')
 
     # 1. Fetch user data
-    db_response = supabase.table('users').select("user_data").eq('chat_id', chat_id).execute()
-
-    user_data = {}
-    if db_response.data:
-        user_data = db_response.data[0]['user_data']
-    else:
+    user_data = stored = await store.fetch(chat_id)
+    if user_data is None:
         # New user
         user_data = {"onboarding_step": "start"}
 
@@ -97,10 +86,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 4. Save updated state to database
     if updated_data:
-        supabase.table('users').upsert({
-            'chat_id': chat_id,
-            'user_data': updated_data
-        }).execute()
+        # only the changes to the stored document are sent
+        await store.save(chat_id, updated_data, stored)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,23 @@
 import asyncio
 import schedule
-import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
-import json
-from supabase import create_client, Client
 from dotenv import load_dotenv
-import google.generativeai as genai
-from config import DAILY_CHECK_IN_TIMES, RESPONSE_TEMPLATES, SYSTEM_NAME
+from config import (
+    DAILY_CHECK_IN_TIMES,
+    RESPONSE_TEMPLATES,
+    SYSTEM_NAME,
+    RAG_ENABLED,
+    RAG_MAX_CONTEXT_CHARS,
+    RAG_TOP_K,
+    MAX_OUTPUT_TOKENS,
+)
+from context_packer import projected_json
+from knowledge_index import retrieve_packed_batch
+from llm_backend import get_backend
+from llm_client import generate_json_async, generate_text_async, get_model
+from llm_metrics import dump_periodically
+from user_store import get_user_store
 
 load_dotenv()
 
@@ -17,33 +27,142 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-genai.configure(api_key=GEMINI_API_KEY)
+get_backend().configure(GEMINI_API_KEY)
+
+# Static scheduler instructions, sent as each model's system_instruction
+MORNING_CHECK_IN_INSTRUCTION = """
+Create a personalized morning check-in message for the user described in the prompt.
+
+The message should:
+1. Be motivating and personalized to their personality
+2. Present today's tasks in an engaging way
+3. Be concise and conversational
+4. Match their communication style
+
+Return only the message text, no JSON.
+"""
+
+EVENING_REFLECTION_INSTRUCTION = """
+Create a personalized evening reflection prompt for the user described in the prompt.
+
+The prompt should:
+1. Ask about today's task completion
+2. Encourage reflection on the day
+3. Be supportive regardless of completion status
+4. Match their communication style
+
+Return only the prompt text, no JSON.
+"""
+
+DAILY_PLAN_INSTRUCTION = """
+Generate a new daily plan for tomorrow based on the user's personality and goals.
+
+Create 3-4 tasks that:
+1. Balance physical, emotional, and mental development
+2. Match their personality traits
+3. Progress toward their goals
+4. Are specific and actionable
+
+Return JSON with:
+{
+    "daily_plan": {
+        "date": "YYYY-MM-DD",
+        "tasks": [
+            {
+                "id": 1,
+                "type": "physical|emotional|mental",
+                "title": "Task title",
+                "description": "Detailed description",
+                "difficulty": "easy|medium|hard"
+            }
+        ],
+        "motivation_message": "Personalized motivation"
+    }
+}
+"""
+
+DAILY_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "daily_plan": {
+            "type": "object",
+            "properties": {
+                "date": {"type": "string"},
+                "tasks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "type": {"type": "string", "enum": ["physical", "emotional", "mental"]},
+                            "title": {"type": "string"},
+                            "description": {"type": "string"},
+                            "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]},
+                        },
+                        "required": ["id", "type", "title", "description", "difficulty"],
+                    },
+                },
+                "motivation_message": {"type": "string"},
+            },
+            "required": ["date", "tasks", "motivation_message"],
+        },
+    },
+    "required": ["daily_plan"],
+}
+
+def plan_context_query(user_data):
+    """Retrieval query for plan generation: the user's goals, obstacles and current tasks"""
+    goals = user_data.get('goals', {})
+    tasks = user_data.get('daily_plan', {}).get('tasks', [])
+    parts = [
+        str(goals.get('vision_statement', '')),
+        str(goals.get('weaknesses', '')),
+        str(goals.get('bad_habits', '')),
+    ]
+    parts.extend(t.get('title', '') for t in tasks if isinstance(t, dict))
+    return " ".join(parts)
+
+def retrieve_plan_contexts(users_data):
+    """Knowledge context for many users in one retrieval pass (vectorized with RAG_BACKEND = "tfidf")"""
+    if not RAG_ENABLED or not users_data:
+        return ["" for _ in users_data]
+    try:
+        queries = [plan_context_query(user_data) for user_data in users_data]
+        return retrieve_packed_batch(queries, RAG_TOP_K, RAG_MAX_CONTEXT_CHARS)
+    except Exception as e:
+        print(f"Error retrieving plan contexts: {e}")
+        return ["" for _ in users_data]
 
 class DailyScheduler:
     def __init__(self):
-        self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.morning_model = get_model(system_instruction=MORNING_CHECK_IN_INSTRUCTION)
+        self.evening_model = get_model(system_instruction=EVENING_REFLECTION_INSTRUCTION)
+        self.plan_model = get_model(system_instruction=DAILY_PLAN_INSTRUCTION)
+        # the event loop only keeps weak references to tasks; these keep runs alive until they finish
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        """Run coro as a task that can't be garbage-collected mid-flight"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
         
     async def send_morning_check_in(self, chat_id, user_data):
         """Send morning check-in with daily tasks"""
         try:
             # Generate personalized morning message
             morning_prompt = f"""
-            Create a personalized morning check-in message for the user.
-            
-            User Data: {json.dumps(user_data, indent=2)}
-            
-            The message should:
-            1. Be motivating and personalized to their personality
-            2. Present today's tasks in an engaging way
-            3. Be concise and conversational
-            4. Match their communication style
-            
-            Return only the message text, no JSON.
+            User Data: {projected_json("morning_check_in", user_data)}
             """
             
-            response = self.model.generate_content(morning_prompt)
-            morning_message = response.text.strip()
+            morning_text = await generate_text_async(
+                self.morning_model, morning_prompt, "morning_check_in",
+                generation_config={"max_output_tokens": MAX_OUTPUT_TOKENS["morning_check_in"]},
+            )
+            if not morning_text:
+                return None
+            morning_message = morning_text.strip()
             
             # Send via Telegram (you'll need to implement this)
             print(f"Morning check-in for {chat_id}: {morning_message}")
@@ -59,21 +178,16 @@ class DailyScheduler:
         try:
             # Generate personalized evening reflection
             evening_prompt = f"""
-            Create a personalized evening reflection prompt for the user.
-            
-            User Data: {json.dumps(user_data, indent=2)}
-            
-            The prompt should:
-            1. Ask about today's task completion
-            2. Encourage reflection on the day
-            3. Be supportive regardless of completion status
-            4. Match their communication style
-            
-            Return only the prompt text, no JSON.
+            User Data: {projected_json("evening_reflection", user_data)}
             """
             
-            response = self.model.generate_content(evening_prompt)
-            evening_message = response.text.strip()
+            evening_text = await generate_text_async(
+                self.evening_model, evening_prompt, "evening_reflection",
+                generation_config={"max_output_tokens": MAX_OUTPUT_TOKENS["evening_reflection"]},
+            )
+            if not evening_text:
+                return None
+            evening_message = evening_text.strip()
             
             # Send via Telegram (you'll need to implement this)
             print(f"Evening reflection for {chat_id}: {evening_message}")
@@ -84,109 +198,99 @@ class DailyScheduler:
             print(f"Error sending evening reflection: {e}")
             return None
     
-    async def generate_new_daily_plan(self, user_data):
+    async def generate_new_daily_plan(self, user_data, rag_context=""):
         """Generate new daily plan for tomorrow"""
         try:
             plan_prompt = f"""
-            Generate a new daily plan for tomorrow based on the user's personality and goals.
-            
-            User Data: {json.dumps(user_data, indent=2)}
-            
-            Create 3-4 tasks that:
-            1. Balance physical, emotional, and mental development
-            2. Match their personality traits
-            3. Progress toward their goals
-            4. Are specific and actionable
-            
-            Return JSON with:
-            {{
-                "daily_plan": {{
-                    "date": "YYYY-MM-DD",
-                    "tasks": [
-                        {{
-                            "id": 1,
-                            "type": "physical|emotional|mental",
-                            "title": "Task title",
-                            "description": "Detailed description",
-                            "difficulty": "easy|medium|hard"
-                        }}
-                    ],
-                    "motivation_message": "Personalized motivation"
-                }}
-            }}
+            User Data: {projected_json("daily_plan", user_data)}
+            Retrieved Coaching Knowledge (optional):\n{rag_context}
             """
             
-            response = self.model.generate_content(plan_prompt)
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-            return json.loads(cleaned_response)
+            return await generate_json_async(
+                self.plan_model, plan_prompt, "daily_plan", DAILY_PLAN_SCHEMA, MAX_OUTPUT_TOKENS["daily_plan"]
+            )
             
         except Exception as e:
             print(f"Error generating daily plan: {e}")
             return None
     
+    async def process_user(self, chat_id, user_data, current_hour, rag_context=""):
+        """Morning or evening check-in for one user in the daily execution phase"""
+        try:
+            # Morning check-in (around 9 AM)
+            if current_hour == 9:
+                await self.send_morning_check_in(chat_id, user_data)
+            
+            # Evening reflection (around 8 PM)
+            elif current_hour == 20:
+                await self.send_evening_reflection(chat_id, user_data)
+                
+                # Generate new plan for tomorrow
+                new_plan = await self.generate_new_daily_plan(user_data, rag_context)
+                if new_plan:
+                    # Update database: only daily_plan changed, so this goes out as a patch
+                    updated_data = {**user_data, 'daily_plan': new_plan['daily_plan']}
+                    await get_user_store().save_changes([(chat_id, user_data, updated_data)])
+                    
+                    print(f"Generated new plan for user {chat_id}")
+        except Exception as e:
+            print(f"Error processing user {chat_id}: {e}")
+    
     async def process_all_users(self):
         """Process all active users for daily check-ins"""
         try:
             # Get all users from database
-            response = self.supabase.table('users').select("*").execute()
+            users = await get_user_store().fetch_all()
             
-            if not response.data:
+            if not users:
                 print("No users found for daily processing")
                 return
             
             current_time = datetime.now()
             current_hour = current_time.hour
             
-            for user in response.data:
-                chat_id = user['chat_id']
-                user_data = user.get('user_data', {})
-                
-                # Check if user is in daily execution phase
-                onboarding_step = user_data.get('onboarding', {}).get('current_step')
-                if onboarding_step != 'complete':
-                    continue
-                
-                # Morning check-in (around 9 AM)
-                if current_hour == 9:
-                    await self.send_morning_check_in(chat_id, user_data)
-                
-                # Evening reflection (around 8 PM)
-                elif current_hour == 20:
-                    await self.send_evening_reflection(chat_id, user_data)
-                    
-                    # Generate new plan for tomorrow
-                    new_plan = await self.generate_new_daily_plan(user_data)
-                    if new_plan:
-                        user_data['daily_plan'] = new_plan['daily_plan']
-                        
-                        # Update database
-                        self.supabase.table('users').upsert({
-                            'chat_id': chat_id,
-                            'user_data': user_data
-                        }).execute()
-                        
-                        print(f"Generated new plan for user {chat_id}")
+            # Only users in the daily execution phase get check-ins
+            active_users = [
+                (user['chat_id'], user.get('user_data', {}))
+                for user in users
+                if user.get('user_data', {}).get('onboarding', {}).get('current_step') == 'complete'
+            ]
+            
+            # Retrieve plan context for every user in one batch before the per-user loop
+            plan_contexts = [""] * len(active_users)
+            if current_hour == 20:
+                plan_contexts = retrieve_plan_contexts([user_data for _, user_data in active_users])
+            
+            # Users are processed concurrently; LLM_MAX_CONCURRENT_CALLS bounds the Gemini fan-out
+            await asyncio.gather(*[
+                self.process_user(chat_id, user_data, current_hour, rag_context)
+                for (chat_id, user_data), rag_context in zip(active_users, plan_contexts)
+            ])
                 
         except Exception as e:
             print(f"Error processing users: {e}")
     
-    def run_scheduler(self):
+    async def run_scheduler(self):
         """Run the scheduler"""
         print("Starting daily scheduler...")
         
-        # Schedule daily processing
-        schedule.every().hour.do(self.process_all_users)
+        # Schedule daily processing on this event loop
+        schedule.every().hour.do(lambda: self._spawn(self.process_all_users()))
+        metrics_task = self._spawn(dump_periodically())
         
-        while True:
-            schedule.run_pending()
-            time.sleep(60)  # Check every minute
+        try:
+            while True:
+                schedule.run_pending()
+                await asyncio.sleep(60)  # Check every minute
+        finally:
+            metrics_task.cancel()
 
 async def main():
     """Main function to run the scheduler"""
     scheduler = DailyScheduler()
     
     # Run the scheduler
-    scheduler.run_scheduler()
+    await scheduler.run_scheduler()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,96 @@
+# Work started before it is asked for, kept per chat and used only while its inputs still match
+
+import asyncio
+import logging
+import time
+
+from config import PLAN_SPECULATION_TTL_SECONDS
+
+
+class _Speculation:
+    def __init__(self, key, expires_at):
+        self.key = key
+        self.expires_at = expires_at
+        self.task = None
+        self.text = None  # latest streamed text, replayed to a late subscriber
+        self.on_text = None
+
+    async def relay(self, text):
+        self.text = text
+        if self.on_text:
+            await self.on_text(text)
+
+    async def subscribe(self, on_text):
+        text, self.on_text = self.text, on_text
+        if text:
+            await on_text(text)
+
+
+class Speculator:
+    """One speculative background task per chat, keyed by the inputs it was started from.
+
+    start(chat_id, key, factory) runs factory(on_text) as a task. take() with
+    the same key awaits that task instead of doing the work again; with any
+    other key the task is stale, so it is cancelled and take() returns None.
+    Text the task streams before anyone takes it is buffered and replayed, so
+    a speculative model call can still stream into the reply that shows it.
+    """
+
+    def __init__(self, ttl_seconds=PLAN_SPECULATION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}  # chat_id -> _Speculation
+        self.started = 0
+        self.used = 0
+        self.stale = 0
+        self.expired = 0
+
+    def _drop(self, chat_id):
+        entry = self._entries.pop(chat_id)
+        entry.task.cancel()
+
+    def start(self, chat_id, key, factory):
+        """Start factory(on_text) for chat_id unless a task for the same key is already there"""
+        now = time.monotonic()
+        for other in [c for c, e in self._entries.items() if e.expires_at <= now]:
+            self._drop(other)
+            self.expired += 1
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            if entry.key == key:
+                return
+            self._drop(chat_id)
+            self.stale += 1
+        entry = self._entries[chat_id] = _Speculation(key, now + self.ttl_seconds)
+        entry.task = asyncio.ensure_future(factory(entry.relay))
+        # failures surface through take(); a task nobody takes must not log "never retrieved"
+        entry.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self.started += 1
+
+    async def take(self, chat_id, key, on_text=None):
+        """The result of the chat's task for key (awaited if still running), or None if there is none, it is stale or it failed"""
+        entry = self._entries.pop(chat_id, None)
+        if entry is None:
+            return None
+        if entry.key != key or entry.expires_at <= time.monotonic():
+            entry.task.cancel()
+            self.stale += 1
+            return None
+        self.used += 1
+        if on_text:
+            await entry.subscribe(on_text)
+        try:
+            return await entry.task
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Speculative task for chat {chat_id} failed: {e}")
+            return None
+
+    def stats(self):
+        return {
+            "pending": len(self._entries),
+            "started": self.started,
+            "used": self.used,
+            "stale": self.stale,
+            "expired": self.expired,
+        }
@@ -0,0 +1,114 @@
+# Progressive Telegram replies: show streamed model output while it is still being generated
+
+import json
+import logging
+import re
+import time
+
+from config import MAX_QUESTIONS_PER_REPLY, STREAM_EDIT_INTERVAL_SECONDS, STREAM_MIN_FIRST_CHARS
+from llm_metrics import llm_metrics
+
+TELEGRAM_MAX_MESSAGE_CHARS = 4096
+
+_COMPLETE_STRING = r'"((?:[^"\\]|\\.)*)"'
+
+
+def partial_json_string(raw, key):
+    """Decoded prefix of the string value of key in a partially streamed JSON object, or None"""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), raw)
+    if not match:
+        return None
+    start = end = match.end()
+    # stop before a closing quote or an escape sequence that hasn't fully arrived
+    while end < len(raw) and raw[end] != '"':
+        if raw[end] == "\\":
+            step = 6 if raw[end + 1 : end + 2] == "u" else 2
+            if end + step > len(raw):
+                break
+            end += step
+        else:
+            end += 1
+    try:
+        text = json.loads(f'"{raw[start:end]}"')
+    except ValueError:
+        return None
+    # drop the first half of an emoji's surrogate pair until the second half arrives
+    if text and "\ud800" <= text[-1] <= "\udbff":
+        text = text[:-1]
+    return text
+
+
+def limit_questions(text):
+    """Cut text after its first question mark when it asks more than MAX_QUESTIONS_PER_REPLY"""
+    if text.count('?') > MAX_QUESTIONS_PER_REPLY:
+        first_q_idx = text.find('?')
+        if first_q_idx != -1:
+            text = text[: first_q_idx + 1]
+    return text
+
+
+def visible_reply_text(raw):
+    """What to show of a streaming accountability reply: reply_to_user so far"""
+    text = partial_json_string(raw, "reply_to_user")
+    return limit_questions(text) if text else None
+
+
+def visible_plan_text(raw):
+    """What to show of a streaming plan: the titles of the tasks completed so far"""
+    titles = [json.loads(f'"{title}"') for title in re.findall(r'"title"\s*:\s*' + _COMPLETE_STRING, raw)]
+    if not titles:
+        return None
+    return "Building your plan...\n" + "\n".join(f"• {title}" for title in titles)
+
+
+class ProgressiveReply:
+    """One Telegram message that is sent early and edited as the reply streams in.
+
+    update() is rate-limited to one edit per STREAM_EDIT_INTERVAL_SECONDS;
+    finish() always delivers the final text, sending the message if nothing
+    was shown yet.
+    """
+
+    def __init__(self, bot, chat_id, kind, started=None, interval=STREAM_EDIT_INTERVAL_SECONDS):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.kind = kind
+        self.started = time.monotonic() if started is None else started
+        self.interval = interval
+        self.message = None
+        self._shown = None
+        self._next_edit = 0.0
+
+    def _record_first_visible(self):
+        # time from the user's message to the first text they can read (reply_first_visible_seconds)
+        llm_metrics.record_visible_text(self.kind, time.monotonic() - self.started)
+
+    async def _show(self, text):
+        text = text[:TELEGRAM_MAX_MESSAGE_CHARS]
+        if self.message is None:
+            self.message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+            self._record_first_visible()
+        else:
+            await self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message.message_id)
+        self._shown = text
+        self._next_edit = time.monotonic() + self.interval
+
+    async def update(self, text):
+        """Show partial text if it is new, long enough and the edit interval has passed"""
+        if not text or text == self._shown or time.monotonic() < self._next_edit:
+            return
+        if self.message is None and len(text) < STREAM_MIN_FIRST_CHARS:
+            return
+        try:
+            await self._show(text)
+        except Exception as e:
+            # flood control or a transient error: skip this frame, finish() sends the final text
+            retry_after = getattr(e, "retry_after", 0)
+            retry_after = getattr(retry_after, "total_seconds", lambda: retry_after)()
+            self._next_edit = time.monotonic() + max(self.interval, retry_after or 0)
+            logging.warning(f"Streaming update to {self.chat_id} skipped: {e}")
+
+    async def finish(self, text):
+        """Make text the final content of the message"""
+        if text != self._shown:
+            await self._show(text)
@@ -0,0 +1,150 @@
+# json_patch.rebase and the WriteBehindUserStore flush, against an in-memory users table
+#
+# Usage: python -m pytest tests
+
+import asyncio
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_patch
+from user_store import WriteBehindUserStore
+
+
+class MemoryUserStore:
+    """The UserStore interface over a dict; patches are applied to the current row like patch_user_data"""
+
+    def __init__(self, rows=None):
+        self.loop = asyncio.get_running_loop()
+        self.rows = copy.deepcopy(rows or {})
+        self.fail_chats = set()  # save_changes raises for a batch containing one of these
+        self.before_write = None  # awaited inside save_changes, before anything is stored
+
+    async def fetch(self, chat_id):
+        return copy.deepcopy(self.rows.get(chat_id))
+
+    async def fetch_many(self, chat_ids):
+        return {chat_id: copy.deepcopy(self.rows[chat_id]) for chat_id in chat_ids if chat_id in self.rows}
+
+    async def save_changes(self, rows):
+        if self.before_write:
+            await self.before_write()
+        if any(chat_id in self.fail_chats for chat_id, *_ in rows):
+            raise ConnectionError("users table unavailable")
+        for chat_id, base, user_data in rows:
+            if base is None or chat_id not in self.rows:
+                self.rows[chat_id] = copy.deepcopy(user_data)
+            else:
+                self.rows[chat_id] = json_patch.apply(self.rows[chat_id], json_patch.diff(base, user_data))
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_rebase_keeps_both_sides_changes():
+    base = {"last_seen": "8", "daily_plan": {"tasks": ["old"]}}
+    theirs = {"last_seen": "8", "daily_plan": {"tasks": ["new"]}}
+    mine = {"last_seen": "21", "daily_plan": {"tasks": ["old"]}}
+    assert json_patch.rebase(base, theirs, mine) == {"last_seen": "21", "daily_plan": {"tasks": ["new"]}}
+
+
+def test_rebase_conflict_keeps_theirs():
+    base = {"daily_plan": {"tasks": [{"id": 1, "completed": False}]}}
+    theirs = {"daily_plan": {"tasks": [{"id": 2, "completed": False}]}}
+    mine = {"daily_plan": {"tasks": [{"id": 1, "completed": True}]}}
+    assert json_patch.rebase(base, theirs, mine) == theirs
+
+
+def test_rebase_nested_key_removal():
+    base = {"goals": {"weaknesses": "focus", "bad_habits": "phone"}, "user_info": {"name": "Sam"}}
+    # they drop a nested key, I change a sibling and remove another nested key
+    theirs = {"goals": {"weaknesses": "focus"}, "user_info": {"name": "Sam"}}
+    mine = {"goals": {"weaknesses": "sleep", "bad_habits": "phone"}, "user_info": {}}
+    assert json_patch.rebase(base, theirs, mine) == {"goals": {"weaknesses": "sleep"}, "user_info": {}}
+    # a change inside a subtree they removed is dropped
+    theirs = {"user_info": {"name": "Sam"}}
+    assert json_patch.rebase(base, theirs, mine) == {"user_info": {}}
+
+
+def test_scheduler_write_between_fetch_and_flush():
+    async def scenario():
+        store = MemoryUserStore({1: {"last_seen": "8", "daily_plan": {"tasks": ["old"]}}})
+        cache = WriteBehindUserStore(store)
+        user_data = await cache.fetch(1)
+        # the scheduler (another process) writes tomorrow's plan
+        store.rows[1]["daily_plan"] = {"tasks": ["new"]}
+        user_data["last_seen"] = "21"
+        await cache.save(1, user_data)
+        await cache.flush()
+        return store, cache
+
+    store, cache = run(scenario())
+    expected = {"last_seen": "21", "daily_plan": {"tasks": ["new"]}}
+    assert store.rows[1] == expected
+    assert run(cache.fetch(1)) == expected
+    assert cache.rebased_rows == 1
+
+
+def test_save_during_flush_stays_dirty_and_is_rebased():
+    async def scenario():
+        store = MemoryUserStore({1: {"count": 0, "daily_plan": {"tasks": ["old"]}}})
+        cache = WriteBehindUserStore(store)
+        user_data = await cache.fetch(1)
+        user_data["count"] = 1
+        await cache.save(1, user_data)
+        # the scheduler writes after the chat's fetch, and the chat saves again while the flush writes
+        store.rows[1]["daily_plan"] = {"tasks": ["new"]}
+
+        async def save_meanwhile():
+            store.before_write = None
+            await cache.save(1, {**user_data, "count": 2})
+
+        store.before_write = save_meanwhile
+        await cache.flush()
+        assert cache.stats()["dirty"] == 1
+        await cache.flush()
+        return store, cache
+
+    store, cache = run(scenario())
+    assert store.rows[1] == {"count": 2, "daily_plan": {"tasks": ["new"]}}
+    assert cache.stats()["dirty"] == 0
+
+
+def test_failed_batch_does_not_hold_back_the_others():
+    async def scenario():
+        store = MemoryUserStore({chat_id: {"n": 0} for chat_id in range(4)})
+        cache = WriteBehindUserStore(store, batch_size=2)
+        for chat_id in range(4):
+            await cache.save(chat_id, {"n": 1})
+        store.fail_chats = {0}
+        await cache.flush()
+        return store, cache
+
+    store, cache = run(scenario())
+    assert [store.rows[chat_id]["n"] for chat_id in range(4)] == [0, 0, 1, 1]
+    assert cache.flush_errors == 1
+    assert cache.stats()["dirty"] == 2
+
+
+def test_close_retries_then_logs_unsaved_rows(caplog):
+    async def scenario():
+        store = MemoryUserStore()
+        cache = WriteBehindUserStore(store)
+        await cache.save(1, {"n": 1})
+        await cache.save(2, {"n": 1})
+        store.fail_chats = {2}
+        await cache.close()
+        return store
+
+    store = run(scenario())
+    assert store.rows == {}  # both chats share the failing batch
+    assert "User state of 2 chats could not be saved before shutdown: [1, 2]" in caplog.text
@@ -0,0 +1,119 @@
+# Vectorized TF-IDF retrieval over the knowledge chunks (optional NumPy backend)
+
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # the BM25 backend in knowledge_index needs nothing beyond the stdlib
+    np = None
+
+from knowledge_index import index_terms
+
+# Queries are vectorized this many at a time so a batch of thousands of users
+# never materializes one huge dense query matrix
+BATCH_BLOCK_SIZE = 1024
+
+
+class TfidfRetriever:
+    """L2-normalised TF-IDF matrix over the chunks of a KnowledgeIndex.
+
+    The matrix has one row per chunk and one column per corpus term. The
+    knowledge base is a few dozen playbooks, so a dense float32 matrix is both
+    smaller and faster than a sparse layout here. One query is one
+    matrix-vector product, a batch of queries is one matrix-matrix product
+    per BATCH_BLOCK_SIZE queries. The matrix is rebuilt lazily whenever the
+    underlying index swaps in a new snapshot.
+    """
+
+    def __init__(self, index):
+        if np is None:
+            raise ImportError("numpy is required for the tfidf retrieval backend")
+        self.index = index
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _build(self, chunks):
+        chunk_ids = sorted(chunks)
+        vocabulary = {}
+        for chunk_id in chunk_ids:
+            for term in chunks[chunk_id]["tf"]:
+                vocabulary.setdefault(term, len(vocabulary))
+        matrix = np.zeros((len(chunk_ids), max(len(vocabulary), 1)), dtype=np.float32)
+        for row, chunk_id in enumerate(chunk_ids):
+            for term, tf in chunks[chunk_id]["tf"].items():
+                matrix[row, vocabulary[term]] = 1.0 + np.log(tf)
+        df = np.count_nonzero(matrix, axis=0)
+        idf = (np.log((1.0 + len(chunk_ids)) / (1.0 + df)) + 1.0).astype(np.float32)
+        matrix *= idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        return {
+            "source": chunks,
+            "chunk_ids": chunk_ids,
+            "vocabulary": vocabulary,
+            "idf": idf,
+            "matrix": matrix,
+        }
+
+    def _current(self):
+        chunks = self.index.chunks
+        state = self._state
+        if state is None or state["source"] is not chunks:
+            with self._lock:
+                state = self._state
+                if state is None or state["source"] is not chunks:
+                    state = self._state = self._build(chunks)
+        return state
+
+    def _vectorize(self, state, queries):
+        vocabulary = state["vocabulary"]
+        vectors = np.zeros((len(queries), state["matrix"].shape[1]), dtype=np.float32)
+        for row, query in enumerate(queries):
+            # binary query terms: repeats don't change the ranking, which keeps results
+            # consistent with the keyword-set keys of the retrieval cache
+            for term in set(index_terms(query)):
+                col = vocabulary.get(term)
+                if col is not None:
+                    vectors[row, col] = 1.0
+        # idf weighting, same as the chunk rows; the query norm is a per-row
+        # constant and doesn't change the ranking, so it is skipped
+        vectors *= state["idf"]
+        return vectors
+
+    def _top_k(self, state, scores, top_k):
+        """Best top_k columns of each row of a (queries x chunks) score matrix, selected in NumPy"""
+        chunks = state["source"]
+        chunk_ids = state["chunk_ids"]
+        k = min(top_k, scores.shape[1])
+        if k < scores.shape[1]:
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(k), scores.shape)
+        # sort the k candidates by score, ties to the earlier chunk (matches the BM25 backend)
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.lexsort((candidates, -candidate_scores), axis=1)
+        rows = np.take_along_axis(candidates, order, axis=1)
+        row_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        return [
+            [(chunks[chunk_ids[row]], float(score)) for row, score in zip(ranked, ranked_scores) if score > 0]
+            for ranked, ranked_scores in zip(rows.tolist(), row_scores.tolist())
+        ]
+
+    def search(self, query, top_k=5):
+        """Top-k (chunk, TF-IDF score) pairs for one query: a single matrix-vector product"""
+        state = self._current()
+        if not state["chunk_ids"] or top_k <= 0:
+            return []
+        vector = self._vectorize(state, [query])[0]
+        return self._top_k(state, (state["matrix"] @ vector)[np.newaxis, :], top_k)[0]
+
+    def search_batch(self, queries, top_k=5):
+        """search() for many queries at once, one matrix-matrix product per block"""
+        state = self._current()
+        if not state["chunk_ids"] or top_k <= 0:
+            return [[] for _ in queries]
+        results = []
+        for start in range(0, len(queries), BATCH_BLOCK_SIZE):
+            block = self._vectorize(state, queries[start : start + BATCH_BLOCK_SIZE])
+            results.extend(self._top_k(state, block @ state["matrix"].T, top_k))
+        return results
@@ -0,0 +1,340 @@
+# Process-wide async access to the Supabase users table over one pooled, keep-alive HTTP client
+
+import asyncio
+import collections
+import copy
+import json
+import logging
+import os
+import time
+
+import httpx
+from supabase import AsyncClientOptions, acreate_client
+
+import json_patch
+
+from config import (
+    DB_KEEPALIVE_SECONDS,
+    DB_MAX_CONNECTIONS,
+    DB_TIMEOUT_SECONDS,
+    DELTA_MAX_RATIO,
+    DELTA_PERSISTENCE_ENABLED,
+    USER_CACHE_BATCH_SIZE,
+    USER_CACHE_ENABLED,
+    USER_CACHE_FLUSH_SECONDS,
+    USER_CACHE_MAX_DIRTY,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL_SECONDS,
+)
+
+
+class UserStore:
+    """users table reads and writes for one event loop.
+
+    The Supabase client is created once, on first use, around an
+    httpx.AsyncClient whose connections stay open for DB_KEEPALIVE_SECONDS,
+    so a message costs a round trip on an open connection instead of a new
+    client plus TCP/TLS setup. Every call is awaited on the event loop.
+    """
+
+    def __init__(self, url=None, key=None):
+        self.url = url or os.getenv("SUPABASE_URL")
+        self.key = key or os.getenv("SUPABASE_KEY")
+        self.loop = asyncio.get_running_loop()
+        self._client = None
+        self._http = None
+        self._lock = asyncio.Lock()
+        # cleared when the patch_user_data RPC is not installed: full writes from then on
+        self.deltas_enabled = DELTA_PERSISTENCE_ENABLED
+        self.patched_rows = 0
+        self.full_rows = 0
+        self.bytes_sent = 0
+        self.full_bytes = 0  # what full writes of the same rows would have sent
+
+    async def _table(self):
+        await self._connect()
+        return self._client.table("users")
+
+    async def _connect(self):
+        if self._client is None:
+            async with self._lock:
+                if self._client is None:
+                    self._http = httpx.AsyncClient(
+                        timeout=DB_TIMEOUT_SECONDS,
+                        limits=httpx.Limits(
+                            max_connections=DB_MAX_CONNECTIONS,
+                            max_keepalive_connections=DB_MAX_CONNECTIONS,
+                            keepalive_expiry=DB_KEEPALIVE_SECONDS,
+                        ),
+                    )
+                    self._client = await acreate_client(self.url, self.key, AsyncClientOptions(httpx_client=self._http))
+
+    async def fetch(self, chat_id):
+        """The chat's user_data, or None for a chat without a row"""
+        response = await (await self._table()).select("user_data").eq("chat_id", chat_id).execute()
+        return response.data[0]["user_data"] if response.data else None
+
+    async def fetch_many(self, chat_ids):
+        """{chat_id: user_data} for the chats of chat_ids that have a row, in one request"""
+        response = await (await self._table()).select("chat_id, user_data").in_("chat_id", list(chat_ids)).execute()
+        return {row["chat_id"]: row["user_data"] for row in response.data}
+
+    async def fetch_all(self):
+        """Every row of the users table"""
+        response = await (await self._table()).select("*").execute()
+        return response.data
+
+    async def save(self, chat_id, user_data, base=None):
+        """Store user_data; with base (the fetched document it was made from) only the changes are sent"""
+        if base is not None:
+            return await self.save_changes([(chat_id, base, user_data)])
+        await (await self._table()).upsert({"chat_id": chat_id, "user_data": user_data}).execute()
+
+    async def save_many(self, rows):
+        """Upsert [(chat_id, user_data), ...] in one multi-row request"""
+        await (await self._table()).upsert(
+            [{"chat_id": chat_id, "user_data": user_data} for chat_id, user_data in rows]
+        ).execute()
+
+    async def save_changes(self, rows):
+        """Persist [(chat_id, base, user_data), ...] where base is the stored document user_data was made from.
+
+        Rows with a known base are sent as JSON patches through the
+        patch_user_data RPC (json_patch.PATCH_USER_DATA_SQL) when the patch is
+        at most DELTA_MAX_RATIO of the document; the rest, chats without a
+        stored row and everything after an RPC failure are upserted whole.
+        """
+        patches, full = [], []
+        for chat_id, base, user_data in rows:
+            size = len(json.dumps(user_data, default=str))
+            self.full_bytes += size
+            if not self.deltas_enabled or base is None:
+                full.append((chat_id, user_data, size))
+                continue
+            ops = json_patch.diff(base, user_data)
+            if not ops:
+                continue  # unchanged
+            patch_size = len(json.dumps(ops, default=str))
+            if patch_size > DELTA_MAX_RATIO * size or any(op["path"] == "" for op in ops):
+                full.append((chat_id, user_data, size))
+            else:
+                patches.append((chat_id, ops, user_data, size, patch_size))
+        if patches:
+            try:
+                await self._connect()
+                response = await self._client.rpc(
+                    "patch_user_data", {"p_rows": [{"chat_id": chat_id, "ops": ops} for chat_id, ops, *_ in patches]}
+                ).execute()
+                missing = set(response.data or [])
+            except Exception as e:
+                if getattr(e, "code", None) == "PGRST202":  # PostgREST: no such function
+                    logging.warning("patch_user_data RPC not installed, writing full documents from now on")
+                    self.deltas_enabled = False
+                else:
+                    logging.error(f"patch_user_data RPC failed, writing these documents in full: {e}")
+                missing = {chat_id for chat_id, *_ in patches}
+            for chat_id, ops, user_data, size, patch_size in patches:
+                if chat_id in missing:
+                    full.append((chat_id, user_data, size))
+                else:
+                    self.patched_rows += 1
+                    self.bytes_sent += patch_size
+        if full:
+            await self.save_many([(chat_id, user_data) for chat_id, user_data, _ in full])
+            self.full_rows += len(full)
+            self.bytes_sent += sum(size for *_, size in full)
+
+    def stats(self):
+        return {
+            "patched_rows": self.patched_rows,
+            "full_rows": self.full_rows,
+            "bytes_sent": self.bytes_sent,
+            "full_write_bytes": self.full_bytes,
+        }
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+        self._client = self._http = None
+
+
+class WriteBehindUserStore:
+    """LRU of hot user_data in front of a UserStore, writing changes back in batches.
+
+    fetch() is served from memory while an entry is younger than ttl_seconds
+    (other processes, such as the scheduler, write user_data too). save()
+    only updates memory and marks the chat dirty. Dirty chats are written
+    in batches of up to batch_size rows:
+      - every flush_seconds (run_flusher)
+      - as soon as max_dirty chats are waiting
+      - when a dirty entry is evicted from the LRU
+      - on close()
+    A crash therefore loses at most flush_seconds of updates, for at most
+    max_dirty chats. A batch that fails stays dirty for the next flush; the
+    other batches are still written.
+
+    Each batch first re-reads its rows. A row another process changed since
+    it was cached gets this process's changes merged into it
+    (json_patch.rebase, the other write wins where both changed the same
+    value) instead of being overwritten, and the merged document replaces
+    the cache entry.
+    """
+
+    def __init__(self, store, maxsize=USER_CACHE_SIZE, ttl_seconds=USER_CACHE_TTL_SECONDS,
+                 flush_seconds=USER_CACHE_FLUSH_SECONDS, max_dirty=USER_CACHE_MAX_DIRTY,
+                 batch_size=USER_CACHE_BATCH_SIZE):
+        self.store = store
+        self.loop = store.loop
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.flush_seconds = flush_seconds
+        self.max_dirty = max_dirty
+        self.batch_size = batch_size
+        self._entries = collections.OrderedDict()  # chat_id -> (user_data, expires_at)
+        self._dirty = {}  # chat_id -> latest unsaved user_data
+        self._persisted = {}  # chat_id -> the document as stored, base of the next delta write
+        self._flush_lock = asyncio.Lock()
+        self._flush_tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self.rebased_rows = 0
+
+    def _remember(self, chat_id, user_data):
+        self._entries[chat_id] = (user_data, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.maxsize:
+            evicted, _ = self._entries.popitem(last=False)
+            if evicted not in self._dirty:
+                self._persisted.pop(evicted, None)
+            else:
+                task = self.loop.create_task(self.flush())
+                self._flush_tasks.add(task)
+                task.add_done_callback(self._flush_tasks.discard)
+
+    async def fetch(self, chat_id):
+        """The chat's user_data (a copy the caller may change), or None for a chat without a row"""
+        if chat_id in self._dirty:
+            self.hits += 1
+            return copy.deepcopy(self._dirty[chat_id])
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(chat_id)
+            return copy.deepcopy(entry[0])
+        self.misses += 1
+        user_data = await self.store.fetch(chat_id)
+        if chat_id not in self._dirty:  # a save during the fetch is newer
+            self._persisted[chat_id] = user_data
+            self._remember(chat_id, user_data)
+        return copy.deepcopy(user_data)
+
+    async def fetch_all(self):
+        await self.flush()
+        return await self.store.fetch_all()
+
+    async def save(self, chat_id, user_data, base=None):
+        """Cache user_data and mark it dirty; base is ignored, flushes diff against the stored document"""
+        user_data = copy.deepcopy(user_data)
+        self._dirty[chat_id] = user_data
+        self._remember(chat_id, user_data)
+        if len(self._dirty) >= self.max_dirty:
+            await self.flush()
+
+    async def flush(self):
+        """Write every dirty chat in batches (as deltas, see UserStore.save_changes); rows saved again meanwhile stay dirty"""
+        async with self._flush_lock:
+            rows = list(self._dirty.items())
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                try:
+                    changes = await self._rebase(batch)
+                    await self.store.save_changes(changes)
+                except Exception as e:
+                    # only this batch stays dirty; the rest are still written
+                    self.flush_errors += 1
+                    logging.error(f"User state flush failed, {len(batch)} chats stay dirty: {e}")
+                    continue
+                for (chat_id, user_data), (_, _, stored) in zip(batch, changes):
+                    if self._dirty.get(chat_id) is not user_data:
+                        # saved again meanwhile from user_data; the next flush rebases that onto stored
+                        self._persisted[chat_id] = user_data
+                        continue
+                    del self._dirty[chat_id]
+                    if chat_id in self._entries:
+                        self._persisted[chat_id] = stored
+                        self._entries[chat_id] = (stored, time.monotonic() + self.ttl_seconds)
+                    else:
+                        self._persisted.pop(chat_id, None)
+                self.flushes += 1
+                self.flushed_rows += len(batch)
+
+    async def _rebase(self, batch):
+        """save_changes rows for [(chat_id, user_data), ...], rebased onto rows changed by other processes"""
+        known = [chat_id for chat_id, _ in batch if self._persisted.get(chat_id) is not None]
+        current = await self.store.fetch_many(known) if known else {}
+        changes = []
+        for chat_id, user_data in batch:
+            base = self._persisted.get(chat_id)
+            stored = current.get(chat_id)
+            if stored is not None and stored != base:
+                self.rebased_rows += 1
+                user_data = json_patch.rebase(base, stored, user_data)
+                base = stored
+            changes.append((chat_id, base, user_data))
+        return changes
+
+    async def run_flusher(self):
+        """Background task: flush every flush_seconds"""
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def close(self):
+        """Flush (retrying a failed batch once) and close the store; rows that still fail are logged as lost"""
+        await self.flush()
+        if self._dirty:
+            await self.flush()
+        if self._dirty:
+            logging.error(f"User state of {len(self._dirty)} chats could not be saved before shutdown: {sorted(self._dirty)}")
+        await self.store.close()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+            "rebased_rows": self.rebased_rows,
+            **self.store.stats(),
+        }
+
+
+_store = None
+
+
+def get_user_store():
+    """The UserStore of the running event loop (one per process in the bot, the scheduler and webhook mode)"""
+    global _store
+    if _store is None or _store.loop is not asyncio.get_running_loop():
+        _store = UserStore()
+    return _store
+
+
+_user_state = None
+
+
+def get_user_state():
+    """The bot's user_data access: get_user_store() behind a WriteBehindUserStore when USER_CACHE_ENABLED"""
+    global _user_state
+    store = get_user_store()
+    if not USER_CACHE_ENABLED:
+        return store
+    if _user_state is None or _user_state.store is not store:
+        _user_state = WriteBehindUserStore(store)
+    return _user_state